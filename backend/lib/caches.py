@@ -0,0 +1,471 @@
+import re
+import threading
+
+SEARCH_FIELDS = (2, 3, 6)    # item row columns that are searched: name, desc and type
+
+
+class Cache:
+    """
+    Base of the caches below.  A bulk load can run while commands keep changing the cache, so changes made between
+    begin_load and the end of the load are journaled and re-applied on top of the loaded rows.
+    """
+    def __init__(self):
+        self.loaded = False
+        self.lock = threading.RLock()   # helper functions update the caches from database threads
+        self.journal = None             # changes made while a bulk load is running
+
+    def begin_load(self):
+        """
+        Start journaling changes, call before reading the rows to load
+        :return: void
+        """
+        with self.lock:
+            self.journal = []
+
+    def abort_load(self):
+        """
+        Drop a bulk load that failed, the cache keeps falling back to the database
+        :return: void
+        """
+        with self.lock:
+            self.journal = None
+
+    def record(self, change, *args):
+        """
+        Journal a change if a bulk load is running, called by every change with the lock held
+        :param change: the method making the change
+        :param args: its arguments
+        :return: void
+        """
+        if self.journal is not None:
+            self.journal.append((change, args))
+
+    def replay(self):
+        """
+        Re-apply the journaled changes after loading rows and mark the cache loaded, called with the lock held
+        :return: void
+        """
+        journal, self.journal = self.journal or [], None
+        for change, args in journal:
+            change(*args)
+        self.loaded = True
+
+
+class ShopRoutingTable(Cache):
+    """
+    In-memory map of shop channel id -> shop row (shop_id, owner, name, desc, status, sign_id).
+    Once loaded it holds every shop, so a channel missing from the table is known not to be a shop.
+    The helper functions keep it in sync whenever they change the shop table.
+    """
+    def __init__(self):
+        super().__init__()
+        self.shops = {}
+
+    def load(self, rows):
+        """
+        Replace the table with every row of the shop table
+        :param rows: all shop rows
+        :return: void
+        """
+        with self.lock:
+            self.shops = {int(row[0]): tuple(row) for row in rows}
+            self.replay()
+
+    def get(self, shop_id):
+        """
+        Gets the cached row of a shop
+        :param shop_id: channel id of the shop
+        :return: shop row, or None if the shop is not cached
+        """
+        return self.shops.get(int(shop_id))
+
+    def is_shop(self, channel_id):
+        """
+        Checks if a channel could be a shop without going to the database
+        :param channel_id: id of the channel to check
+        :return: False if the channel is known not to be a shop, True otherwise
+        """
+        return not self.loaded or int(channel_id) in self.shops
+
+    def put(self, row):
+        """
+        Add or replace a shop row
+        :param row: the shop row
+        :return: void
+        """
+        with self.lock:
+            self.record(self.put, row)
+            self.shops[int(row[0])] = tuple(row)
+
+    def update(self, shop_id, index, value):
+        """
+        Update a single column of a cached shop row, if the shop is cached
+        :param shop_id: channel id of the shop
+        :param index: column index in the shop row
+        :param value: new value of the column
+        :return: void
+        """
+        with self.lock:
+            self.record(self.update, shop_id, index, value)
+            row = self.shops.get(int(shop_id))
+            if row is not None:
+                self.shops[int(shop_id)] = row[:index] + (value,) + row[index + 1:]
+
+    def discard(self, shop_id):
+        """
+        Remove a shop from the table
+        :param shop_id: channel id of the shop
+        :return: void
+        """
+        with self.lock:
+            self.record(self.discard, shop_id)
+            self.shops.pop(int(shop_id), None)
+
+
+class OwnershipIndex(Cache):
+    """
+    In-memory index of who owns which control panel and shop, so a command preamble can check the control panel
+    and find the shop in one lookup.  Once loaded it holds every control panel and shop.
+    """
+    def __init__(self):
+        super().__init__()
+        self.panel_owners = {}  # control panel channel id -> owner id
+        self.owner_panels = {}  # owner id -> control panel channel id
+        self.owner_shops = {}   # owner id -> shop id
+
+    def load(self, panel_rows, shop_rows):
+        """
+        Replace the index with the rows of the shop_control and shop tables
+        :param panel_rows: (shop_category_id, owner) rows of every control panel
+        :param shop_rows: rows of every shop
+        :return: void
+        """
+        with self.lock:
+            self.panel_owners = {int(row[0]): int(row[1]) for row in panel_rows}
+            self.owner_panels = {owner: panel for panel, owner in self.panel_owners.items()}
+            self.owner_shops = {int(row[1]): int(row[0]) for row in shop_rows}
+            self.replay()
+
+    def lookup(self, channel_id):
+        """
+        Gets the owner and shop of a control panel channel
+        :param channel_id: id of the channel
+        :return: (owner id, shop id or None), or None if the channel is not a cached control panel
+        """
+        owner = self.panel_owners.get(int(channel_id))
+        if owner is None:
+            return None
+        return owner, self.owner_shops.get(owner)
+
+    def get_panel(self, owner):
+        """
+        Gets the control panel of a user
+        :param owner: id of the user
+        :return: control panel channel id, or None if not cached
+        """
+        return self.owner_panels.get(int(owner))
+
+    def get_shop(self, owner):
+        """
+        Gets the shop of a user
+        :param owner: id of the user
+        :return: shop id, or None if not cached
+        """
+        return self.owner_shops.get(int(owner))
+
+    def put_panel(self, owner, channel_id):
+        """
+        Record a user's control panel
+        :param owner: id of the user
+        :param channel_id: id of the control panel channel
+        :return: void
+        """
+        with self.lock:
+            self.record(self.put_panel, owner, channel_id)
+            self.panel_owners[int(channel_id)] = int(owner)
+            self.owner_panels[int(owner)] = int(channel_id)
+
+    def put_shop(self, owner, shop_id):
+        """
+        Record a user's shop
+        :param owner: id of the user
+        :param shop_id: id of the shop channel
+        :return: void
+        """
+        with self.lock:
+            self.record(self.put_shop, owner, shop_id)
+            self.owner_shops[int(owner)] = int(shop_id)
+
+    def discard_panel(self, owner):
+        """
+        Remove a user's control panel
+        :param owner: id of the user
+        :return: void
+        """
+        with self.lock:
+            self.record(self.discard_panel, owner)
+            channel_id = self.owner_panels.pop(int(owner), None)
+            self.panel_owners.pop(channel_id, None)
+
+    def discard_shop(self, owner):
+        """
+        Remove a user's shop
+        :param owner: id of the user
+        :return: void
+        """
+        with self.lock:
+            self.record(self.discard_shop, owner)
+            self.owner_shops.pop(int(owner), None)
+
+
+class ItemCache(Cache):
+    """
+    In-memory map of item id -> item row (item_id, shop_id, name, desc, price, qty, type, image), also indexed by
+    shop and by the words of each item's name, description and type for search.  Once loaded it holds every item,
+    so an item missing from the cache doesn't exist.  Items are loaded in chunks as they are streamed from the
+    database.
+    """
+    def __init__(self):
+        super().__init__()
+        self.items = {}
+        self.shops = {}         # shop id -> set of item ids
+        self.words = {}         # word -> set of item ids, the inverted index used by search
+        self.staged = None      # rows streamed so far by a bulk load
+
+    def begin_load(self):
+        """
+        Start a bulk load
+        :return: void
+        """
+        with self.lock:
+            super().begin_load()
+            self.staged = []
+
+    def load_chunk(self, rows):
+        """
+        Add a chunk of streamed item rows to the bulk load
+        :param rows: item rows
+        :return: void
+        """
+        with self.lock:
+            self.staged.extend(tuple(row) for row in rows)
+
+    def finish_load(self):
+        """
+        Replace the cache with the streamed rows
+        :return: void
+        """
+        with self.lock:
+            self.items = {}
+            self.shops = {}
+            self.words = {}
+            for row in self.staged:
+                self._add(row)
+            self.staged = None
+            self.replay()
+
+    def abort_load(self):
+        """
+        Drop a bulk load that failed, the cache keeps falling back to the database
+        :return: void
+        """
+        with self.lock:
+            super().abort_load()
+            self.staged = None
+
+    def get(self, item_id, shop_id):
+        """
+        Gets the cached row of an item
+        :param item_id: id of the item
+        :param shop_id: id of the shop the item must belong to
+        :return: item row, or None if it isn't cached, belongs to another shop or the id isn't a number
+        """
+        try:
+            item_id = int(item_id)
+        except (TypeError, ValueError):
+            return None     # ids typed into commands may be anything
+
+        row = self.items.get(item_id)
+        if row is None or int(row[1]) != int(shop_id):
+            return None
+        return row
+
+    def get_shop(self, shop_id):
+        """
+        Gets the cached rows of a shop's items
+        :param shop_id: id of the shop
+        :return: list of item rows ordered by item id
+        """
+        with self.lock:
+            return sorted((self.items[item_id] for item_id in self.shops.get(int(shop_id), ())),
+                          key=lambda row: row[0])
+
+    def put(self, row):
+        """
+        Add or replace an item row
+        :param row: the item row
+        :return: void
+        """
+        with self.lock:
+            self.record(self.put, row)
+            self._remove(int(row[0]))
+            self._add(tuple(row))
+
+    def update(self, item_id, shop_id, changes):
+        """
+        Update columns of a cached item row, if the item is cached and belongs to the shop
+        :param item_id: id of the item
+        :param shop_id: id of the shop the item belongs to
+        :param changes: dict of column index -> new value
+        :return: void
+        """
+        with self.lock:
+            self.record(self.update, item_id, shop_id, changes)
+            row = self.get(item_id, shop_id)
+            if row is not None:
+                self._remove(int(item_id))  # reindexes the changed words
+                self._add(tuple(changes.get(index, value) for index, value in enumerate(row)))
+
+    def rekey(self, item_id, shop_id, new_item_id):
+        """
+        Move a cached item to a new id, after its message was reposted
+        :param item_id: current id of the item
+        :param shop_id: id of the shop the item belongs to
+        :param new_item_id: new id of the item
+        :return: void
+        """
+        with self.lock:
+            self.record(self.rekey, item_id, shop_id, new_item_id)
+            row = self.get(item_id, shop_id)
+            if row is not None:
+                self._remove(int(item_id))
+                self._add((int(new_item_id),) + row[1:])
+
+    def discard(self, item_id, shop_id):
+        """
+        Remove an item, if it belongs to the shop
+        :param item_id: id of the item
+        :param shop_id: id of the shop the item belongs to
+        :return: void
+        """
+        with self.lock:
+            self.record(self.discard, item_id, shop_id)
+            if self.get(item_id, shop_id) is not None:
+                self._remove(int(item_id))
+
+    def discard_shop(self, shop_id):
+        """
+        Remove every item of a shop
+        :param shop_id: id of the shop
+        :return: void
+        """
+        with self.lock:
+            self.record(self.discard_shop, shop_id)
+            for item_id in list(self.shops.get(int(shop_id), ())):
+                self._remove(item_id)
+
+    def search(self, query):
+        """
+        Finds the items whose name, description or type contain every word of a query
+        :param query: text to search for
+        :return: list of matching item rows ordered by price
+        """
+        words = set(tokenize(query))
+        if len(words) == 0:
+            return []
+
+        with self.lock:
+            matches = sorted((self.words.get(word, set()) for word in words), key=len)     # smallest set first
+            item_ids = set(matches[0])
+            for match in matches[1:]:
+                item_ids &= match
+            rows = [self.items[item_id] for item_id in item_ids]
+
+        return sorted(rows, key=lambda row: (row[4], row[0]))
+
+    def _add(self, row):
+        item_id = int(row[0])
+        self.items[item_id] = row
+        self.shops.setdefault(int(row[1]), set()).add(item_id)
+        for word in item_words(row):
+            self.words.setdefault(word, set()).add(item_id)
+
+    def _remove(self, item_id):
+        row = self.items.pop(item_id, None)
+        if row is not None:
+            shop = self.shops.get(int(row[1]))
+            shop.discard(item_id)
+            if len(shop) == 0:
+                del self.shops[int(row[1])]
+
+            for word in item_words(row):
+                items = self.words.get(word)
+                items.discard(item_id)
+                if len(items) == 0:
+                    del self.words[word]
+
+
+class AdminSet(Cache):
+    """
+    In-memory set of the ids of admin users.  Once loaded it holds every admin, so any other user isn't one.
+    """
+    def __init__(self):
+        super().__init__()
+        self.admins = set()
+
+    def load(self, rows):
+        """
+        Replace the set with the ids of every admin
+        :param rows: (user_id,) rows of every admin
+        :return: void
+        """
+        with self.lock:
+            self.admins = {int(row[0]) for row in rows}
+            self.replay()
+
+    def is_admin(self, user_id):
+        return int(user_id) in self.admins
+
+    def put(self, user_id):
+        """
+        Record that a user is an admin
+        :param user_id: id of the user
+        :return: void
+        """
+        with self.lock:
+            self.record(self.put, user_id)
+            self.admins.add(int(user_id))
+
+    def discard(self, user_id):
+        """
+        Record that a user isn't an admin
+        :param user_id: id of the user
+        :return: void
+        """
+        with self.lock:
+            self.record(self.discard, user_id)
+            self.admins.discard(int(user_id))
+
+
+def tokenize(text):
+    """
+    Splits text into lower case words for the search index
+    :param text: the text
+    :return: list of words
+    """
+    return re.findall(r'\w+', str(text).lower())
+
+
+def item_words(row):
+    """
+    Gets the words an item is indexed under
+    :param row: the item row
+    :return: set of words of the item's name, description and type
+    """
+    return {word for index in SEARCH_FIELDS for word in tokenize(row[index])}
+
+
+shop_routes = ShopRoutingTable()
+control_panels = OwnershipIndex()
+item_rows = ItemCache()
+admin_users = AdminSet()
@@ -0,0 +1,248 @@
+import asyncio
+import functools
+import inspect
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mysql.connector import errors, pooling
+
+from backend.lib.metrics import metrics
+from backend.lib.sqlite_storage import MEMORY, SQLitePool
+from backend.lib.tracing import span
+
+
+class Database:
+    """
+    Async data-access layer for the bot.  The SQL helper functions in helper_commands and user_queries are blocking
+    (mysql.connector or sqlite3), so they are run on worker threads instead of directly inside the discord.py event
+    loop.
+    Every call checks a connection out of a pool and gets its own cursor, so commands can run concurrently.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.executor = ThreadPoolExecutor(max_workers=pool.pool_size,
+                                           thread_name_prefix='database')  # never more workers than connections
+        # units of work keep their connection between statements, so they get their own threads and can never be
+        # stuck behind single queries waiting for that connection
+        self.transaction_executor = ThreadPoolExecutor(max_workers=pool.pool_size,
+                                                       thread_name_prefix='database-transaction')
+        self.available = threading.BoundedSemaphore(pool.pool_size)   # connections left in the pool
+
+    async def run(self, func, *args):
+        """
+        Run a blocking SQL helper function without stalling the event loop
+        :param func: helper function whose last parameters are cursor (and optionally cnx)
+        :param args: arguments for the helper function, excluding cursor and cnx
+        :return: whatever the helper function returns; exceptions raised by the helper are re-raised here
+        """
+        loop = asyncio.get_event_loop()
+        with span('sql ' + func.__name__):     # includes waiting for a worker and a connection
+            return await loop.run_in_executor(self.executor, functools.partial(self.call, func, *args))
+
+    def call(self, func, *args):
+        """
+        Call a helper function with a pooled connection and a fresh cursor, blocking until it finishes.  Used
+        directly only before the bot starts (eg. migrations), everything else goes through run.  If the connection
+        was dropped by the server (eg. wait_timeout) the call is retried once on a reconnected connection.
+        :param func: helper function to call
+        :param args: arguments for the helper function, excluding cursor and cnx
+        :return: result of the helper function
+        """
+        try:
+            return self._call_once(func, *args)
+        except (errors.OperationalError, errors.InterfaceError):
+            return self._call_once(func, *args)
+
+    def _call_once(self, func, *args):
+        """
+        Check out a connection, run a helper function on its own cursor and return the connection to the pool
+        :param func: helper function to call
+        :param args: arguments for the helper function, excluding cursor and cnx
+        :return: result of the helper function
+        """
+        cnx = self.checkout()
+        cursor = cnx.cursor()
+        try:
+            return invoke(func, args, cursor, cnx)
+        except Exception:
+            cnx.rollback()  # don't leave half of a helper's changes pending on the connection
+            raise
+        finally:
+            cursor.close()
+            self.release(cnx)
+
+    def checkout(self):
+        """
+        Get a healthy connection from the pool, waiting for one to be returned if they are all in use, and
+        reconnecting it if the server closed it
+        :return: pooled connection object
+        """
+        start = time.perf_counter()
+        self.available.acquire()
+        metrics.observe('connection_wait_seconds', time.perf_counter() - start)    # sizes the pool
+        try:
+            cnx = self.pool.get_connection()
+            cnx.ping(reconnect=True, attempts=3, delay=1)   # health check, transparently reconnects stale connections
+        except Exception:
+            self.available.release()
+            raise
+        return cnx
+
+    def release(self, cnx):
+        """
+        Return a connection to the pool
+        :param cnx: connection from checkout
+        :return: void
+        """
+        try:
+            cnx.close()     # returns the connection to the pool
+        finally:
+            self.available.release()
+
+    def transaction(self):
+        """
+        Start a unit of work, grouping several helper calls into a single commit
+            async with db.transaction() as tx:
+                await tx.run(create_user_control_panel, user_id, control_channel_id)
+                await tx.run(create_user_shop, user_id, ...)
+        :return: UnitOfWork to use with async with
+        """
+        return UnitOfWork(self)
+
+    def close(self):
+        """
+        Stop the database threads once all pending queries have finished
+        :return: void
+        """
+        self.executor.shutdown(wait=True)
+        self.transaction_executor.shutdown(wait=True)
+
+
+class UnitOfWork:
+    """
+    Runs helper functions on one connection and commits them together when the async with block exits, or rolls
+    them all back if it raises.  The helpers' own commits are deferred, as are their cache updates.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.cnx = None
+        self.deferred = []      # cache updates to run after the commit, see helper_commands.on_commit
+
+    async def __aenter__(self):
+        loop = asyncio.get_event_loop()
+        self.cnx = await loop.run_in_executor(self.db.executor, self.db.checkout)    # may wait for a connection
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                with span('sql commit'):
+                    await self._execute(self.cnx.commit)
+            else:
+                await self._execute(self.cnx.rollback)
+        finally:
+            self.db.release(self.cnx)
+
+        if exc_type is None:
+            for callback in self.deferred:
+                callback()
+
+    async def run(self, func, *args):
+        """
+        Run a helper function as part of this unit of work
+        :param func: helper function whose last parameters are cursor (and optionally cnx)
+        :param args: arguments for the helper function, excluding cursor and cnx
+        :return: whatever the helper function returns
+        """
+        with span('sql ' + func.__name__):
+            return await self._execute(functools.partial(self._call, func, *args))
+
+    def _call(self, func, *args):
+        cursor = self.cnx.cursor()
+        try:
+            return invoke(func, args, cursor, self)     # helpers commit through us, which defers the commit
+        finally:
+            cursor.close()
+
+    def _execute(self, func):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.db.transaction_executor, func)
+
+    def commit(self):
+        """Helpers call this after their statements, the real commit happens when the unit of work ends"""
+
+    def rollback(self):
+        """Helpers call this on failure, the whole unit of work is rolled back when the exception leaves it"""
+
+
+def create_pool(username, password, host, database, pool_size):
+    """
+    Creates the MySQL connection pool used by the Database
+    :param username: database user
+    :param password: database password
+    :param host: database host
+    :param database: name of the database
+    :param pool_size: number of connections to keep open
+    :return: connection pool object
+    """
+    return pooling.MySQLConnectionPool(pool_name='discord_shop',
+                                       pool_size=pool_size,
+                                       pool_reset_session=True,
+                                       user=username,
+                                       password=password,
+                                       host=host,
+                                       database=database)
+
+
+def open_pool(config):
+    """
+    Creates the connection pool of the storage backend selected in the [Database] section of configuration.conf
+        backend = mysql     username, password, host and database of a MySQL server (default)
+        backend = sqlite    path of a SQLite database file
+        backend = memory    SQLite database in memory, lost when the bot stops
+    :param config: the [Database] section
+    :return: connection pool object
+    """
+    backend = config.get('backend', 'mysql').lower()
+    pool_size = config.getint('pool_size', 5)
+
+    if backend == 'mysql':
+        return create_pool(config['username'], config['password'], config['host'], config['database'], pool_size)
+    if backend == 'sqlite':
+        return SQLitePool(config['path'], pool_size)
+    if backend == 'memory':
+        return SQLitePool(MEMORY)
+
+    raise ValueError('Unknown database backend: {0}'.format(backend))
+
+
+def invoke(func, args, cursor, cnx):
+    """
+    Call a helper function, recording its latency and any exception it raises
+    :param func: helper function to call
+    :param args: arguments for the helper function, excluding cursor and cnx
+    :param cursor: cursor object for the helper
+    :param cnx: connection object for helpers that commit
+    :return: result of the helper function
+    """
+    start = time.perf_counter()
+    try:
+        if takes_cnx(func):
+            return func(*args, cursor, cnx)
+        return func(*args, cursor)
+    except Exception as e:
+        metrics.increment('errors_total', source=func.__name__, error=type(e).__name__)
+        raise
+    finally:
+        metrics.observe('query_seconds', time.perf_counter() - start, function=func.__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def takes_cnx(func):
+    """
+    Checks if a helper function commits changes and therefore needs the connection object
+    :param func: helper function to check
+    :return: True if the function has a cnx parameter, False otherwise
+    """
+    return 'cnx' in inspect.signature(func).parameters
@@ -1,42 +1,67 @@
+import discord
 from discord.ext import commands
 
-from backend.lib.helper_commands import ShopNotFoundError, get_shop, set_shop_sign, get_shop_sign
-from backend.lib.shop_queries import create_shop_sign
-from backend.lib.user_queries import sql_add_user, sql_delete_user
+from backend.lib.caches import shop_routes
+from backend.lib.metrics import metrics
+from backend.lib.outbound import BACKGROUND
+from backend.lib.user_queries import sql_delete_users
+
+WELCOME_MESSAGE = "Welcome to Affiliates Only!\n\nIf you wish to invite others our permanent invite link is https://discord.gg/vw8AN3j "
 
 
 class EventActions(commands.Cog):
-    def __init__(self, bot, cursor, cnx):
+    def __init__(self, bot, db, outbound, signs, joins, renderer, shop_category_id):
         self.bot = bot
-        self.cursor = cursor
-        self.cnx = cnx
+        self.db = db
+        self.outbound = outbound
+        self.signs = signs
+        self.joins = joins
+        self.renderer = renderer
+        self.shop_category_id = shop_category_id
+
+    async def welcome(self, member):
+        """
+        Send a joining member the welcome message, paced behind commands users are waiting on
+        :param member: the member
+        :return: void
+        """
+        try:
+            await self.outbound.send(member, WELCOME_MESSAGE, priority=BACKGROUND)
+        except discord.HTTPException:
+            pass    # member doesn't accept direct messages
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
-        await member.send("Welcome to Affiliates Only!\n\nIf you wish to invite others our permanent invite link is https://discord.gg/vw8AN3j ")
-        sql_add_user(member.id, member.name + "#" + member.discriminator, "", "false", 0, member.joined_at,
-                     self.cursor, self.cnx)
+        self.joins.add(member.id, member.name + "#" + member.discriminator, member.joined_at)    # written in batches
+        self.bot.loop.create_task(self.welcome(member))
 
     @commands.Cog.listener()
-    async def on_member_leave(self, member):
-        sql_delete_user(member.id, self.cursor, self.cnx)
+    async def on_member_remove(self, member):
+        if self.joins.discard(member.id):
+            return  # left before their user was written
+
+        await self.db.run(sql_delete_users, [member.id])     # no error if the user was never added
 
     @commands.Cog.listener()
-    async def on_message(self, message):
-        try:
-            shop_id = message.channel.id
-            shop_results = get_shop(shop_id, self.cursor)
+    async def on_user_update(self, before, after):
+        if (before.name, before.discriminator, before.avatar) == (after.name, after.discriminator, after.avatar):
+            return  # nothing shown in item embeds or signs changed
+
+        await self.renderer.render_owner(after)     # only edits messages whose render changed
 
-            formatted_status = "open" if int(shop_results[4]) == 1 else "closed"
-            check = "**This shop is currently " + formatted_status + "!**"
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if message.guild is None or message.channel.category_id != self.shop_category_id:
+            return  # only shop channels have signs, skip general chat without touching the database
 
-            if check not in message.content:
-                new_sign = await message.channel.send(create_shop_sign(self.bot.get_user(int(shop_results[1])), shop_results, self.cursor))
+        if message.author.bot and message.author != self.bot.user:
+            return  # other bots never post in shops
 
-                old_msg = await message.channel.fetch_message(get_shop_sign(shop_id, self.cursor))
+        if not shop_routes.is_shop(message.channel.id):
+            return  # channel in the shop category that isn't a shop
 
-                set_shop_sign(shop_id, new_sign.id, self.cursor, self.cnx)
-                await old_msg.delete()
+        if message.author == self.bot.user and "**This shop is currently " in message.content:
+            return  # our own sign post
 
-        except ShopNotFoundError:
-            pass    # do nothing
\ No newline at end of file
+        metrics.increment('shop_messages_total', shop=message.channel.id)     # finds hot shops
+        self.signs.request_repost(message.channel.id)    # coalesced, reposts at most once per window
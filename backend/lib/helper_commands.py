@@ -1,11 +1,16 @@
 from discord.ext import commands
 
+from backend.lib.caches import shop_routes, control_panels, item_rows, admin_users
+from backend.lib.metrics import metrics
+
 
 class HelperCommands(commands.Cog):
-    def __init__(self, bot, cursor, cnx):
+    def __init__(self, bot, db, outbound, members, renderer):
         self.bot = bot
-        self.cursor = cursor
-        self.cnx = cnx
+        self.db = db
+        self.outbound = outbound
+        self.members = members
+        self.renderer = renderer
 
     @commands.command(name='exit')
     async def exit_bot(self, ctx):
@@ -13,14 +18,68 @@ class HelperCommands(commands.Cog):
         Prompt bot to logout
         :return: none
         """
-        self.cursor.close()
-        self.cnx.close()
+        self.db.close()
         await self.bot.logout()  # log the bot out
 
+    @commands.command()
+    async def stats(self, ctx):
+        """
+        Show command, SQL and Discord API statistics (admin only)
+        :return: none
+        """
+        try:
+            await self.db.run(check_admin_status, ctx.author.id, True)
+        except AdminPermissionError:
+            await self.outbound.send(ctx, "Error: You must be an admin to perform this command!")
+            return
+
+        await self.outbound.send(ctx, "```" + metrics.summary()[:1990] + "```")
+
+    @commands.command()
+    async def sync_members(self, ctx):
+        """
+        Add members missing from the database and remove users who left the server (admin only)
+        :return: none
+        """
+        try:
+            await self.db.run(check_admin_status, ctx.author.id, True)
+        except AdminPermissionError:
+            await self.outbound.send(ctx, "Error: You must be an admin to perform this command!")
+            return
+
+        report = await self.members.sync()
+        await self.outbound.send(ctx, "Synced {0} members: added {1} and removed {2} users.".format(
+            report['members'], report['added'], report['deleted']))
+
+    @commands.command()
+    async def rerender(self, ctx):
+        """
+        Bring every item embed and shop sign up to date, eg. after a template changed (admin only)
+        :return: none
+        """
+        try:
+            await self.db.run(check_admin_status, ctx.author.id, True)
+        except AdminPermissionError:
+            await self.outbound.send(ctx, "Error: You must be an admin to perform this command!")
+            return
+
+        await self.outbound.send(ctx, "Re-rendering every shop in the background, only changed messages are edited.")
+
+        async def render():
+            report = await self.renderer.render_all()
+            await self.outbound.send(ctx, "Re-rendered {0} shops: edited {1} of {2} messages.".format(
+                report['shops'], report['edited'], report['messages']))
+
+        self.bot.loop.create_task(render())    # takes a while under rate limits
+
 
 # HELPER FUNCTIONS #
 
 
+ITEM_FIELDS = {'name': 2, 'desc': 3, 'price': 4, 'qty': 5, 'type': 6, 'image': 7}     # item field -> row index
+LOAD_BATCH = 1000     # rows fetched at a time when streaming a table into a cache
+
+
 def check_admin_status(user_id, add, cursor):
     """
     Check to see if a given user is an admin.  Only admins can change the database.
@@ -29,12 +88,16 @@ def check_admin_status(user_id, add, cursor):
     :param cursor: cursor object for executing search query
     :return: Raise AdminPermissionError if user is not admin or does not exist,Nothing if the user is an admin
     """
-    cursor.execute('select admin from user where user_id = %s', (user_id,))
-    result = cursor.fetchall()
+    if admin_users.loaded:  # every admin is in the set
+        is_admin = admin_users.is_admin(user_id)
+    else:
+        cursor.execute('select admin from user where user_id = %s', (user_id,))
+        result = cursor.fetchall()
+        is_admin = len(result) > 0 and result[0][0] == 1
 
-    if add and (len(result) == 0 or result[0][0] == 0):  # adding to the database
+    if add and not is_admin:  # adding to the database
         raise AdminPermissionError(user_id)
-    elif not add and (len(result) > 0 and result[0][0] == 1):  # removing from the database
+    elif not add and is_admin:  # removing from the database
         raise AdminPermissionError(user_id)
 
 
@@ -45,12 +108,20 @@ def get_user_control_panel(user_id, cursor):
     :param cursor: cursor object for executing search query
     :return: ControlPanelNotFoundError if control panel not found, control panel id if successful
     """
+    result = control_panels.get_panel(user_id)
+    if result is not None:
+        return result
+
+    if control_panels.loaded:  # every control panel is in the index
+        raise ControlPanelNotFoundError
+
     cursor.execute('select shop_category_id from shop_control where owner = %s', (user_id,))
     result = cursor.fetchall()
 
     if len(result) == 0:  # user not in control panel
         raise ControlPanelNotFoundError
 
+    control_panels.put_panel(user_id, result[0][0])
     return result[0][0]
 
 
@@ -62,6 +133,12 @@ def in_control_panel(user_id, channel_id, cursor):
     :param cursor: cursor object for executing search query
     :return: Raise CommandNotControlPanel if user is not in their control panel channel, or nothing if successful
     """
+    if control_panels.loaded:
+        entry = control_panels.lookup(channel_id)
+        if entry is None or entry[0] != int(user_id):
+            raise CommandNotControlPanelError
+        return
+
     cursor.execute('select owner from shop_control where owner = %s and shop_category_id = %s', (user_id, channel_id))
     result = cursor.fetchall()
 
@@ -76,25 +153,159 @@ def get_user_shop(user_id, cursor):
     :param cursor: cursor object for executing search query
     :return: Raise ShopNotFoundError if user doesn't have a shop, shop_id if they do
     """
+    result = control_panels.get_shop(user_id)
+    if result is not None:
+        return result
+
+    if control_panels.loaded:  # every shop is in the index
+        raise ShopNotFoundError
+
     cursor.execute('select shop_id from shop where owner = %s', (user_id,))
     result = cursor.fetchall()
 
     if len(result) == 0:  # user not in control panel
         raise ShopNotFoundError
 
+    control_panels.put_shop(user_id, result[0][0])
     return result[0][0]
 
 
+def get_control_panel(channel_id, cursor):
+    """
+    Gets the owner and shop of a control panel channel from the database, used before the ownership index is loaded
+    :param channel_id: the channel id of the control panel
+    :param cursor: cursor object for executing search query
+    :return: (owner id, shop id or None), or None if the channel is not a control panel
+    """
+    cursor.execute('select shop_control.owner, shop.shop_id from shop_control '
+                   'left join shop on shop.owner = shop_control.owner '
+                   'where shop_control.shop_category_id = %s', (channel_id,))
+    result = cursor.fetchall()
+
+    if len(result) == 0:  # channel is not a control panel
+        return None
+
+    control_panels.put_panel(result[0][0], channel_id)
+    if result[0][1] is not None:
+        control_panels.put_shop(result[0][0], result[0][1])
+
+    return int(result[0][0]), None if result[0][1] is None else int(result[0][1])
+
+
+def get_all_control_panels(cursor):
+    """
+    Gets every control panel row, used to populate the ownership index
+    :param cursor: cursor object for executing search query
+    :return: list of (shop_category_id, owner) rows
+    """
+    cursor.execute('select shop_category_id, owner from shop_control')
+    return cursor.fetchall()
+
+
 def get_shop(shop_id, cursor):
+    """
+    Gets the row of a shop, from the routing table when possible
+    :param shop_id: the id of the shop
+    :param cursor: cursor object for executing search query
+    :return: Raise ShopNotFoundError if the shop doesn't exist, the shop row if it does
+    """
+    result = shop_routes.get(shop_id)
+    if result is not None:
+        return result
+
+    if shop_routes.loaded:  # every shop is in the routing table
+        raise ShopNotFoundError
+
     cursor.execute('select * from shop where shop_id = %s', (shop_id,))
     result = cursor.fetchall()
 
     if len(result) == 0:  # shop not found
         raise ShopNotFoundError
 
+    shop_routes.put(result[0])
     return result[0]
 
 
+def get_all_shops(cursor):
+    """
+    Gets every shop row, used to populate the routing table
+    :param cursor: cursor object for executing search query
+    :return: list of shop rows
+    """
+    cursor.execute('select * from shop')
+    return cursor.fetchall()
+
+
+def load_shops(cursor):
+    """
+    Loads every shop and control panel into the routing table and ownership index
+    :param cursor: cursor object for executing search query
+    :return: (number of shops, number of control panels)
+    """
+    shop_routes.begin_load()     # changes committed while loading are kept
+    control_panels.begin_load()
+
+    try:
+        shop_rows = []
+        cursor.execute('select * from shop')
+        for rows in iter(lambda: cursor.fetchmany(LOAD_BATCH), []):
+            shop_rows.extend(rows)
+
+        panel_rows = []
+        cursor.execute('select shop_category_id, owner from shop_control')
+        for rows in iter(lambda: cursor.fetchmany(LOAD_BATCH), []):
+            panel_rows.extend(rows)
+    except Exception:
+        shop_routes.abort_load()
+        control_panels.abort_load()
+        raise
+
+    shop_routes.load(shop_rows)
+    control_panels.load(panel_rows, shop_rows)
+    return len(shop_rows), len(panel_rows)
+
+
+def load_items(cursor):
+    """
+    Streams every item into the item cache
+    :param cursor: cursor object for executing search query
+    :return: number of items
+    """
+    item_rows.begin_load()     # changes committed while loading are kept
+    count = 0
+
+    try:
+        cursor.execute('select * from item')
+        for rows in iter(lambda: cursor.fetchmany(LOAD_BATCH), []):
+            item_rows.load_chunk(rows)
+            count += len(rows)
+    except Exception:
+        item_rows.abort_load()
+        raise
+
+    item_rows.finish_load()
+    return count
+
+
+def load_admins(cursor):
+    """
+    Loads the ids of every admin into the admin set
+    :param cursor: cursor object for executing search query
+    :return: number of admins
+    """
+    admin_users.begin_load()     # changes committed while loading are kept
+
+    try:
+        cursor.execute('select user_id from user where admin = 1')
+        rows = cursor.fetchall()
+    except Exception:
+        admin_users.abort_load()
+        raise
+
+    admin_users.load(rows)
+    return len(rows)
+
+
 def get_shop_status(shop_id, cursor):
     """
     Gets the status of the shop being open
@@ -102,13 +313,7 @@ def get_shop_status(shop_id, cursor):
     :param cursor: cursor object for executing search query
     :return: Raise ShopNotFoundError if the shop doesn't exit, open status if the shop exists
     """
-    cursor.execute('select status from shop where shop_id = %s', (shop_id,))
-    result = cursor.fetchall()
-
-    if len(result) == 0:  # user not in shop
-        raise ShopNotFoundError
-
-    return int(result[0][0])
+    return int(get_shop(shop_id, cursor)[4])
 
 
 def set_shop_status(shop_id, status, cursor, cnx):
@@ -124,6 +329,103 @@ def set_shop_status(shop_id, status, cursor, cnx):
                    'set status = %s '
                    'where shop_id = %s', (status, shop_id))
     cnx.commit() # commit changes to shop table
+    on_commit(cnx, lambda: shop_routes.update(shop_id, 4, int(status)))
+
+
+def get_shop_statuses(shop_ids, cursor):
+    """
+    Gets the status of several shops, from the routing table when possible and with one query for the rest
+    :param shop_ids: ids of the shops
+    :param cursor: cursor object for executing search query
+    :return: dict of shop id -> status, shops that don't exist are left out
+    """
+    statuses = {}
+    uncached = []
+    for shop_id in shop_ids:
+        result = shop_routes.get(shop_id)
+        if result is not None:
+            statuses[shop_id] = int(result[4])
+        elif not shop_routes.loaded:  # a shop missing from a loaded table doesn't exist
+            uncached.append(shop_id)
+
+    if len(uncached) == 0:
+        return statuses
+
+    cursor.execute('select * from shop '
+                   'where shop_id in (' + ', '.join(['%s'] * len(uncached)) + ')', tuple(uncached))
+    for result in cursor.fetchall():
+        shop_routes.put(result)
+        statuses[int(result[0])] = int(result[4])
+
+    return statuses
+
+
+def set_shop_statuses(statuses, cursor, cnx):
+    """
+    Update the status of several shops in one commit
+    :param statuses: list of (shop id, status)
+    :param cursor: cursor object for executing update
+    :param cnx: connection object for committing changes
+    :return: void
+    """
+    if len(statuses) == 0:
+        return
+
+    cursor.executemany('update shop '
+                       'set status = %s '
+                       'where shop_id = %s', [(status, shop_id) for shop_id, status in statuses])
+    cnx.commit()  # commit every status at once
+
+    def update_caches():
+        for shop_id, status in statuses:
+            shop_routes.update(shop_id, 4, int(status))
+
+    on_commit(cnx, update_caches)
+
+
+def get_shop_schedules(cursor):
+    """
+    Gets the opening hours of every shop
+    :param cursor: cursor object for executing search query
+    :return: dict of shop id -> {day: (open minute, close minute)}
+    """
+    schedules = {}
+    cursor.execute('select shop_id, day, open_minute, close_minute from shop_schedule')
+    for rows in iter(lambda: cursor.fetchmany(LOAD_BATCH), []):
+        for shop_id, day, open_minute, close_minute in rows:
+            schedules.setdefault(int(shop_id), {})[int(day)] = (int(open_minute), int(close_minute))
+
+    return schedules
+
+
+def get_shop_schedule(shop_id, cursor):
+    """
+    Gets the opening hours of a shop
+    :param shop_id: id of the shop
+    :param cursor: cursor object for executing search query
+    :return: dict of day -> (open minute, close minute)
+    """
+    cursor.execute('select day, open_minute, close_minute from shop_schedule where shop_id = %s', (shop_id,))
+    return {int(day): (int(open_minute), int(close_minute)) for day, open_minute, close_minute in cursor.fetchall()}
+
+
+def set_shop_schedule(shop_id, days, hours, cursor, cnx):
+    """
+    Set the opening hours of a shop on some days of the week
+    :param shop_id: id of the shop
+    :param days: days of the week to set, 0 is Monday
+    :param hours: (open minute, close minute), or None to stay closed on those days
+    :param cursor: cursor object for executing update
+    :param cnx: connection object for committing changes
+    :return: the shop's new opening hours, dict of day -> (open minute, close minute)
+    """
+    cursor.executemany('delete from shop_schedule where shop_id = %s and day = %s', [(shop_id, day) for day in days])
+    if hours is not None:
+        cursor.executemany('insert into shop_schedule (shop_id, day, open_minute, close_minute) '
+                           'values (%s, %s, %s, %s)', [(shop_id, day) + tuple(hours) for day in days])
+    cnx.commit()  # commit every day at once
+
+    return get_shop_schedule(shop_id, cursor)
 
 
 def get_shop_sign(shop_id, cursor):
@@ -133,28 +435,28 @@ def get_shop_sign(shop_id, cursor):
     :param cursor: cursor object for executing search query
     :return: Raise ShopNotFoundError if the shop doesn't exit, sign id if successful
     """
-    cursor.execute('select sign_id from shop where shop_id = %s', (shop_id,))
-    result = cursor.fetchall()
-
-    if len(result) == 0:  # user not in shop
-        raise ShopNotFoundError
+    return int(get_shop(shop_id, cursor)[5])
 
-    return int(result[0][0])
 
-
-def set_shop_sign(shop_id, sign_id, cursor, cnx):
+def set_shop_sign(shop_id, sign_id, sign_hash, cursor, cnx):
     """
-    Update the sign id of a shop
+    Update the sign id of a shop after its sign was reposted
     :param shop_id: the id of the shop we want to change the status of
     :param sign_id: the sign id we want to set for the shop
+    :param sign_hash: render hash of the text of the new sign
     :param cursor: cursor object for executing update
     :param cnx: connection object for committing changes
     :return: void
     """
+    cursor.execute('delete from render_hash '
+                   'where message_id = (select sign_id from shop where shop_id = %s)', (shop_id,))  # old sign
     cursor.execute('update shop '
                    'set sign_id = %s '
                    'where shop_id = %s', (sign_id, shop_id))
+    cursor.execute('insert into render_hash (message_id, hash) values (%s, %s) '
+                   'on duplicate key update hash = values(hash)', (sign_id, sign_hash))
     cnx.commit() # commit changes to shop table
+    on_commit(cnx, lambda: shop_routes.update(shop_id, 5, int(sign_id)))
 
 
 def create_user_control_panel(user_id, control_channel_id, cursor, cnx):
@@ -166,16 +468,15 @@ def create_user_control_panel(user_id, control_channel_id, cursor, cnx):
     :param cnx: connection object for committing changes
     :return: raise ExistingControlPanel if a control panel already exists, void if successful
     """
-    try:
-        get_user_control_panel(user_id, cursor)
-    except ControlPanelNotFoundError:
-        cursor.execute('insert into shop_control '
-                       'values (%s, %s)',
-                       (control_channel_id, user_id))
-        cnx.commit()    # commit changes to database
-        return
+    cursor.execute('insert ignore into shop_control (shop_category_id, owner) '
+                   'values (%s, %s)',
+                   (control_channel_id, user_id))    # owner is unique, so nothing is inserted if one exists
+
+    if cursor.rowcount == 0:
+        raise ExistingControlPanelError
 
-    raise ExistingControlPanelError
+    cnx.commit()    # commit changes to database
+    on_commit(cnx, lambda: control_panels.put_panel(user_id, control_channel_id))
 
 
 def create_user_shop(user_id, shop_channel_id, name, desc, status, shop_sign_id, cursor, cnx):
@@ -189,18 +490,22 @@ def create_user_shop(user_id, shop_channel_id, name, desc, status, shop_sign_id,
     :param shop_sign_id: id of the shop's sign
     :param cursor: cursor object for executing insert query
     :param cnx: connection object for committing changes
-    :return:raise ExistingControlPanel if a control panel already exists, void if successful
+    :return: raise ExistingShopError if a shop already exists, void if successful
     """
-    try:
-        get_user_shop(user_id, cursor)
-    except ShopNotFoundError:
-        cursor.execute('insert into shop '
-                       'values (%s, %s, %s, %s, %s, %s)',
-                       (shop_channel_id, user_id, name, desc, status, shop_sign_id))
-        cnx.commit()  # commit changes to database
-        return
+    cursor.execute('insert ignore into shop (shop_id, owner, name, `desc`, status, sign_id) '
+                   'values (%s, %s, %s, %s, %s, %s)',
+                   (shop_channel_id, user_id, name, desc, status, shop_sign_id))  # owner is unique
 
-    raise ExistingShopError
+    if cursor.rowcount == 0:
+        raise ExistingShopError
+
+    cnx.commit()  # commit changes to database
+
+    def update_caches():
+        shop_routes.put((int(shop_channel_id), int(user_id), name, desc, int(status), int(shop_sign_id)))
+        control_panels.put_shop(user_id, shop_channel_id)
+
+    on_commit(cnx, update_caches)
 
 
 def delete_user_control_panel(user_id, cursor, cnx):
@@ -209,44 +514,107 @@ def delete_user_control_panel(user_id, cursor, cnx):
     :param user_id: user id to delete control panel for
     :param cursor: cursor object for executing deletion query
     :param cnx: connection object for committing changes
-    :return:
+    :return: raise ControlPanelNotFoundError if the user has no control panel, void if successful
     """
-    try:
-        shop_category_id = get_user_control_panel(user_id, cursor)
-        cursor.execute('delete from shop_control where shop_category_id = %s', (shop_category_id,))  # execute deletion query
-        cnx.commit()  # commit changes to database
-    except ControlPanelNotFoundError:
+    cursor.execute('delete from shop_control where owner = %s', (user_id,))  # execute deletion query
+
+    if cursor.rowcount == 0:
         raise ControlPanelNotFoundError
 
+    cnx.commit()  # commit changes to database
+    on_commit(cnx, lambda: control_panels.discard_panel(user_id))
+
 
 def delete_user_shop(user_id, cursor, cnx):
     """
-    Deletes a control panel for a user
-    :param user_id: user id to delete control panel for
+    Deletes a shop and all of its items for a user, in one commit
+    :param user_id: user id to delete the shop for
     :param cursor: cursor object for executing deletion query
     :param cnx: connection object for committing changes
-    :return:
+    :return: raise ShopNotFoundError if the user has no shop, void if successful
     """
-    try:
-        shop_id = get_user_shop(user_id, cursor)
-        cursor.execute('delete from shop where shop_id = %s', (shop_id,))  # execute deletion query
-        cnx.commit()  # commit changes to database
+    shop_id = get_user_shop(user_id, cursor)
 
-        delete_all_shop_items(shop_id, cursor, cnx)     # Delete all items that belonged to shop
-    except ShopNotFoundError:
-        raise ShopNotFoundError
+    cursor.execute('delete from render_hash '
+                   'where message_id in (select item_id from item where shop_id = %s) '
+                   'or message_id in (select sign_id from shop where shop_id = %s)', (shop_id, shop_id))
+    cursor.execute('delete from item where shop_id = %s', (shop_id,))     # delete all items that belonged to shop
+    cursor.execute('delete from shop_schedule where shop_id = %s', (shop_id,))    # and its opening hours
+    cursor.execute('delete from shop where shop_id = %s', (shop_id,))  # execute deletion query
+    cnx.commit()  # commit the deletions at once
+
+    def update_caches():
+        shop_routes.discard(shop_id)
+        control_panels.discard_shop(user_id)
+        item_rows.discard_shop(shop_id)
+
+    on_commit(cnx, update_caches)
 
 
 def get_shop_item(item_id, shop_id, cursor):
+    """
+    Gets the row of an item, from the item cache when possible
+    :param item_id: id of the item
+    :param shop_id: id of the shop the item belongs to
+    :param cursor: cursor object for executing search query
+    :return: Raise ItemNotFoundError if the shop has no such item, the item row if it does
+    """
+    result = item_rows.get(item_id, shop_id)
+    if result is not None:
+        return result
+
+    if item_rows.loaded:  # every item is in the cache
+        raise ItemNotFoundError
+
     cursor.execute('select * from item where item_id = %s and shop_id = %s', (item_id, shop_id))
     result = cursor.fetchall()
 
     if len(result) == 0:  # item not in shop
         raise ItemNotFoundError
 
+    item_rows.put(result[0])
     return result[0]
 
 
+def get_shop_items(shop_id, cursor):
+    """
+    Gets every item of a shop, from the item cache when it has loaded
+    :param shop_id: the id of the shop
+    :param cursor: cursor object for executing search query
+    :return: list of item rows ordered by item id
+    """
+    if item_rows.loaded:  # every item is in the cache
+        return item_rows.get_shop(shop_id)
+
+    cursor.execute('select * from item where shop_id = %s order by item_id', (shop_id,))
+    return cursor.fetchall()
+
+
+def get_shop_items_page(shop_id, after_item_id, limit, cursor):
+    """
+    Gets a page of a shop's items by keyset, the items ordered by id that come after a given item
+    :param shop_id: the id of the shop
+    :param after_item_id: id of the last item of the previous page, 0 for the first page
+    :param limit: most items to return
+    :param cursor: cursor object for executing search query
+    :return: list of item rows ordered by item id
+    """
+    cursor.execute('select * from item '
+                   'where shop_id = %s and item_id > %s '
+                   'order by item_id limit %s', (shop_id, after_item_id, limit))
+    return cursor.fetchall()
+
+
+def get_item_shop_ids(cursor):
+    """
+    Gets the id of every shop that has items, including shops that no longer exist
+    :param cursor: cursor object for executing search query
+    :return: list of shop ids
+    """
+    cursor.execute('select distinct shop_id from item')
+    return [int(row[0]) for row in cursor.fetchall()]
+
+
 def add_shop_item(item_id, shop_id, item_name, item_desc, item_price, item_qty, item_type, item_image, cursor, cnx):
     """
     Adds an item to a shop
@@ -262,10 +630,38 @@ def add_shop_item(item_id, shop_id, item_name, item_desc, item_price, item_qty,
     :param cnx: connection object for committing changes
     :return: void
     """
-    cursor.execute('insert into item '
-                   'values (%s, %s, %s, %s, %s, %s, %s, %s, %s)',
+    cursor.execute('insert into item (item_id, shop_id, name, `desc`, price, qty, type, image) '
+                   'values (%s, %s, %s, %s, %s, %s, %s, %s)',
                    (item_id, shop_id, item_name, item_desc, item_price, item_qty, item_type, item_image))
     cnx.commit()  # commit changes to database
+    on_commit(cnx, lambda: item_rows.put((int(item_id), int(shop_id), item_name, item_desc, item_price, item_qty,
+                                          item_type, item_image)))
+
+
+def add_shop_items(shop_id, items, cursor, cnx):
+    """
+    Adds many items to a shop with one batched insert in a single transaction
+    :param shop_id: id of the shop to add the items to
+    :param items: list of (item_id, item_name, item_desc, item_price, item_qty, item_type, item_image) tuples
+    :param cursor: cursor object for executing adding query
+    :param cnx: connection object for committing changes
+    :return: void
+    """
+    rows = [(int(item[0]), int(shop_id)) + tuple(item[1:]) for item in items]
+
+    try:
+        cursor.executemany('insert into item (item_id, shop_id, name, `desc`, price, qty, type, image) '
+                           'values (%s, %s, %s, %s, %s, %s, %s, %s)', rows)
+        cnx.commit()  # commit every item at once
+    except Exception:
+        cnx.rollback()
+        raise
+
+    def update_caches():
+        for row in rows:
+            item_rows.put(row)
+
+    on_commit(cnx, update_caches)
 
 
 def delete_all_shop_items(shop_id, cursor, cnx):
@@ -274,10 +670,15 @@ def delete_all_shop_items(shop_id, cursor, cnx):
     :param shop_id: id of the shop to delete items from
     :param cursor: cursor object for executing adding query
     :param cnx: connection object for committing changes
-    :return: void
+    :return: number of items deleted
     """
+    cursor.execute('delete from render_hash '
+                   'where message_id in (select item_id from item where shop_id = %s)', (shop_id,))
     cursor.execute('delete from item where shop_id = %s', (shop_id,))  # execute deletion query
+    deleted = cursor.rowcount
     cnx.commit()  # commit changes to database
+    on_commit(cnx, lambda: item_rows.discard_shop(shop_id))
+    return deleted
 
 
 def delete_shop_item(item_id, shop_id, cursor, cnx):
@@ -289,8 +690,12 @@ def delete_shop_item(item_id, shop_id, cursor, cnx):
     :param cnx: connection object for committing changes
     :return: void
     """
+    cursor.execute('delete from render_hash '
+                   'where message_id in (select item_id from item where item_id = %s and shop_id = %s)',
+                   (item_id, shop_id))
     cursor.execute('delete from item where item_id = %s and shop_id = %s', (item_id, shop_id))
     cnx.commit()
+    on_commit(cnx, lambda: item_rows.discard(item_id, shop_id))
 
 
 def set_shop_item_name(item_id, shop_id, item_name, cursor, cnx):
@@ -298,13 +703,15 @@ def set_shop_item_name(item_id, shop_id, item_name, cursor, cnx):
                    'set name = %s '
                    'where item_id = %s and shop_id = %s', (item_name, item_id, shop_id))
     cnx.commit()  # commit changes to shop table
+    on_commit(cnx, lambda: item_rows.update(item_id, shop_id, {ITEM_FIELDS['name']: item_name}))
 
 
 def set_shop_item_desc(item_id, shop_id, item_desc, cursor, cnx):
     cursor.execute('update item '
-                   'set desc = %s '
+                   'set `desc` = %s '
                    'where item_id = %s and shop_id = %s', (item_desc, item_id, shop_id))
     cnx.commit()  # commit changes to shop table
+    on_commit(cnx, lambda: item_rows.update(item_id, shop_id, {ITEM_FIELDS['desc']: item_desc}))
 
 
 def set_shop_item_price(item_id, shop_id, item_price, cursor, cnx):
@@ -312,6 +719,7 @@ def set_shop_item_price(item_id, shop_id, item_price, cursor, cnx):
                    'set price = %s '
                    'where item_id = %s and shop_id = %s', (item_price, item_id, shop_id))
     cnx.commit()  # commit changes to shop table
+    on_commit(cnx, lambda: item_rows.update(item_id, shop_id, {ITEM_FIELDS['price']: item_price}))
 
 
 def set_shop_item_qty(item_id, shop_id, item_qty, cursor, cnx):
@@ -319,6 +727,7 @@ def set_shop_item_qty(item_id, shop_id, item_qty, cursor, cnx):
                    'set qty = %s '
                    'where item_id = %s and shop_id = %s', (item_qty, item_id, shop_id))
     cnx.commit()  # commit changes to shop table
+    on_commit(cnx, lambda: item_rows.update(item_id, shop_id, {ITEM_FIELDS['qty']: item_qty}))
 
 
 def set_shop_item_type(item_id, shop_id, item_type, cursor, cnx):
@@ -326,6 +735,7 @@ def set_shop_item_type(item_id, shop_id, item_type, cursor, cnx):
                    'set type = %s '
                    'where item_id = %s and shop_id = %s', (item_type, item_id, shop_id))
     cnx.commit()  # commit changes to shop table
+    on_commit(cnx, lambda: item_rows.update(item_id, shop_id, {ITEM_FIELDS['type']: item_type}))
 
 
 def set_shop_item_image(item_id, shop_id, item_image, cursor, cnx):
@@ -333,6 +743,94 @@ def set_shop_item_image(item_id, shop_id, item_image, cursor, cnx):
                    'set image = %s '
                    'where item_id = %s and shop_id = %s', (item_image, item_id, shop_id))
     cnx.commit()  # commit changes to shop table
+    on_commit(cnx, lambda: item_rows.update(item_id, shop_id, {ITEM_FIELDS['image']: item_image}))
+
+
+def set_shop_item_id(item_id, shop_id, new_item_id, item_hash, cursor, cnx):
+    """
+    Moves an item to a new message id, used when its message had to be reposted
+    :param item_id: current id of the item
+    :param shop_id: id of the shop the item belongs to
+    :param new_item_id: id of the new item message
+    :param item_hash: render hash of the embed of the new item message
+    :param cursor: cursor object for executing update
+    :param cnx: connection object for committing changes
+    :return: void
+    """
+    cursor.execute('update item '
+                   'set item_id = %s '
+                   'where item_id = %s and shop_id = %s', (new_item_id, item_id, shop_id))
+    if cursor.rowcount > 0:
+        cursor.execute('delete from render_hash where message_id = %s', (item_id,))     # old message is gone
+        cursor.execute('insert into render_hash (message_id, hash) values (%s, %s) '
+                       'on duplicate key update hash = values(hash)', (new_item_id, item_hash))
+    cnx.commit()  # commit changes to item table
+    on_commit(cnx, lambda: item_rows.rekey(item_id, shop_id, new_item_id))
+
+
+def set_shop_item_fields(item_id, shop_id, fields, cursor, cnx):
+    """
+    Updates several fields of an item with a single query
+    :param item_id: id of the item to update
+    :param shop_id: id of the shop the item belongs to
+    :param fields: dict of field name (name, desc, price, qty, type, image) -> new value
+    :param cursor: cursor object for executing update
+    :param cnx: connection object for committing changes
+    :return: void
+    """
+    columns = [field for field in fields if field in ITEM_FIELDS]  # only ever interpolate known column names
+    cursor.execute('update item '
+                   'set ' + ', '.join('`' + column + '` = %s' for column in columns) + ' '
+                   'where item_id = %s and shop_id = %s', tuple(fields[column] for column in columns) + (item_id, shop_id))
+    cnx.commit()  # commit changes to item table
+    on_commit(cnx, lambda: item_rows.update(item_id, shop_id, {ITEM_FIELDS[column]: fields[column]
+                                                               for column in columns}))
+
+
+def get_render_hashes(message_ids, cursor):
+    """
+    Gets the stored render hashes of messages
+    :param message_ids: ids of the item and sign messages
+    :param cursor: cursor object for executing search query
+    :return: dict of message id -> hash, messages never rendered are left out
+    """
+    if len(message_ids) == 0:
+        return {}
+
+    cursor.execute('select message_id, hash from render_hash '
+                   'where message_id in (' + ', '.join(['%s'] * len(message_ids)) + ')', tuple(message_ids))
+    return {int(message_id): digest for message_id, digest in cursor.fetchall()}
+
+
+def set_render_hashes(hashes, cursor, cnx):
+    """
+    Store the render hashes of messages that were posted or edited
+    :param hashes: list of (message id, hash)
+    :param cursor: cursor object for executing update
+    :param cnx: connection object for committing changes
+    :return: void
+    """
+    if len(hashes) == 0:
+        return
+
+    cursor.executemany('insert into render_hash (message_id, hash) values (%s, %s) '
+                       'on duplicate key update hash = values(hash)', hashes)
+    cnx.commit()  # commit every hash at once
+
+
+def on_commit(cnx, callback):
+    """
+    Runs a cache update once a helper's changes are committed.  Inside a unit of work the commit is deferred to the
+    end of the unit, so the update waits for it too and is dropped if the unit is rolled back.
+    :param cnx: connection object the helper committed on
+    :param callback: function updating the in-memory caches
+    :return: void
+    """
+    deferred = getattr(cnx, 'deferred', None)
+    if deferred is None:
+        callback()
+    else:
+        deferred.append(callback)
 
 
 def get_id_from_name(display_name, cursor):
@@ -358,7 +856,7 @@ def get_name_from_id(user_id, cursor):
     :param cursor: cursor object for executing search query
     :return: Raise InvalidUserIDError, display_name if user is found
     """
-    cursor.execute('select name from user where user_id = %s', (user_id,))
+    cursor.execute('select display_name from user where user_id = %s', (user_id,))
     result = cursor.fetchall()
 
     if len(result) == 0:  # user not found
@@ -0,0 +1,89 @@
+import collections
+
+import discord
+
+from backend.lib.helper_commands import get_shop_items_page
+
+PAGE_SIZE = 10          # items per inventory page
+CACHED_PAGES = 5        # page embeds kept per inventory
+PREVIOUS = '◀'     # reactions used to turn pages
+NEXT = '▶'
+
+
+class InventoryView:
+    """
+    A seller's paged listing of their shop's items.  Pages are read by keyset, each page starts after the last item
+    id of the one before it, so turning to any page costs one indexed query instead of an OFFSET scan.  Page embeds
+    are built when first shown and the most recent few are kept.
+    """
+    def __init__(self, db, owner_id, shop_id, shop_name):
+        self.db = db
+        self.owner_id = owner_id
+        self.shop_id = shop_id
+        self.shop_name = shop_name
+        self.page = 0               # page currently shown
+        self.starts = [0]           # page -> id of the item the page starts after, for the pages reached so far
+        self.last_page = None       # known once the last page has been read
+        self.pages = collections.OrderedDict()     # page -> embed, least recently shown first
+
+    async def get_page(self, page):
+        """
+        Gets the embed of a page, reading its items if it isn't cached
+        :param page: page number, 0 is the first page
+        :return: the embed
+        """
+        embed = self.pages.get(page)
+        if embed is not None:
+            self.pages.move_to_end(page)
+            return embed
+
+        rows = await self.db.run(get_shop_items_page, self.shop_id, self.starts[page], PAGE_SIZE + 1)
+        if len(rows) > PAGE_SIZE:   # the extra row only tells us there is a next page
+            rows = rows[:PAGE_SIZE]
+            if len(self.starts) == page + 1:
+                self.starts.append(int(rows[-1][0]))
+        else:
+            self.last_page = page
+
+        embed = create_inventory_embed(self.shop_name, rows, page, self.last_page == page)
+        self.pages[page] = embed
+        if len(self.pages) > CACHED_PAGES:
+            self.pages.popitem(last=False)
+        return embed
+
+    async def turn(self, emoji):
+        """
+        Turn to the previous or next page
+        :param emoji: PREVIOUS or NEXT
+        :return: embed of the new page, or None if there is no page that way
+        """
+        if emoji == PREVIOUS and self.page > 0:
+            self.page -= 1
+        elif emoji == NEXT and self.page + 1 < len(self.starts):
+            self.page += 1
+        else:
+            return None
+
+        return await self.get_page(self.page)
+
+
+def create_inventory_embed(shop_name, rows, page, last):
+    """
+    Creates the embed of an inventory page
+    :param shop_name: name of the shop
+    :param rows: item rows of the page
+    :param page: page number, 0 is the first page
+    :param last: True if this is the last page
+    :return: embed for Discord
+    """
+    embed = discord.Embed(title="Inventory of " + shop_name, color=0x68ff7a)
+
+    for row in rows:
+        embed.add_field(name=row[2], value="ID: {0}\nPrice: ${1:,.2f} | Qty Avl: {2} | Type: {3}".format(
+            row[0], row[4], "INF" if int(row[5]) < 0 else row[5], row[6]), inline=False)
+
+    if len(rows) == 0:
+        embed.description = "Your shop has no items yet."
+
+    embed.set_footer(text="Page " + str(page + 1) + ("" if last else " - react with " + NEXT + " for more"))
+    return embed
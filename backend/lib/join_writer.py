@@ -0,0 +1,108 @@
+import traceback
+
+from backend.lib.user_queries import sql_add_users, sql_delete_users
+
+
+class JoinWriter:
+    """
+    Buffers the users of members joining the server and writes them with one multi-row upsert every batch_size
+    members or flush_interval seconds, whichever comes first.  A raid or invite campaign then costs a few queries
+    instead of a query and commit per member, and members who rejoin are refreshed instead of raising an error.
+    """
+    def __init__(self, bot, db, batch_size=100, flush_interval=0.5):
+        self.bot = bot
+        self.db = db
+        self.batch_size = batch_size            # members per upsert
+        self.flush_interval = flush_interval    # seconds a member waits in the buffer at most
+        self.buffer = {}    # user id -> (user id, display name, join date)
+        self.timer = None   # scheduled flush of a partial batch
+        self.pending = set()    # flush tasks still writing
+        self.writing = set()    # ids of the users being written
+        self.departed = set()   # ids of members who left while their user was being written
+
+    def add(self, user_id, display_name, joindate):
+        """
+        Buffer a joining member's user
+        :param user_id: id of the member
+        :param display_name: name#discriminator of the member
+        :param joindate: when the member joined
+        :return: void
+        """
+        self.buffer[user_id] = (user_id, display_name, joindate)    # a member joining twice is written once
+        self.departed.discard(user_id)  # rejoined while their first join was being written
+
+        if len(self.buffer) >= self.batch_size:
+            self.flush_later()
+        elif self.timer is None:
+            self.timer = self.bot.loop.call_later(self.flush_interval, self.flush_later)
+
+    def flush_later(self):
+        """
+        Write every buffered user in the background
+        :return: void
+        """
+        task = self.bot.loop.create_task(self.write(self.take()))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    def discard(self, user_id):
+        """
+        Drop a member who left before their user was written.  If their user is being written right now it is
+        deleted once the write has finished, so it can't land after the member's delete.
+        :param user_id: id of the member
+        :return: True if the member was still buffered or is being written, False if their user has to be deleted
+        """
+        if user_id in self.writing:
+            self.departed.add(user_id)
+            return True
+
+        return self.buffer.pop(user_id, None) is not None
+
+    async def flush(self):
+        """
+        Write every buffered user
+        :return: number of users written
+        """
+        return await self.write(self.take())
+
+    def take(self):
+        """
+        Empty the buffer
+        :return: list of buffered users
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        users = list(self.buffer.values())
+        self.buffer = {}
+        return users
+
+    async def write(self, users):
+        """
+        Write users with one upsert
+        :param users: list of (user id, display name, join date)
+        :return: number of users written
+        """
+        if len(users) == 0:
+            return 0
+
+        user_ids = {user[0] for user in users}
+        self.writing |= user_ids
+        try:
+            await self.db.run(sql_add_users, users)
+            written = len(users)
+        except Exception:
+            traceback.print_exc()   # the members are added again when they next join
+            written = 0
+
+        self.writing -= user_ids
+        departed = self.departed & user_ids     # left while being written
+        self.departed -= departed
+        if len(departed) > 0:
+            try:
+                await self.db.run(sql_delete_users, list(departed))
+            except Exception:
+                traceback.print_exc()   # member sync removes them later
+
+        return written
@@ -0,0 +1,73 @@
+import asyncio
+import datetime
+import traceback
+
+from backend.lib.user_queries import sql_add_users, sql_delete_users, get_user_joindates
+
+SYNC_BATCH = 1000       # users inserted or deleted per query
+MIN_FETCHED = 0.9       # share of the guilds' member count that must be fetched before users are deleted
+
+
+class MemberSync:
+    """
+    Brings the user table in line with the guild's members.  Members are streamed from Discord in pages and the
+    users from the database in chunks, the two sets of ids are compared, and the difference is applied with batched
+    upserts and deletes.  Catches up on members who joined or left while the bot was offline.  Admins are never
+    deleted, and nothing is deleted if the member list came back incomplete.
+    """
+    def __init__(self, bot, db):
+        self.bot = bot
+        self.db = db
+        self.lock = asyncio.Lock()  # one sync at a time
+
+    def start(self):
+        """
+        Sync once in the background as soon as the bot is ready
+        :return: the background task
+        """
+        return self.bot.loop.create_task(self.run())
+
+    async def run(self):
+        await self.bot.wait_until_ready()
+        try:
+            await self.sync()
+        except Exception:
+            traceback.print_exc()   # an admin can retry with sync_members
+
+    async def sync(self):
+        """
+        Add members missing from the user table and delete users who are no longer members
+        :return: dict of changes made
+        """
+        async with self.lock:
+            started = datetime.datetime.utcnow()    # joined_at is in UTC
+
+            members = {}    # member id -> (user id, display name, join date)
+            expected = 0    # members Discord says the guilds have
+            for guild in self.bot.guilds:
+                expected += guild.member_count or 0
+                async for member in guild.fetch_members(limit=None):    # 1000 members per request
+                    members[member.id] = (member.id, member.name + "#" + member.discriminator, member.joined_at)
+
+            users = await self.db.run(get_user_joindates)
+
+            missing = [members[user_id] for user_id in members.keys() - users.keys()]
+            departed = [user_id for user_id in users.keys() - members.keys()
+                        if not users[user_id][1] and       # never delete an admin
+                        (users[user_id][0] is None or users[user_id][0] < started)]  # not someone joining right now
+
+            if len(members) == 0 or len(members) < expected * MIN_FETCHED:
+                # eg. the members intent is missing, never empty the user table from a partial list
+                print('Member sync fetched {0} of {1} members, not deleting users'.format(len(members), expected))
+                departed = []
+
+            for start in range(0, len(missing), SYNC_BATCH):
+                await self.db.run(sql_add_users, missing[start:start + SYNC_BATCH])
+
+            deleted = 0
+            for start in range(0, len(departed), SYNC_BATCH):
+                deleted += await self.db.run(sql_delete_users, departed[start:start + SYNC_BATCH])
+
+            report = {'members': len(members), 'users': len(users), 'added': len(missing), 'deleted': deleted}
+            print('Member sync: ' + ', '.join('{0} {1}'.format(count, name) for name, count in report.items()))
+            return report
@@ -0,0 +1,254 @@
+import asyncio
+import bisect
+import logging
+import threading
+import time
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)   # histogram bucket bounds in seconds
+PREFIX = 'discord_shop_'
+
+DESCRIPTIONS = {
+    'command_seconds': 'Time to run a bot command',
+    'query_seconds': 'Time to run a SQL helper function',
+    'connection_wait_seconds': 'Time waiting for a pooled database connection',
+    'sign_repost_seconds': 'Time to bring a shop sign up to date',
+    'warm_up_seconds': 'Time to bulk-load the caches',
+    'errors_total': 'Exceptions raised by commands and SQL helper functions',
+    'rate_limits_total': 'Discord 429 responses',
+    'shop_messages_total': 'Messages posted in each shop channel',
+    'outbound_queue_depth': 'Outbound Discord operations queued or in flight',
+}
+
+
+class Histogram:
+    """Prometheus style histogram: cumulative counts per bucket, plus the count and sum of all observations"""
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)    # last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """
+    Registry of the bot's counters, latency histograms and gauges.  Observations come from the event loop and
+    from the database threads, so every update takes the lock.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.histograms = {}    # (name, labels) -> Histogram
+        self.counters = {}      # (name, labels) -> value
+        self.gauges = {}        # name -> function returning the current value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Record a latency
+        :param name: name of the histogram, eg. query_seconds
+        :param seconds: the latency
+        :param labels: labels of the series, eg. function='get_shop'
+        :return: void
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, amount=1, **labels):
+        """
+        Increase a counter
+        :param name: name of the counter, eg. errors_total
+        :param amount: amount to add
+        :param labels: labels of the series, eg. error='ShopNotFoundError'
+        :return: void
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, function):
+        """
+        Register a gauge that is read whenever metrics are exported
+        :param name: name of the gauge
+        :param function: function returning the current value
+        :return: void
+        """
+        self.gauges[name] = function
+
+    def totals(self, name):
+        """
+        Gets the count and sum of every series of a histogram
+        :param name: name of the histogram
+        :return: list of (labels dict, count, sum)
+        """
+        with self.lock:
+            return [(dict(labels), histogram.count, histogram.sum)
+                    for (series, labels), histogram in self.histograms.items() if series == name]
+
+    def values(self, name):
+        """
+        Gets the value of every series of a counter
+        :param name: name of the counter
+        :return: list of (labels dict, value)
+        """
+        with self.lock:
+            return [(dict(labels), value) for (series, labels), value in self.counters.items() if series == name]
+
+    def render(self):
+        """
+        Export every metric in the Prometheus text format
+        :return: text of the export
+        """
+        lines = []
+
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+
+        seen = set()
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines += describe(name, 'histogram')
+
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.buckets):
+                cumulative += count
+                lines.append('{0}{1}_bucket{2} {3}'.format(PREFIX, name, format_labels(labels + (('le', bound),)),
+                                                           cumulative))
+            lines.append('{0}{1}_count{2} {3}'.format(PREFIX, name, format_labels(labels), histogram.count))
+            lines.append('{0}{1}_sum{2} {3}'.format(PREFIX, name, format_labels(labels), histogram.sum))
+
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines += describe(name, 'counter')
+            lines.append('{0}{1}{2} {3}'.format(PREFIX, name, format_labels(labels), value))
+
+        for name, function in sorted(self.gauges.items()):
+            lines += describe(name, 'gauge')
+            lines.append('{0}{1} {2}'.format(PREFIX, name, function()))
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, limit=5):
+        """
+        Summarize the metrics for the stats command
+        :param limit: rows to show per section
+        :return: text of the summary
+        """
+        lines = ['Uptime: {0:.1f} hours'.format((time.time() - self.started) / 3600)]
+
+        commands = sorted(self.totals('command_seconds'), key=lambda series: -series[1])[:limit]
+        lines.append('\nBusiest commands (runs, mean ms):')
+        lines += ['  {0}: {1}, {2:.1f}'.format(labels['command'], count, total / count * 1000)
+                  for labels, count, total in commands]
+
+        queries = sorted(self.totals('query_seconds'), key=lambda series: -series[2])[:limit]
+        lines.append('\nSlowest SQL helpers by total time (calls, mean ms):')
+        lines += ['  {0}: {1}, {2:.1f}'.format(labels['function'], count, total / count * 1000)
+                  for labels, count, total in queries]
+
+        wait = self.totals('connection_wait_seconds')
+        if len(wait) > 0 and wait[0][1] > 0:
+            lines.append('\nMean connection wait: {0:.1f} ms'.format(wait[0][2] / wait[0][1] * 1000))
+
+        errors = {}
+        for labels, value in self.values('errors_total'):
+            errors[labels['error']] = errors.get(labels['error'], 0) + value
+        lines.append('\nErrors:')
+        lines += ['  {0}: {1}'.format(error, count) for error, count in sorted(errors.items(), key=lambda e: -e[1])]
+
+        shops = sorted(self.values('shop_messages_total'), key=lambda series: -series[1])[:limit]
+        lines.append('\nHottest shops (messages):')
+        lines += ['  <#{0}>: {1}'.format(labels['shop'], value) for labels, value in shops]
+
+        lines.append('\nDiscord 429s: {0}'.format(sum(value for _, value in self.values('rate_limits_total'))))
+        if 'outbound_queue_depth' in self.gauges:
+            lines.append('Outbound queue depth: {0}'.format(self.gauges['outbound_queue_depth']()))
+
+        return '\n'.join(lines)
+
+
+RATE_LIMITED = 'We are being rate limited.'     # start of the warning discord.py logs once for every 429
+
+
+class RateLimitHandler(logging.Handler):
+    """
+    Counts the warnings discord.py logs whenever Discord answers with a 429.  Its debug lines about waiting out a
+    bucket and the extra warning for a global 429 mention rate limits too but are not 429s of their own.
+    """
+    def emit(self, record):
+        if record.levelno == logging.WARNING and str(record.msg).startswith(RATE_LIMITED):
+            metrics.increment('rate_limits_total')
+
+
+def describe(name, kind):
+    """
+    Gets the HELP and TYPE lines of a metric
+    :param name: name of the metric
+    :param kind: histogram, counter or gauge
+    :return: list of lines
+    """
+    return ['# HELP {0}{1} {2}'.format(PREFIX, name, DESCRIPTIONS.get(name, name)),
+            '# TYPE {0}{1} {2}'.format(PREFIX, name, kind)]
+
+
+def format_labels(labels):
+    """
+    Formats the labels of a series
+    :param labels: tuple of (label, value) pairs
+    :return: eg. {function="get_shop"}, or an empty string without labels
+    """
+    if len(labels) == 0:
+        return ''
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join('{0}="{1}"'.format(label, value) for (label, _), value in zip(labels, escaped)) + '}'
+
+
+async def serve(host, port):
+    """
+    Serve the metrics at http://host:port/metrics for Prometheus to scrape
+    :param host: address to listen on, keep this local
+    :param port: port to listen on
+    :return: the asyncio server
+    """
+    return await asyncio.start_server(handle_scrape, host, port)
+
+
+async def handle_scrape(reader, writer):
+    """
+    Answer a single HTTP request with the metrics export
+    :param reader: stream of the request
+    :param writer: stream of the response
+    :return: void
+    """
+    try:
+        request = (await reader.readline()).decode('latin-1').split()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass    # skip the headers
+
+        if len(request) >= 2 and request[0] == 'GET' and request[1].split('?')[0] in ('/', '/metrics'):
+            status, body = '200 OK', metrics.render().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+
+        writer.write('HTTP/1.1 {0}\r\n'
+                     'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     'Content-Length: {1}\r\n'
+                     'Connection: close\r\n\r\n'.format(status, len(body)).encode('latin-1') + body)
+        await writer.drain()
+    except ConnectionError:
+        pass    # scraper went away
+    finally:
+        writer.close()
+
+
+metrics = Metrics()
@@ -0,0 +1,218 @@
+import ast
+import os
+import re
+import sys
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+HELPER_MODULES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), module)
+                  for module in ('helper_commands.py', 'user_queries.py', 'reminders.py')]
+SAMPLE_ARGUMENTS = {    # stand-ins for the arguments statements are built from, to explain a representative instance
+    'columns': ['price', 'qty'],
+    'message_ids': [0, 0],
+    'user_ids': [0, 0],
+    'event_ids': [0, 0],
+    'uncached': [0, 0],
+    'users': [(0, '', None), (0, '', None)],
+    'len': len,
+}
+
+
+def get_migrations():
+    """
+    Gets the migration files in version order
+    :return: list of (version, name, path) for every NNNN_name.sql file in the migrations directory
+    """
+    migrations = []
+
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = re.match(r'^(\d+)_(\w+)\.sql$', filename)
+        if match is not None:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+
+    return migrations
+
+
+def split_statements(sql):
+    """
+    Splits a migration file into statements
+    :param sql: contents of the migration file
+    :return: list of statements without comments or trailing semicolons
+    """
+    lines = [line for line in sql.splitlines() if not line.strip().startswith('--')]
+    return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip() != '']
+
+
+def get_schema_version(cursor):
+    """
+    Gets the version of the newest migration applied to the database
+    :param cursor: cursor object for executing queries
+    :return: schema version, 0 if no migration has been applied
+    """
+    cursor.execute('create table if not exists schema_version ('
+                   'version int not null, '
+                   'name varchar(128) not null, '
+                   'applied_at timestamp not null default current_timestamp, '
+                   'primary key (version))')
+    cursor.execute('select max(version) from schema_version')
+    result = cursor.fetchall()
+
+    return 0 if result[0][0] is None else int(result[0][0])
+
+
+def index_exists(statement, cursor):
+    """
+    Checks if the index a create index statement makes already exists
+    :param statement: migration statement
+    :param cursor: cursor object for executing queries
+    :return: True if the statement creates an index that exists, False otherwise
+    """
+    match = re.match(r'^create\s+(?:unique\s+)?index\s+(\w+)\s+on\s+(\w+)', statement, re.IGNORECASE)
+    if match is None:
+        return False
+
+    if getattr(cursor, 'dialect', 'mysql') == 'sqlite':
+        cursor.execute("select count(*) from sqlite_master where type = 'index' and name = %s", (match.group(1),))
+    else:
+        cursor.execute('select count(*) from information_schema.statistics '
+                       'where table_schema = database() and table_name = %s and index_name = %s',
+                       (match.group(2), match.group(1)))
+    return int(cursor.fetchall()[0][0]) > 0
+
+
+def migrate(cursor, cnx):
+    """
+    Applies every migration newer than the database's schema version, in order.  MySQL commits DDL as it goes, so
+    a migration that failed part way is re-run from the start: indexes it already created are skipped, as MySQL
+    has no create index if not exists.
+    :param cursor: cursor object for executing migrations
+    :param cnx: connection object for committing changes
+    :return: list of (version, name) of the migrations applied
+    """
+    current = get_schema_version(cursor)
+    applied = []
+
+    for version, name, path in get_migrations():
+        if version <= current:
+            continue
+
+        with open(path) as migration:
+            for statement in split_statements(migration.read()):
+                if not index_exists(statement, cursor):
+                    cursor.execute(statement)
+
+        cursor.execute('insert into schema_version (version, name) values (%s, %s)', (version, name))
+        cnx.commit()  # commit each migration once it has fully applied
+        applied.append((version, name))
+
+    return applied
+
+
+def get_helper_statements():
+    """
+    Finds the SQL of every cursor.execute call in the helper modules.  Queries built at runtime are built with
+    SAMPLE_ARGUMENTS, eg. an in list of two ids.
+    :return: list of (function name, statement), statement is None for a query that couldn't be built
+    """
+    statements = []
+
+    for path in HELPER_MODULES:
+        with open(path) as module:
+            tree = ast.parse(module.read())
+
+        for function in ast.walk(tree):
+            if not isinstance(function, ast.FunctionDef):
+                continue
+
+            for node in ast.walk(function):
+                if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and \
+                        node.func.attr in ('execute', 'executemany') and len(node.args) > 0:
+                    statements.append((function.name, build_statement(node.args[0], path)))
+
+    return statements
+
+
+def build_statement(node, path):
+    """
+    Gets the query passed to cursor.execute, building it with SAMPLE_ARGUMENTS if it isn't a constant
+    :param node: syntax tree of the query argument
+    :param path: path of the module, for error messages
+    :return: the query, or None if it couldn't be built
+    """
+    if isinstance(node, ast.Constant):
+        return node.value if isinstance(node.value, str) else None
+
+    try:
+        statement = eval(compile(ast.Expression(node), path, 'eval'), dict(SAMPLE_ARGUMENTS, __builtins__={}))
+    except Exception:
+        return None     # built from something without a sample
+
+    return statement if isinstance(statement, str) else None
+
+
+def check_query_plans(cursor):
+    """
+    Runs EXPLAIN on every filtered select, update and delete in the helper modules and reports any that scan a
+    whole table.  Statements without a where clause are bulk loads that read everything on purpose and are skipped.
+    Queries that couldn't be built are reported as not checked.  On SQLite the cursor turns EXPLAIN into EXPLAIN
+    QUERY PLAN.
+    :param cursor: cursor object for executing queries
+    :return: list of (function name, statement, table) for every full table scan found, statement and table are
+    None for a query that wasn't checked
+    """
+    scans = []
+
+    for function, statement in get_helper_statements():
+        if statement is None:
+            scans.append((function, None, None))
+            continue
+
+        verb = statement.split(None, 1)[0].lower()
+        if verb not in ('select', 'update', 'delete') or ' where ' not in statement.lower():
+            continue
+
+        cursor.execute('explain ' + statement.replace('%s', '0'))
+        columns = [column[0] for column in cursor.description]
+        for row in cursor.fetchall():
+            plan = dict(zip(columns, row))
+            if getattr(cursor, 'dialect', 'mysql') == 'sqlite':
+                detail = plan.get('detail', '').split()
+                if len(detail) > 1 and detail[0] == 'SCAN':     # SQLite's plan step for a full scan
+                    scans.append((function, statement, detail[1]))
+            elif plan.get('type') == 'ALL':     # MySQL's access type for a full table scan
+                scans.append((function, statement, plan.get('table')))
+
+    return scans
+
+
+def main():
+    """
+    Apply pending migrations using configuration.conf, then with --check fail if any helper query scans a whole table
+        python -m backend.lib.migrations [--check]
+    :return: exit status
+    """
+    import configparser
+    from backend.lib.database import Database, open_pool
+
+    config = configparser.ConfigParser()
+    config.read(r'configuration.conf')
+
+    db = Database(open_pool(config['Database']))
+
+    for version, name in db.call(migrate):
+        print('Applied migration {0:04d} {1}'.format(version, name))
+
+    status = 0
+    if '--check' in sys.argv[1:]:
+        for function, statement, table in db.call(check_query_plans):
+            if statement is None:
+                print('Not checked, query built at runtime in {0}'.format(function))
+            else:
+                print('Full table scan of {0} in {1}: {2}'.format(table, function, statement))
+            status = 1
+
+    db.close()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,272 @@
+import asyncio
+import collections
+import heapq
+import itertools
+
+from backend.lib.tracing import span
+
+USER = 0            # replies and changes a user is waiting on
+BACKGROUND = 1      # maintenance such as sign reposts, served only when no user facing operation is waiting
+PRUNE_EVERY = 100   # operations submitted between sweeps of idle channel gates
+
+
+class OutboundQueue:
+    """
+    Central scheduler for outbound Discord operations (message sends, edits and deletes, and permission changes).
+    Operations are paced per channel and globally so bursts are spread out instead of running into 429s, user facing
+    operations go ahead of background ones, and an edit that is superseded before it runs is merged into the newer
+    edit of the same message.
+    """
+    def __init__(self, bot, channel_rate=5, channel_per=5.0, global_rate=45, global_per=1.0):
+        self.bot = bot
+        self.channel_rate = channel_rate    # operations allowed per channel ...
+        self.channel_per = channel_per      # ... every channel_per seconds
+        self.global_gate = RateGate(global_rate, global_per)
+        self.channel_gates = {}     # channel id -> RateGate
+        self.pending_edits = {}     # message id -> edit operation that hasn't started yet
+        self.waiting = 0            # operations queued but not yet started
+        self.running = 0            # operations currently talking to Discord
+        self.submitted = 0          # operations submitted, to schedule gate sweeps
+
+    def depth(self):
+        """
+        Gets the number of operations that are queued or in flight
+        :return: queue depth
+        """
+        return self.waiting + self.running
+
+    async def send(self, destination, content=None, priority=USER, **kwargs):
+        """
+        Send a message
+        :param destination: channel, context or user to send to
+        :param content: text of the message
+        :param priority: USER or BACKGROUND
+        :param kwargs: other arguments for discord.abc.Messageable.send (eg. embed)
+        :return: the sent message
+        """
+        return await self._submit(bucket_key(destination), priority, 'send_message',
+                                  lambda: destination.send(content, **kwargs))
+
+    async def edit(self, channel_id, message_id, priority=USER, **fields):
+        """
+        Edit a message by id, without fetching it first.  If an edit of the same message is still queued it is
+        replaced by this one, only the latest content matters.
+        :param channel_id: id of the channel the message is in
+        :param message_id: id of the message to edit
+        :param priority: USER or BACKGROUND
+        :param fields: new content and / or embed of the message
+        :return: Raise discord.NotFound if the message no longer exists, void otherwise
+        """
+        message_id = int(message_id)
+        operation = self.pending_edits.get(message_id)
+        if operation is not None:
+            operation.kwargs = fields   # merge into the queued edit
+            if priority < operation.priority:
+                operation.raise_priority(priority)  # a user is now waiting on it
+            return await asyncio.shield(operation.future)
+
+        operation = Operation(priority, fields)
+        self.pending_edits[message_id] = operation
+
+        async def run():
+            self.pending_edits.pop(message_id, None)     # later edits queue a new operation from here on
+            payload = dict(operation.kwargs)
+            if payload.get('embed') is not None:
+                payload['embed'] = payload['embed'].to_dict()
+            await self.bot.http.edit_message(channel_id, message_id, **payload)
+
+        return await self._submit(int(channel_id), priority, 'edit_message', run, operation)
+
+    async def delete(self, channel_id, message_id, priority=USER):
+        """
+        Delete a message by id without fetching it first, dropping any edit of it that is still queued
+        :param channel_id: id of the channel the message is in
+        :param message_id: id of the message to delete
+        :param priority: USER or BACKGROUND
+        :return: Raise discord.NotFound if the message no longer exists, void otherwise
+        """
+        operation = self.pending_edits.pop(int(message_id), None)
+        if operation is not None:
+            operation.superseded = True
+
+        return await self._submit(int(channel_id), priority, 'delete_message',
+                                  lambda: self.bot.http.delete_message(channel_id, message_id))
+
+    async def set_permissions(self, channel, target, priority=USER, **permissions):
+        """
+        Change the permission overwrites of a role or member in a channel
+        :param channel: the channel
+        :param target: role or member the overwrites apply to
+        :param priority: USER or BACKGROUND
+        :param permissions: permissions to allow (True) or deny (False), eg. read_messages=False
+        :return: void
+        """
+        return await self._submit(channel.id, priority, 'set_permissions',
+                                  lambda: channel.set_permissions(target, **permissions))
+
+    async def _submit(self, key, priority, name, factory, operation=None):
+        """
+        Wait for the channel and global rate limits, then run an operation
+        :param key: id of the channel bucket
+        :param priority: USER or BACKGROUND
+        :param name: name of the Discord request, for tracing
+        :param factory: function returning the coroutine that performs the operation
+        :param operation: Operation to resolve, for merged edits
+        :return: result of the operation
+        """
+        if operation is None:
+            operation = Operation(priority)
+
+        self.submitted += 1
+        if self.submitted % PRUNE_EVERY == 0:
+            self.prune()
+
+        gate = self.channel_gates.get(key)
+        if gate is None:
+            gate = self.channel_gates[key] = RateGate(self.channel_rate, self.channel_per)
+
+        self.waiting += 1
+        try:
+            with span('outbound wait ' + name):     # time spent held back by the rate limits
+                await gate.acquire(operation)
+                await self.global_gate.acquire(operation)
+        except BaseException as e:
+            operation.fail(e)
+            raise
+        finally:
+            self.waiting -= 1
+
+        if operation.superseded:
+            operation.succeed(None)
+            return None
+
+        self.running += 1
+        try:
+            with span('discord ' + name):
+                result = await factory()
+        except Exception as e:
+            operation.fail(e)
+            raise
+        finally:
+            self.running -= 1
+
+        operation.succeed(result)
+        return result
+
+    def prune(self):
+        """
+        Drop the rate gates of channels that have gone quiet, so state isn't kept for every channel ever used
+        :return: number of gates dropped
+        """
+        idle = [key for key, gate in self.channel_gates.items() if gate.idle()]
+        for key in idle:
+            del self.channel_gates[key]
+        return len(idle)
+
+
+class Operation:
+    """A queued outbound operation, shared by every caller merged into it"""
+    def __init__(self, priority, kwargs=None):
+        self.priority = priority
+        self.kwargs = kwargs
+        self.superseded = False
+        self.gate = None    # RateGate the operation is waiting at
+        self.future = asyncio.get_event_loop().create_future()
+
+    def raise_priority(self, priority):
+        self.priority = priority
+        if self.gate is not None:
+            self.gate.reorder()
+
+    def succeed(self, result):
+        if not self.future.done():
+            self.future.set_result(result)
+
+    def fail(self, error):
+        if not self.future.done():
+            self.future.set_exception(error)
+            self.future.exception()     # mark retrieved, the submitting caller re-raises it
+
+
+class RateGate:
+    """
+    Allows at most rate operations every per seconds.  When operations have to wait they are let through in
+    priority order, then first come first served.
+    """
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.started = collections.deque()  # start times of recent operations
+        self.waiters = []   # heap of (priority, sequence, future, operation)
+        self.sequence = itertools.count()
+        self.wakeup = None
+
+    async def acquire(self, operation):
+        """
+        Wait until an operation may start
+        :param operation: the waiting operation
+        :return: void
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        heapq.heappush(self.waiters, (operation.priority, next(self.sequence), future, operation))
+        self._release(loop)
+
+        operation.gate = self
+        try:
+            await future
+        finally:
+            operation.gate = None
+
+    def reorder(self):
+        """
+        Re-sort the waiting operations after the priority of one of them was raised
+        :return: void
+        """
+        self.waiters = [(operation.priority, sequence, future, operation)
+                        for _, sequence, future, operation in self.waiters]
+        heapq.heapify(self.waiters)
+
+    def idle(self):
+        """
+        Checks if the gate has no waiting operations and no recent history
+        :return: True if idle
+        """
+        return len(self.waiters) == 0 and (len(self.started) == 0 or
+                                           asyncio.get_event_loop().time() - self.started[-1] >= self.per)
+
+    def _release(self, loop):
+        """
+        Let through as many waiting operations as the rate allows and schedule a wakeup for the rest
+        :param loop: event loop
+        :return: void
+        """
+        now = loop.time()
+        while len(self.started) > 0 and now - self.started[0] >= self.per:
+            self.started.popleft()
+
+        while len(self.waiters) > 0 and len(self.started) < self.rate:
+            _, _, future, _ = heapq.heappop(self.waiters)
+            if future.done():
+                continue    # waiter was cancelled
+            self.started.append(now)
+            future.set_result(None)
+
+        if len(self.waiters) > 0 and self.wakeup is None:
+            self.wakeup = loop.call_later(self.started[0] + self.per - now, self._wake, loop)
+
+    def _wake(self, loop):
+        self.wakeup = None
+        self._release(loop)
+
+
+def bucket_key(destination):
+    """
+    Gets the rate limit bucket of a destination
+    :param destination: channel, context or user
+    :return: id of the channel (or user, for direct messages)
+    """
+    channel = getattr(destination, 'channel', None)
+    if channel is not None:
+        return channel.id
+    return destination.id
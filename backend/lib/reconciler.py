@@ -0,0 +1,186 @@
+import asyncio
+import datetime
+import traceback
+
+import discord
+
+from backend.lib.caches import shop_routes
+from backend.lib.helper_commands import ShopNotFoundError, get_shop, get_all_shops, get_shop_items, \
+    get_item_shop_ids, delete_all_shop_items, delete_user_shop, set_shop_item_id
+from backend.lib.outbound import BACKGROUND
+from backend.lib.shop_queries import create_item_embed, hash_render
+
+HISTORY_PAGE = 100      # messages per channel history request
+
+
+class Reconciler:
+    """
+    Repairs shops whose messages were deleted by hand.  On a schedule it walks shop channel histories page by page,
+    reposts item embeds and signs that are missing, and removes rows of shops whose channel is gone.  Each cycle
+    spends at most max_api_calls Discord requests and the next cycle carries on where it stopped, part way through
+    a shop's history if it has to.
+    """
+    def __init__(self, bot, db, outbound, signs, scheduler, interval, max_api_calls):
+        self.bot = bot
+        self.db = db
+        self.outbound = outbound
+        self.signs = signs
+        self.scheduler = scheduler
+        self.interval = interval            # seconds between cycles
+        self.max_api_calls = max_api_calls  # Discord requests allowed per cycle
+        self.last_shop_id = 0               # last shop fully reconciled, the next cycle starts after it
+        self.scans = {}     # shop id -> history read of a shop that ran out of budget, resumed next cycle
+
+    def start(self):
+        """
+        Run reconcile cycles in the background for as long as the bot runs
+        :return: the background task
+        """
+        return self.bot.loop.create_task(self.run())
+
+    async def run(self):
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            await asyncio.sleep(self.interval)
+            try:
+                await self.cycle()
+            except Exception:
+                traceback.print_exc()   # try again next cycle
+
+    async def cycle(self):
+        """
+        Reconcile as many shops as the API budget allows, starting after the last shop reconciled
+        :return: dict of repairs made
+        """
+        report = {'shops': 0, 'signs': 0, 'items': 0, 'orphaned shops': 0, 'orphaned items': 0, 'api calls': 0}
+
+        # read the shops with items before the shops, a shop created in between then can't look orphaned
+        item_shop_ids = set(await self.db.run(get_item_shop_ids))
+
+        if shop_routes.loaded:
+            shop_ids = sorted(shop_routes.shops)
+        else:
+            shop_ids = sorted(int(row[0]) for row in await self.db.run(get_all_shops))
+
+        for shop_id in item_shop_ids - set(shop_ids):
+            # items of a shop that no longer exists
+            report['orphaned items'] += await self.db.run(delete_all_shop_items, shop_id)
+
+        ordered = [shop_id for shop_id in shop_ids if shop_id > self.last_shop_id] + \
+                  [shop_id for shop_id in shop_ids if shop_id <= self.last_shop_id]
+
+        for shop_id in ordered:
+            if not await self.reconcile_shop(shop_id, report):
+                break   # out of budget, this shop is retried first next cycle
+            self.last_shop_id = shop_id
+            report['shops'] += 1
+
+        print('Reconciled ' + ', '.join('{0} {1}'.format(count, name) for name, count in report.items()))
+        return report
+
+    async def reconcile_shop(self, shop_id, report):
+        """
+        Repost the missing sign and item messages of a shop, or remove the shop if its channel is gone
+        :param shop_id: id of the shop
+        :param report: dict of repairs made this cycle, updated in place
+        :return: False if the API budget ran out before the shop was done, True otherwise
+        """
+        try:
+            finished = await self.repair_shop(shop_id, report)
+        except discord.Forbidden:
+            finished = True     # can't read this shop, nothing to repair
+
+        if finished:
+            self.scans.pop(shop_id, None)   # the next visit reads the history afresh
+        return finished
+
+    async def repair_shop(self, shop_id, report):
+        channel = self.bot.get_channel(shop_id)
+        if channel is None:     # not cached, ask Discord before deciding the channel is gone
+            if report['api calls'] >= self.max_api_calls:
+                return False
+            report['api calls'] += 1
+
+            try:
+                channel = await self.bot.fetch_channel(shop_id)
+            except discord.NotFound:
+                try:
+                    shop_results = await self.db.run(get_shop, shop_id)
+                    await self.db.run(delete_user_shop, shop_results[1])   # channel was deleted by hand
+                    self.scheduler.forget(shop_id)
+                    report['orphaned shops'] += 1
+                except ShopNotFoundError:
+                    pass
+                return True
+            except discord.HTTPException:
+                return True     # can't tell if the channel exists, try again next cycle
+
+        scan = await self.read_history(shop_id, channel, report)
+        if scan is None:
+            return False
+        horizon, present = scan['horizon'], scan['present']
+
+        try:
+            shop_results = await self.db.run(get_shop, shop_id)
+        except ShopNotFoundError:
+            return True     # shop was deleted while reading its history
+
+        owner = self.bot.get_user(int(shop_results[1]))
+        for item in await self.db.run(get_shop_items, shop_id):
+            if int(item[0]) in present or int(item[0]) > horizon or owner is None:
+                continue
+
+            if report['api calls'] >= self.max_api_calls:
+                return False
+            report['api calls'] += 1
+
+            embed = create_item_embed(owner, item[2], item[3], item[4], item[5], item[6], item[7])
+            item_msg = await self.outbound.send(channel, embed=embed, priority=BACKGROUND)
+            await self.db.run(set_shop_item_id, item[0], shop_id, item_msg.id, hash_render(embed.to_dict()))
+            report['items'] += 1
+
+        sign_id = int(shop_results[5])
+        if sign_id not in present and sign_id <= horizon:
+            if report['api calls'] + 2 > self.max_api_calls:
+                return False
+            report['api calls'] += 2    # send the new sign and try to delete the old one
+
+            try:
+                await self.signs.repost(shop_id)
+                report['signs'] += 1
+            except ShopNotFoundError:
+                pass
+
+        return True
+
+    async def read_history(self, shop_id, channel, report):
+        """
+        Find our messages in a shop channel, carrying on from where the last cycle ran out of budget
+        :param shop_id: id of the shop
+        :param channel: the shop channel
+        :param report: dict of repairs made this cycle, updated in place
+        :return: Raise discord.Forbidden if the channel can't be read, None if the API budget ran out first, the
+        scan otherwise: dict with the horizon and the ids of our messages still in the channel
+        """
+        scan = self.scans.get(shop_id)
+        if scan is None:
+            # messages posted after this point are newer than the history we read, so they are never "missing"
+            scan = self.scans[shop_id] = {'horizon': discord.utils.time_snowflake(datetime.datetime.utcnow()),
+                                          'present': set(), 'before': None, 'done': False}
+
+        if not scan['done']:
+            before = None if scan['before'] is None else discord.Object(id=scan['before'])
+            count = 0
+            async for message in channel.history(limit=None, before=before):
+                if count % HISTORY_PAGE == 0:   # each page is one request
+                    if report['api calls'] >= self.max_api_calls:
+                        return None
+                    report['api calls'] += 1
+                count += 1
+
+                if message.author == self.bot.user:
+                    scan['present'].add(message.id)
+                scan['before'] = message.id     # oldest message read so far
+            scan['done'] = True
+
+        return scan
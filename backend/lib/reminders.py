@@ -0,0 +1,220 @@
+import asyncio
+import datetime
+import heapq
+import traceback
+
+import discord
+
+from backend.lib.outbound import BACKGROUND
+
+REMINDER_BATCH = 100    # users reminded between two reminder_sent writes
+FETCH_BATCH = 1000      # registration rows fetched at a time
+
+
+class ReminderDispatcher:
+    """
+    Reminds users of the events they registered for, lead before each event starts.  Upcoming events are kept in a
+    timer heap and the dispatcher sleeps until the next one is due.  When events fall due their registrations are
+    read with one streaming query and grouped per user, so each user gets a single direct message listing all of
+    their events.  Users who don't accept direct messages are mentioned together in the reminder channel instead.
+    """
+    def __init__(self, bot, db, outbound, reminder_channel_id, lead, refresh_interval=3600):
+        self.bot = bot
+        self.db = db
+        self.outbound = outbound
+        self.reminder_channel_id = reminder_channel_id
+        self.lead = lead                            # timedelta between the reminder and the event
+        self.refresh_interval = refresh_interval    # seconds between looking for new events
+        self.timers = []        # heap of (reminder time, event id)
+        self.scheduled = set()  # event ids in the heap
+
+    def start(self):
+        """
+        Run the dispatcher in the background for as long as the bot runs
+        :return: the background task
+        """
+        return self.bot.loop.create_task(self.run())
+
+    async def run(self):
+        await self.bot.wait_until_ready()
+        loop = asyncio.get_event_loop()
+        next_refresh = loop.time()
+
+        while not self.bot.is_closed():
+            if loop.time() >= next_refresh:
+                next_refresh = loop.time() + self.refresh_interval
+                try:
+                    await self.refresh()
+                except Exception:
+                    traceback.print_exc()   # try again next refresh
+
+            due = []
+            while len(self.timers) > 0 and self.timers[0][0] <= datetime.datetime.now():
+                _, event_id = heapq.heappop(self.timers)
+                self.scheduled.discard(event_id)
+                due.append(event_id)
+
+            if len(due) > 0:
+                try:
+                    print('Reminded {0} users of {1} events'.format(await self.dispatch(due), len(due)))
+                except Exception:
+                    traceback.print_exc()   # unsent reminders are picked up again next refresh
+                continue    # more may have fallen due while sending
+
+            sleep = next_refresh - loop.time()
+            if len(self.timers) > 0:
+                sleep = min(sleep, (self.timers[0][0] - datetime.datetime.now()).total_seconds())
+            await asyncio.sleep(max(sleep, 0))
+
+    async def refresh(self):
+        """
+        Schedule the events whose reminders are due before the next refresh
+        :return: void
+        """
+        until = datetime.datetime.now() + self.lead + datetime.timedelta(seconds=self.refresh_interval)
+
+        for event_id, date in await self.db.run(get_upcoming_events, until):
+            if event_id not in self.scheduled:
+                heapq.heappush(self.timers, (date - self.lead, event_id))
+                self.scheduled.add(event_id)
+
+    async def dispatch(self, event_ids):
+        """
+        Send the reminders of events that are due, one message per user
+        :param event_ids: ids of the events
+        :return: number of users reminded
+        """
+        reminders = await self.db.run(get_due_reminders, event_ids)
+        user_ids = list(reminders)
+        mentions = []   # users who couldn't be sent a direct message
+
+        for start in range(0, len(user_ids), REMINDER_BATCH):
+            batch = user_ids[start:start + REMINDER_BATCH]
+            results = await asyncio.gather(*(self.remind(user_id, reminders[user_id]) for user_id in batch))
+
+            sent = []
+            for user_id, result in zip(batch, results):
+                if result is None:
+                    continue    # failed, try again next refresh
+                if result is False:
+                    mentions.append(user_id)
+                sent += [(event_id, user_id) for event_id, _, _, _ in reminders[user_id]]
+
+            await self.db.run(add_reminders_sent, sent)
+
+        await self.post_mentions(mentions, reminders)
+        return len(user_ids)
+
+    async def remind(self, user_id, events):
+        """
+        Send a user one direct message listing their upcoming events
+        :param user_id: id of the user
+        :param events: list of (event id, game name, event title, event date)
+        :return: True if sent or the user is gone, False if they don't accept direct messages, None on other errors
+        """
+        user = self.bot.get_user(user_id)
+        if user is None:
+            return True     # left the server, nobody to remind
+
+        try:
+            await self.outbound.send(user, format_reminder(events), priority=BACKGROUND)
+            return True
+        except discord.Forbidden:
+            return False
+        except discord.HTTPException:
+            return None
+
+    async def post_mentions(self, user_ids, reminders):
+        """
+        Remind users who don't accept direct messages in the reminder channel, many users per message
+        :param user_ids: ids of the users
+        :param reminders: dict of user id -> list of events
+        :return: void
+        """
+        channel = self.bot.get_channel(self.reminder_channel_id)
+        if channel is None or len(user_ids) == 0:
+            return
+
+        message = "Reminders for your registered events:\n"
+        for user_id in user_ids:
+            line = "<@" + str(user_id) + "> " + "; ".join(
+                "%s in '%s' on %s" % (game, title, format_date(date)) for _, game, title, date in reminders[user_id])
+
+            if len(message) + len(line) >= 1900:
+                await self.outbound.send(channel, message, priority=BACKGROUND)
+                message = ""
+            message += line + "\n"
+
+        await self.outbound.send(channel, message, priority=BACKGROUND)
+
+
+def format_reminder(events):
+    """
+    Formats the reminder message of a user
+    :param events: list of (event id, game name, event title, event date)
+    :return: text of the message
+    """
+    lines = ["You are registered to play %s in '%s' on %s" % (game, title, format_date(date))
+             for _, game, title, date in events]
+    return "Reminder!\n" + "\n".join(lines)
+
+
+def format_date(date):
+    return date.strftime('%B %d %Y at %H:%M')
+
+
+# SQL FUNCTIONS #
+
+
+def get_upcoming_events(until, cursor):
+    """
+    Gets the events that haven't started yet and start before a given time
+    :param until: latest start time to include
+    :param cursor: cursor object for executing search query
+    :return: list of (event id, date)
+    """
+    cursor.execute('select event_id, date from event '
+                   'where date > %s and date <= %s', (datetime.datetime.now(), until))
+    return cursor.fetchall()
+
+
+def get_due_reminders(event_ids, cursor):
+    """
+    Streams the registrations of events that haven't been reminded yet, grouped per user
+    :param event_ids: ids of the events
+    :param cursor: cursor object for executing search query
+    :return: dict of user id -> list of (event id, game name, event title, event date)
+    """
+    reminders = {}
+    if len(event_ids) == 0:
+        return reminders
+
+    cursor.execute('select registration.user_id, event.event_id, game.name, event.title, event.date '
+                   'from registration '
+                   'inner join event on event.event_id = registration.event_id '
+                   'inner join game on game.game_id = event.game_id '
+                   'left join reminder_sent on reminder_sent.event_id = registration.event_id '
+                   'and reminder_sent.user_id = registration.user_id '
+                   'where registration.event_id in (' + ', '.join(['%s'] * len(event_ids)) + ') '
+                   'and reminder_sent.event_id is null', tuple(event_ids))
+
+    for rows in iter(lambda: cursor.fetchmany(FETCH_BATCH), []):
+        for user_id, event_id, game, title, date in rows:
+            reminders.setdefault(int(user_id), []).append((int(event_id), game, title, date))
+
+    return reminders
+
+
+def add_reminders_sent(reminders, cursor, cnx):
+    """
+    Records reminders as sent
+    :param reminders: list of (event id, user id)
+    :param cursor: cursor object for executing insert query
+    :param cnx: connection object for committing changes
+    :return: void
+    """
+    if len(reminders) == 0:
+        return
+
+    cursor.executemany('insert ignore into reminder_sent (event_id, user_id) values (%s, %s)', reminders)
+    cnx.commit()  # commit the whole batch at once
@@ -0,0 +1,113 @@
+import asyncio
+
+import discord
+
+from backend.lib.caches import shop_routes, control_panels
+from backend.lib.helper_commands import ShopNotFoundError, get_shop, get_all_shops, get_user_shop, get_shop_items, \
+    get_render_hashes, set_render_hashes
+from backend.lib.outbound import BACKGROUND
+from backend.lib.shop_queries import create_item_embed, hash_render
+from backend.lib.sign_manager import render_shop_sign
+
+
+class Renderer:
+    """
+    Re-renders the item embeds and sign of shops, eg. after an owner changed their name or avatar or a template
+    changed.  A hash of the last render of every message is stored and only messages whose render changed are
+    edited, through the outbound queue at background priority.  At most concurrency shops are rendered at once.
+    """
+    def __init__(self, bot, db, outbound, signs, concurrency=4):
+        self.bot = bot
+        self.db = db
+        self.outbound = outbound
+        self.signs = signs
+        self.slots = asyncio.Semaphore(concurrency)    # shops rendered at once
+
+    async def render_owner(self, user):
+        """
+        Re-render the shop of a user, if they have one
+        :param user: the user
+        :return: dict of messages rendered and edited, or None if the user has no shop
+        """
+        shop_id = control_panels.get_shop(user.id)
+        if shop_id is None and not control_panels.loaded:
+            try:
+                shop_id = await self.db.run(get_user_shop, user.id)
+            except ShopNotFoundError:
+                pass
+
+        if shop_id is None:
+            return None
+
+        return await self.render_shops([shop_id])
+
+    async def render_all(self):
+        """
+        Re-render every shop, eg. after a template changed
+        :return: dict of messages rendered and edited
+        """
+        if shop_routes.loaded:
+            shop_ids = sorted(shop_routes.shops)
+        else:
+            shop_ids = sorted(int(row[0]) for row in await self.db.run(get_all_shops))
+
+        return await self.render_shops(shop_ids)
+
+    async def render_shops(self, shop_ids):
+        """
+        Re-render shops
+        :param shop_ids: ids of the shops
+        :return: dict of messages rendered and edited
+        """
+        report = {'shops': 0, 'messages': 0, 'edited': 0, 'missing': 0}
+        await asyncio.gather(*(self.render_shop(shop_id, report) for shop_id in shop_ids))
+
+        print('Rendered ' + ', '.join('{0} {1}'.format(count, name) for name, count in report.items()))
+        return report
+
+    async def render_shop(self, shop_id, report):
+        """
+        Render the item embeds and sign of a shop and edit the messages whose render changed
+        :param shop_id: id of the shop
+        :param report: dict of messages rendered and edited, updated in place
+        :return: void
+        """
+        async with self.slots:
+            try:
+                shop_results = await self.db.run(get_shop, shop_id)
+            except ShopNotFoundError:
+                return  # deleted since the render started
+
+            owner = self.bot.get_user(int(shop_results[1]))
+            if owner is None:
+                return
+
+            renders = {}    # message id -> (hash, fields to edit)
+            for item in await self.db.run(get_shop_items, shop_id):
+                embed = create_item_embed(owner, item[2], item[3], item[4], item[5], item[6], item[7])
+                renders[int(item[0])] = (hash_render(embed.to_dict()), {'embed': embed})
+
+            sign_id = int(shop_results[5])
+            sign_text = render_shop_sign(str(owner), tuple(shop_results))
+            renders[sign_id] = (hash_render(sign_text), {'content': sign_text})
+
+            stored = await self.db.run(get_render_hashes, list(renders))
+
+            edited = []
+            for message_id, (digest, fields) in renders.items():
+                if stored.get(message_id) == digest:
+                    continue    # message already shows this render
+
+                try:
+                    await self.outbound.edit(shop_id, message_id, priority=BACKGROUND, **fields)
+                    edited.append((message_id, digest))
+                except discord.NotFound:
+                    report['missing'] += 1  # deleted by hand, the reconciler reposts it
+
+            await self.db.run(set_render_hashes, edited)
+            if (sign_id, renders[sign_id][0]) in edited:
+                self.signs.posted[shop_id] = (sign_id, sign_text)  # sign manager knows the sign is up to date
+
+            report['shops'] += 1
+            report['messages'] += len(renders)
+            report['edited'] += len(edited)
@@ -0,0 +1,253 @@
+import asyncio
+import datetime
+import heapq
+import traceback
+
+import discord
+
+from backend.lib.helper_commands import get_shop_schedules, get_shop_statuses, set_shop_statuses
+from backend.lib.outbound import BACKGROUND
+
+DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+DAY_GROUPS = {'all': range(7), 'weekdays': range(5), 'weekends': range(5, 7)}
+
+
+class ShopScheduler:
+    """
+    Opens and closes shops on their opening hours.  The next transition of every scheduled shop is kept in one
+    min-heap and the scheduler sleeps until the earliest is due.  Transitions that fall due together, eg. hundreds
+    of shops opening at midnight, are applied as one batch: a single status read and write, permission changes
+    paced by the outbound queue and coalesced sign reposts.
+    """
+    def __init__(self, bot, db, outbound, signs):
+        self.bot = bot
+        self.db = db
+        self.outbound = outbound
+        self.signs = signs
+        self.schedules = {}     # shop id -> {day: (open minute, close minute)}
+        self.versions = {}      # shop id -> version of its schedule, heap entries of older versions are skipped
+        self.timers = []        # heap of (transition time, shop id, status, version)
+        self.wake = asyncio.Event()
+
+    def start(self):
+        """
+        Run the scheduler in the background for as long as the bot runs
+        :return: the background task
+        """
+        return self.bot.loop.create_task(self.run())
+
+    async def run(self):
+        await self.bot.wait_until_ready()
+        for shop_id, schedule in (await self.db.run(get_shop_schedules)).items():
+            self.update(shop_id, schedule)  # also catches up on transitions missed while offline
+
+        while not self.bot.is_closed():
+            self.wake.clear()
+            timeout = None
+            if len(self.timers) > 0:
+                timeout = max((self.timers[0][0] - datetime.datetime.now()).total_seconds(), 0)
+
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+            due = {}
+            now = datetime.datetime.now()
+            while len(self.timers) > 0 and self.timers[0][0] <= now:
+                when, shop_id, status, version = heapq.heappop(self.timers)
+                if self.versions.get(shop_id) != version:
+                    continue    # schedule changed since this was pushed
+
+                due[shop_id] = status
+                self.push_next(shop_id, when)
+
+            if len(due) > 0:
+                try:
+                    await self.apply(due)
+                except Exception:
+                    traceback.print_exc()   # the next transitions are already scheduled
+
+    def update(self, shop_id, schedule):
+        """
+        Replace the opening hours of a shop.  The shop is brought to its scheduled status right away.
+        :param shop_id: id of the shop
+        :param schedule: dict of day -> (open minute, close minute), empty to remove the schedule
+        :return: void
+        """
+        self.versions[shop_id] = self.versions.get(shop_id, 0) + 1   # pending transitions are skipped from now on
+
+        if len(schedule) == 0:
+            self.schedules.pop(shop_id, None)
+            return
+
+        now = datetime.datetime.now()
+        self.schedules[shop_id] = schedule
+        heapq.heappush(self.timers, (now, shop_id, scheduled_status(schedule, now), self.versions[shop_id]))
+        self.wake.set()
+
+    def forget(self, shop_id):
+        """
+        Stop opening and closing a shop, called once it has been deleted
+        :param shop_id: id of the shop
+        :return: void
+        """
+        self.update(shop_id, {})
+
+    def push_next(self, shop_id, after):
+        """
+        Schedule the next transition of a shop
+        :param shop_id: id of the shop
+        :param after: time of the transition that was just taken
+        :return: void
+        """
+        when, status = next_transition(self.schedules[shop_id], after)
+        heapq.heappush(self.timers, (when, shop_id, status, self.versions[shop_id]))
+
+    async def apply(self, due):
+        """
+        Open and close a batch of shops
+        :param due: dict of shop id -> status to set
+        :return: number of shops changed
+        """
+        current = await self.db.run(get_shop_statuses, list(due))
+        for shop_id in due.keys() - current.keys():
+            self.forget(shop_id)    # deleted without telling us
+
+        changes = [(shop_id, status) for shop_id, status in due.items()
+                   if shop_id in current and current[shop_id] != status]
+
+        async def set_permissions(shop_id, status):
+            channel = self.bot.get_channel(shop_id)
+            if channel is None:
+                return False
+            try:
+                await self.outbound.set_permissions(channel, channel.guild.default_role, priority=BACKGROUND,
+                                                    read_messages=(status == 1))
+                return True
+            except discord.HTTPException:
+                return False    # try again at the next transition
+
+        results = await asyncio.gather(*(set_permissions(shop_id, status) for shop_id, status in changes))
+        changed = [change for change, result in zip(changes, results) if result]
+
+        await self.db.run(set_shop_statuses, changed)
+        for shop_id, _ in changed:
+            self.signs.request_repost(shop_id)     # show the new status on the sign
+
+        if len(changed) > 0:
+            print('Opening hours opened {0} and closed {1} shops'.format(
+                sum(1 for _, status in changed if status == 1), sum(1 for _, status in changed if status == 0)))
+        return len(changed)
+
+
+def windows(schedule, day):
+    """
+    Gets the opening windows of a schedule that start on a date
+    :param schedule: dict of day -> (open minute, close minute)
+    :param day: the date
+    :return: list of (open time, close time)
+    """
+    hours = schedule.get(day.weekday())
+    if hours is None:
+        return []
+
+    midnight = datetime.datetime.combine(day, datetime.time())
+    open_minute, close_minute = hours
+    if close_minute <= open_minute:
+        close_minute += 24 * 60     # closes after midnight
+    return [(midnight + datetime.timedelta(minutes=open_minute), midnight + datetime.timedelta(minutes=close_minute))]
+
+
+def scheduled_status(schedule, when):
+    """
+    Gets the status a schedule gives a shop at a time
+    :param schedule: dict of day -> (open minute, close minute)
+    :param when: the time
+    :return: 1 if open, 0 if closed
+    """
+    for offset in (-1, 0):  # a window of yesterday may run past midnight
+        for open_at, close_at in windows(schedule, when.date() + datetime.timedelta(days=offset)):
+            if open_at <= when < close_at:
+                return 1
+    return 0
+
+
+def next_transition(schedule, after):
+    """
+    Gets the first time after a given time that a schedule opens or closes a shop
+    :param schedule: dict of day -> (open minute, close minute), not empty
+    :param after: the time
+    :return: (time, 1 to open or 0 to close)
+    """
+    times = []
+    for offset in range(-1, 8):
+        for open_at, close_at in windows(schedule, after.date() + datetime.timedelta(days=offset)):
+            times += [open_at, close_at]
+
+    when = min(time for time in times if time > after)
+    return when, scheduled_status(schedule, when)     # adjacent windows close and open at the same time
+
+
+def parse_days(text):
+    """
+    Parses the days of an opening hours command
+    :param text: eg. mon, mon-fri, sat,sun, weekdays, weekends or all
+    :return: Raise InvalidHoursError if invalid, list of days otherwise (0 is Monday)
+    """
+    text = text.lower()
+    if text in DAY_GROUPS:
+        return list(DAY_GROUPS[text])
+
+    days = []
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        if first not in DAYS or (last != '' and last not in DAYS):
+            raise InvalidHoursError
+
+        start, end = DAYS.index(first), DAYS.index(last or first)
+        days += [day % 7 for day in range(start, end + 1 if end >= start else end + 8)]    # eg. fri-mon wraps
+
+    return sorted(set(days))
+
+
+def parse_clock(text):
+    """
+    Parses a time of day
+    :param text: eg. 09:00 or 17:30
+    :return: Raise InvalidHoursError if invalid, minutes after midnight otherwise
+    """
+    try:
+        clock = datetime.datetime.strptime(text, '%H:%M')
+    except ValueError:
+        raise InvalidHoursError
+
+    return clock.hour * 60 + clock.minute
+
+
+def format_schedule(schedule):
+    """
+    Formats the opening hours of a shop
+    :param schedule: dict of day -> (open minute, close minute)
+    :return: text listing the hours of every day
+    """
+    lines = []
+    for day, name in enumerate(DAYS):
+        hours = schedule.get(day)
+        if hours is None:
+            lines.append(name.capitalize() + ': closed')
+        else:
+            lines.append('{0}: {1:02d}:{2:02d} - {3:02d}:{4:02d}'.format(name.capitalize(), *divmod(hours[0], 60),
+                                                                        *divmod(hours[1], 60)))
+    return '\n'.join(lines)
+
+
+# ERRORS #
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+
+class InvalidHoursError(Error):
+    """Opening hours given in an invalid format."""
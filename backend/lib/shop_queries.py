@@ -1,141 +1,302 @@
+import asyncio
+import collections
+import csv
+import hashlib
+import io
+import json
+import math
+
 import discord
 from discord.ext import commands
 from discord.utils import get
-from backend.lib.helper_commands import check_admin_status, AdminPermissionError, check_user_exists, in_control_panel, \
-    CommandNotControlPanelError, get_user_shop, get_shop_status, set_shop_status, add_shop_item, ItemNotFoundError, \
+from backend.lib.caches import control_panels, shop_routes, item_rows
+from backend.lib.tracing import span
+from backend.lib.helper_commands import check_admin_status, AdminPermissionError, check_user_exists, get_control_panel, \
+    CommandNotControlPanelError, ShopNotFoundError, get_shop_status, set_shop_status, add_shop_item, ItemNotFoundError, \
     get_shop_item, set_shop_item_name, set_shop_item_desc, set_shop_item_price, set_shop_item_qty, set_shop_item_type, \
-    set_shop_item_image, delete_shop_item, get_shop_sign, get_shop, set_shop_sign
+    set_shop_item_image, delete_shop_item, set_shop_item_fields, ITEM_FIELDS, add_shop_items, \
+    set_shop_item_id, get_shop_schedule, set_shop_schedule, get_shop, set_render_hashes
+from backend.lib.inventory import InventoryView, PREVIOUS, NEXT
+from backend.lib.shop_hours import InvalidHoursError, parse_days, parse_clock, format_schedule
+
+
+MAX_IMPORT_ITEMS = 250     # most items accepted by a single import
+SEARCH_RESULTS = 10     # items listed by a search
+OPEN_INVENTORIES = 100  # inventory messages that can still turn pages, the oldest stop responding
 
 
 class ShopQueries(commands.Cog):
-    def __init__(self, bot, cursor, cnx, shop_category_id, control_category_id):
+    def __init__(self, bot, db, outbound, signs, scheduler, shop_category_id, control_category_id):
         self.bot = bot
-        self.cursor = cursor
-        self.cnx = cnx
+        self.db = db
+        self.outbound = outbound
+        self.signs = signs
+        self.scheduler = scheduler
+        self.inventories = collections.OrderedDict()   # message id -> InventoryView
         self.shop_category_id = shop_category_id
         self.control_category_id = control_category_id
 
+    async def get_panel_shop(self, ctx):
+        """
+        Checks a command was sent from the author's control panel and gets their shop, using the ownership index
+        :param ctx: context of the command
+        :return: Raise CommandNotControlPanelError if not in their control panel, ShopNotFoundError if they have no
+        shop, shop_id if successful
+        """
+        entry = control_panels.lookup(ctx.message.channel.id)
+        if (entry is None or entry[1] is None) and not control_panels.loaded:
+            # the panel may be cached without its shop until the index has loaded
+            entry = await self.db.run(get_control_panel, ctx.message.channel.id)
+
+        if entry is None or entry[0] != ctx.author.id:
+            raise CommandNotControlPanelError
+
+        if entry[1] is None:
+            raise ShopNotFoundError
+
+        return entry[1]
+
+    async def edit_item_message(self, ctx, shop_id, item_id, embed):
+        """
+        Edits an item's embed through its stored message id, without fetching the message first.  If the message
+        was deleted by hand the embed is posted again and the item row is moved to the new message.
+        :param ctx: context of the command, used to tell the seller about a repost
+        :param shop_id: id of the shop the item belongs to
+        :param item_id: id of the item message
+        :param embed: new embed of the item
+        :return: id of the item message, which changes if the message had to be reposted
+        """
+        digest = hash_render(embed.to_dict())
+
+        try:
+            await self.outbound.edit(shop_id, item_id, embed=embed)
+            await self.db.run(set_render_hashes, [(int(item_id), digest)])     # the renderer skips it from now on
+            return int(item_id)
+        except discord.NotFound:
+            item_msg = await self.outbound.send(self.bot.get_channel(shop_id), embed=embed)
+            await self.db.run(set_shop_item_id, item_id, shop_id, item_msg.id, digest)
+            await self.outbound.send(ctx, "The item message was missing so it has been posted again. "
+                                          "The new item id is " + str(item_msg.id) + ".")
+            return item_msg.id
+
     @commands.command()
     async def shop(self, ctx, status):
         """
         Set the status of the shop to open / close
         :param status: the status of the shop (open / close)
         """
-        user = ctx.author
-
         try:
-            in_control_panel(user.id, ctx.message.channel.id, self.cursor)
+            shop_id = await self.get_panel_shop(ctx)
         except CommandNotControlPanelError:
             return  # do nothing in current channel
 
         status = status.lower()
 
         if not (status == 'open' or status == 'close'):  # check for valid response
-            await ctx.send("Error: Must provide a valid status for your shop! (eg. open / close)")
+            await self.outbound.send(ctx, "Error: Must provide a valid status for your shop! (eg. open / close)")
             return
 
         status = 0 if status == 'close' else 1
-        shop_id = get_user_shop(user.id, self.cursor)
 
-        cur_status = get_shop_status(shop_id, self.cursor)
+        cur_status = await self.db.run(get_shop_status, shop_id)
 
         if status == cur_status:
-            await ctx.send("Error: The shop is already " + ('open' if cur_status == 1 else 'closed') + " for business!")
+            await self.outbound.send(ctx, "Error: The shop is already " + ('open' if cur_status == 1 else 'closed') + " for business!")
             return
 
         guild = ctx.guild
         shop_channel = self.bot.get_channel(shop_id)
 
         if status == 1:    # if the user is opening their shop
-            await shop_channel.set_permissions(guild.default_role, read_messages=True)
-            await ctx.send("You have successfully opened up shop!")
+            await self.outbound.set_permissions(shop_channel, guild.default_role, read_messages=True)
+            await self.outbound.send(ctx, "You have successfully opened up shop!")
         else:   # if the user is closing their shop
-            await shop_channel.set_permissions(guild.default_role, read_messages=False)
-            await ctx.send("You have successfully closed down shop!")
+            await self.outbound.set_permissions(shop_channel, guild.default_role, read_messages=False)
+            await self.outbound.send(ctx, "You have successfully closed down shop!")
 
-        set_shop_status(shop_id, status, self.cursor, self.cnx)
+        await self.db.run(set_shop_status, shop_id, status)
 
-        # Begin Shop Sign Update
+        await self.signs.repost_now(shop_id)   # show the new status on the sign
 
-        shop_results = get_shop(shop_id, self.cursor)
+    @commands.command()
+    async def hours(self, ctx, days=None, open_time=None, close_time=None):
+        """
+        Set the opening hours of the shop, or show them when no days are given
+        :param days: the days to set (eg. mon, mon-fri, weekends, all)
+        :param open_time: the opening time (eg. 09:00), or off to stay closed on those days
+        :param close_time: the closing time (eg. 17:00)
+        """
+        try:
+            shop_id = await self.get_panel_shop(ctx)
+        except CommandNotControlPanelError:
+            return  # do nothing in current channel
 
-        new_sign = await shop_channel.send(
-            create_shop_sign(self.bot.get_user(int(shop_results[1])), shop_results, self.cursor))
+        if days is None:
+            schedule = await self.db.run(get_shop_schedule, shop_id)
+            await self.outbound.send(ctx, "Your shop's opening hours:\n" + format_schedule(schedule))
+            return
 
-        old_msg = await shop_channel.fetch_message(get_shop_sign(shop_id, self.cursor))
+        try:
+            day_list = parse_days(days)
+            if open_time is not None and open_time.lower() == 'off':
+                hours = None
+            elif open_time is None or close_time is None:
+                raise InvalidHoursError
+            else:
+                hours = (parse_clock(open_time), parse_clock(close_time))
+        except InvalidHoursError:
+            await self.outbound.send(ctx, "Error: Must provide days and times for your opening hours! "
+                                          "(eg. mon-fri 09:00 17:00, or sun off)")
+            return
 
-        set_shop_sign(shop_id, new_sign.id, self.cursor, self.cnx)
-        await old_msg.delete()
+        schedule = await self.db.run(set_shop_schedule, shop_id, day_list, hours)
+        self.scheduler.update(shop_id, schedule)    # opens or closes the shop now if its hours say so
 
-        # End Shop Sign Update
+        await self.outbound.send(ctx, "Your shop's opening hours are now:\n" + format_schedule(schedule))
 
     @commands.command()
-    async def add_item(self, ctx, item_name, item_price, item_qty, item_type, item_image, item_desc):
+    async def inventory(self, ctx):
         """
-        Add an item to the shop
-        :param item_name: name of the item
-        :param item_price: price of the item (0.00)
-        :param item_qty: available quantity for the item (negative value for INF)
-        :param item_type: type of the item (digital / service)
-        :param item_image: image url of the item (less than 128 characters)
-        :param item_desc: description of the item (less than 256 characters)
+        List the items of the shop with their ids, a page at a time
         """
-        user = ctx.author
-
         try:
-            in_control_panel(user.id, ctx.message.channel.id, self.cursor)
+            shop_id = await self.get_panel_shop(ctx)
         except CommandNotControlPanelError:
             return  # do nothing in current channel
 
-        if not isinstance(item_name, str):
-            await ctx.send("Error: The item name must have a valid name! (Use quotes to include spaces)")
-            return
+        shop_results = await self.db.run(get_shop, shop_id)
+        view = InventoryView(self.db, ctx.author.id, shop_id, shop_results[2])
+        message = await self.outbound.send(ctx, embed=await view.get_page(0))
+
+        if view.last_page == 0:
+            return  # everything fits on one page
+
+        self.inventories[message.id] = view
+        if len(self.inventories) > OPEN_INVENTORIES:
+            self.inventories.popitem(last=False)
+
+        with span('discord add_reaction'):
+            await message.add_reaction(PREVIOUS)
+            await message.add_reaction(NEXT)
+
+    @commands.Cog.listener()
+    async def on_reaction_add(self, reaction, user):
+        view = self.inventories.get(reaction.message.id)
+        if view is None or user.id != view.owner_id:
+            return  # not an inventory, or someone else's
+
+        embed = await view.turn(str(reaction.emoji))
+        if embed is not None:
+            await self.outbound.edit(reaction.message.channel.id, reaction.message.id, embed=embed)
 
         try:
-            item_price = float(item_price)
-        except ValueError:
-            await ctx.send("Error: The item price must have a valid price! (eg. 00.00)")
+            with span('discord remove_reaction'):
+                await reaction.message.remove_reaction(reaction.emoji, user)    # so the page can be turned again
+        except discord.HTTPException:
+            pass
+
+    @commands.command()
+    async def search(self, ctx, *terms):
+        """
+        Search the items of every open shop
+        :param terms: words to search for, and optionally min=price, max=price or instock to filter the results
+        """
+        words = []
+        min_price = max_price = None
+        in_stock = False
+
+        for term in terms:
+            key, sep, value = term.partition('=')
+            key = key.strip().lower()
+
+            if sep != '' and key in ('min', 'max'):
+                try:
+                    price = float(value)
+                except ValueError:
+                    await self.outbound.send(ctx, "Error: Prices must be numbers! (eg. min=1.00 max=20)")
+                    return
+
+                if key == 'min':
+                    min_price = price
+                else:
+                    max_price = price
+            elif term.lower() == 'instock':
+                in_stock = True
+            else:
+                words.append(term)
+
+        if len(words) == 0:
+            await self.outbound.send(ctx, "Error: Must provide something to search for! (eg. *search logo design max=20 instock)")
             return
 
-        try:
-            item_qty = int(item_qty)
-        except ValueError:
-            await ctx.send("Error: The item quantity must have a valid amount! (eg. 1)")
+        if not item_rows.loaded:
+            await self.outbound.send(ctx, "Error: Search is still starting up, please try again in a moment!")
             return
 
-        if not isinstance(item_type, str):
-            await ctx.send("Error: The item type must have a valid type! (eg. digital / service)")
+        results = []
+        for row in item_rows.search(' '.join(words)):     # served from the in-memory index
+            shop = shop_routes.get(row[1])
+            if shop is None or int(shop[4]) != 1:
+                continue    # closed shops are hidden from buyers
+            if (min_price is not None and row[4] < min_price) or (max_price is not None and row[4] > max_price):
+                continue
+            if in_stock and int(row[5]) == 0:
+                continue
+            results.append(row)
+
+        if len(results) == 0:
+            await self.outbound.send(ctx, "No items found for '" + ' '.join(words) + "'.")
             return
 
-        item_type = item_type.upper()
+        lines = ["Found " + str(len(results)) + " item" + ("" if len(results) == 1 else "s") + " for '" +
+                 ' '.join(words) + "':"]
+        for row in results[:SEARCH_RESULTS]:
+            line = "**{0}** - ${1:,.2f} - Qty Avl: {2} - <#{3}>".format(
+                row[2], row[4], "INF" if int(row[5]) < 0 else row[5], row[1])
+            if ctx.guild is not None:
+                line += " https://discord.com/channels/{0}/{1}/{2}".format(ctx.guild.id, row[1], row[0])
+            lines.append(line)
 
-        if not (item_type == 'DIGITAL' or item_type == 'SERVICE'):
-            await ctx.send("Error: The item type must have a valid type! (eg. digital / service)")
-            return
+        await self.outbound.send(ctx, "\n".join(lines)[:2000])
 
-        if not isinstance(item_desc, str):
-            await ctx.send("Error: The item description must have a valid description text!")
-            return
+    @commands.command()
+    async def add_item(self, ctx, item_name, item_price, item_qty, item_type, item_image, item_desc):
+        """
+        Add an item to the shop
+        :param item_name: name of the item
+        :param item_price: price of the item (0.00)
+        :param item_qty: available quantity for the item (negative value for INF)
+        :param item_type: type of the item (digital / service)
+        :param item_image: image url of the item (less than 128 characters)
+        :param item_desc: description of the item (less than 256 characters)
+        """
+        user = ctx.author
 
-        if len(item_desc) >= 512:
-            await ctx.send("Error: The item description must be less than 512 characters long!")
-            return
+        try:
+            shop_id = await self.get_panel_shop(ctx)
+        except CommandNotControlPanelError:
+            return  # do nothing in current channel
 
-        if len(item_image) >= 128:
-            await ctx.send("Error: The item image must be less than 128 characters long!")
+        try:
+            item = validate_item_fields({'name': item_name, 'price': item_price, 'qty': item_qty, 'type': item_type,
+                                         'desc': item_desc, 'image': item_image})
+        except InvalidItemFieldError as e:
+            await self.outbound.send(ctx, str(e))
             return
 
-        if item_image.lower() == 'none':
-            item_image = item_image.lower()
+        item_name, item_desc, item_price, item_qty, item_type, item_image = \
+            item['name'], item['desc'], item['price'], item['qty'], item['type'], item['image']
 
-        shop_id = get_user_shop(user.id, self.cursor)
         shop_channel = self.bot.get_channel(shop_id)
 
         embed = create_item_embed(user, item_name, item_desc, item_price, item_qty, item_type, item_image)
-        msg = await shop_channel.send(embed=embed)
-        add_shop_item(msg.id, shop_id, item_name, item_desc, item_price , item_qty, item_type, item_image, self.cursor, self.cnx)
+        msg = await self.outbound.send(shop_channel, embed=embed)
 
-        await ctx.send("You have successfully added a new item to your shop!")
+        async with self.db.transaction() as tx:     # the item and the hash of its embed in one commit
+            await tx.run(add_shop_item, msg.id, shop_id, item_name, item_desc, item_price , item_qty, item_type, item_image)
+            await tx.run(set_render_hashes, [(msg.id, hash_render(embed.to_dict()))])
+
+        await self.outbound.send(ctx, "You have successfully added a new item to your shop!")
 
     @commands.command()
     async def delete_item(self, ctx, item_id):
@@ -143,26 +304,23 @@ class ShopQueries(commands.Cog):
         Delete an item from the shop
         :param item_id: id of the item to delete
         """
-        user = ctx.author
-
         try:
-            in_control_panel(user.id, ctx.message.channel.id, self.cursor)
+            shop_id = await self.get_panel_shop(ctx)
         except CommandNotControlPanelError:
             return  # do nothing in current channel
 
-        shop_id = get_user_shop(user.id, self.cursor)
-        shop_channel = self.bot.get_channel(shop_id)
-
         try:
-            item_results = get_shop_item(item_id, shop_id, self.cursor)
-            item_msg = await shop_channel.fetch_message(item_id)
+            item_results = await self.db.run(get_shop_item, item_id, shop_id)
 
-            await item_msg.delete()
+            try:
+                await self.outbound.delete(shop_id, item_id)
+            except discord.NotFound:
+                pass    # message was already deleted by hand, just remove the row
 
-            delete_shop_item(item_id, shop_id, self.cursor, self.cnx)
-            await ctx.send("Successfully deleted item " + item_results[2] + "!")
+            await self.db.run(delete_shop_item, item_id, shop_id)
+            await self.outbound.send(ctx, "Successfully deleted item " + item_results[2] + "!")
         except ItemNotFoundError:
-            await ctx.send("Error: The item id was not found! Be sure to copy the correct id of your shop item message.")
+            await self.outbound.send(ctx, "Error: The item id was not found! Be sure to copy the correct id of your shop item message.")
             return
 
     @commands.command()
@@ -175,31 +333,26 @@ class ShopQueries(commands.Cog):
         user = ctx.author
 
         try:
-            in_control_panel(user.id, ctx.message.channel.id, self.cursor)
+            shop_id = await self.get_panel_shop(ctx)
         except CommandNotControlPanelError:
             return  # do nothing in current channel
 
         if not isinstance(item_name, str):
-            await ctx.send("Error: The item name must have a valid name! (Use quotes to include spaces)")
+            await self.outbound.send(ctx, "Error: The item name must have a valid name! (Use quotes to include spaces)")
             return
 
-        shop_id = get_user_shop(user.id, self.cursor)
-        shop_channel = self.bot.get_channel(shop_id)
-
         try:
-            item_msg = await shop_channel.fetch_message(item_id)
-
-            item_results = get_shop_item(item_id, shop_id, self.cursor)
+            item_results = await self.db.run(get_shop_item, item_id, shop_id)
             embed = create_item_embed(user, item_name, item_results[3], item_results[4],
                                       item_results[5], item_results[6], item_results[7])
 
-            set_shop_item_name(item_id, shop_id, item_name, self.cursor, self.cnx)
-            await item_msg.edit(embed=embed)
+            await self.db.run(set_shop_item_name, item_id, shop_id, item_name)
+            await self.edit_item_message(ctx, shop_id, item_id, embed)
         except ItemNotFoundError:
-            await ctx.send("Error: The item id was not found! Be sure to copy the correct id of your shop item message.")
+            await self.outbound.send(ctx, "Error: The item id was not found! Be sure to copy the correct id of your shop item message.")
             return
 
-        await ctx.send("Successfully updated the item name from " + item_results[2] + " to " + item_name + "!")
+        await self.outbound.send(ctx, "Successfully updated the item name from " + item_results[2] + " to " + item_name + "!")
 
     @commands.command()
     async def set_item_desc(self, ctx, item_id, item_desc):
@@ -211,36 +364,31 @@ class ShopQueries(commands.Cog):
         user = ctx.author
 
         try:
-            in_control_panel(user.id, ctx.message.channel.id, self.cursor)
+            shop_id = await self.get_panel_shop(ctx)
         except CommandNotControlPanelError:
             return  # do nothing in current channel
 
         if not isinstance(item_desc, str):
-            await ctx.send("Error: The item description must have a valid description text!")
+            await self.outbound.send(ctx, "Error: The item description must have a valid description text!")
             return
 
         if len(item_desc) >= 512:
-            await ctx.send("Error: The item description must be less than 512 characters long!")
+            await self.outbound.send(ctx, "Error: The item description must be less than 512 characters long!")
             return
 
-        shop_id = get_user_shop(user.id, self.cursor)
-        shop_channel = self.bot.get_channel(shop_id)
-
-        item_msg = await shop_channel.fetch_message(item_id)
-
         try:
-            item_results = get_shop_item(item_id, shop_id, self.cursor)
+            item_results = await self.db.run(get_shop_item, item_id, shop_id)
             embed = create_item_embed(user, item_results[2], item_desc, item_results[4],
                                       item_results[5], item_results[6], item_results[7])
 
-            set_shop_item_desc(item_id, shop_id, item_desc, self.cursor, self.cnx)
-            await item_msg.edit(embed=embed)
+            await self.db.run(set_shop_item_desc, item_id, shop_id, item_desc)
+            await self.edit_item_message(ctx, shop_id, item_id, embed)
         except ItemNotFoundError:
-            await ctx.send(
+            await self.outbound.send(ctx,
                 "Error: The item id was not found! Be sure to copy the correct id of your shop item message.")
             return
 
-        await ctx.send("Successfully updated the item description for " + item_results[2] + " to " + item_desc + "!")
+        await self.outbound.send(ctx, "Successfully updated the item description for " + item_results[2] + " to " + item_desc + "!")
 
     @commands.command()
     async def set_item_price(self, ctx, item_id, item_price):
@@ -252,36 +400,31 @@ class ShopQueries(commands.Cog):
         user = ctx.author
 
         try:
-            in_control_panel(user.id, ctx.message.channel.id, self.cursor)
+            shop_id = await self.get_panel_shop(ctx)
         except CommandNotControlPanelError:
             return  # do nothing in current channel
 
         try:
-            item_price = float(item_price)
-        except ValueError:
-            await ctx.send("Error: The item price must have a valid price! (eg. 00.00)")
+            item_price = validate_item_fields({'price': item_price})['price']
+        except InvalidItemFieldError as e:
+            await self.outbound.send(ctx, str(e))
             return
 
-        shop_id = get_user_shop(user.id, self.cursor)
-        shop_channel = self.bot.get_channel(shop_id)
-
-        item_msg = await shop_channel.fetch_message(item_id)
-
         try:
-            item_results = get_shop_item(item_id, shop_id, self.cursor)
+            item_results = await self.db.run(get_shop_item, item_id, shop_id)
             embed = create_item_embed(user, item_results[2], item_results[3], item_price,
                                       item_results[5], item_results[6], item_results[7])
 
-            set_shop_item_price(item_id, shop_id, item_price, self.cursor, self.cnx)
-            await item_msg.edit(embed=embed)
+            await self.db.run(set_shop_item_price, item_id, shop_id, item_price)
+            await self.edit_item_message(ctx, shop_id, item_id, embed)
         except ItemNotFoundError:
-            await ctx.send(
+            await self.outbound.send(ctx,
                 "Error: The item id was not found! Be sure to copy the correct id of your shop item message.")
             return
 
         formatted_price = "${:,.2f}".format(item_price)
 
-        await ctx.send("Successfully updated the item price for " + item_results[2] + " to " + formatted_price + "!")
+        await self.outbound.send(ctx, "Successfully updated the item price for " + item_results[2] + " to " + formatted_price + "!")
 
     @commands.command()
     async def set_item_quantity(self, ctx, item_id, item_qty):
@@ -293,36 +436,31 @@ class ShopQueries(commands.Cog):
         user = ctx.author
 
         try:
-            in_control_panel(user.id, ctx.message.channel.id, self.cursor)
+            shop_id = await self.get_panel_shop(ctx)
         except CommandNotControlPanelError:
             return  # do nothing in current channel
 
         try:
             item_qty = int(item_qty)
         except ValueError:
-            await ctx.send("Error: The item quantity must have a valid amount! (eg. 1)")
+            await self.outbound.send(ctx, "Error: The item quantity must have a valid amount! (eg. 1)")
             return
 
-        shop_id = get_user_shop(user.id, self.cursor)
-        shop_channel = self.bot.get_channel(shop_id)
-
-        item_msg = await shop_channel.fetch_message(item_id)
-
         try:
-            item_results = get_shop_item(item_id, shop_id, self.cursor)
+            item_results = await self.db.run(get_shop_item, item_id, shop_id)
             embed = create_item_embed(user, item_results[2], item_results[3], item_results[4],
                                       item_qty, item_results[6], item_results[7])
 
-            set_shop_item_qty(item_id, shop_id, item_qty, self.cursor, self.cnx)
-            await item_msg.edit(embed=embed)
+            await self.db.run(set_shop_item_qty, item_id, shop_id, item_qty)
+            await self.edit_item_message(ctx, shop_id, item_id, embed)
         except ItemNotFoundError:
-            await ctx.send(
+            await self.outbound.send(ctx,
                 "Error: The item id was not found! Be sure to copy the correct id of your shop item message.")
             return
 
         formatted_qty = "INF" if item_qty < 0 else str(item_qty)
 
-        await ctx.send("Successfully updated the item quantity for " + item_results[2] + " to " + formatted_qty + "!")
+        await self.outbound.send(ctx, "Successfully updated the item quantity for " + item_results[2] + " to " + formatted_qty + "!")
 
     @commands.command()
     async def set_item_type(self, ctx, item_id, item_type):
@@ -334,34 +472,29 @@ class ShopQueries(commands.Cog):
         user = ctx.author
 
         try:
-            in_control_panel(user.id, ctx.message.channel.id, self.cursor)
+            shop_id = await self.get_panel_shop(ctx)
         except CommandNotControlPanelError:
             return  # do nothing in current channel
 
         item_type = item_type.upper()
 
         if not (item_type == 'DIGITAL' or item_type == 'SERVICE'):
-            await ctx.send("Error: The item type must have a valid type! (eg. digital / service)")
+            await self.outbound.send(ctx, "Error: The item type must have a valid type! (eg. digital / service)")
             return
 
-        shop_id = get_user_shop(user.id, self.cursor)
-        shop_channel = self.bot.get_channel(shop_id)
-
-        item_msg = await shop_channel.fetch_message(item_id)
-
         try:
-            item_results = get_shop_item(item_id, shop_id, self.cursor)
+            item_results = await self.db.run(get_shop_item, item_id, shop_id)
             embed = create_item_embed(user, item_results[2], item_results[3], item_results[4],
                                       item_results[5], item_type, item_results[7])
 
-            set_shop_item_type(item_id, shop_id, item_type, self.cursor, self.cnx)
-            await item_msg.edit(embed=embed)
+            await self.db.run(set_shop_item_type, item_id, shop_id, item_type)
+            await self.edit_item_message(ctx, shop_id, item_id, embed)
         except ItemNotFoundError:
-            await ctx.send(
+            await self.outbound.send(ctx,
                 "Error: The item id was not found! Be sure to copy the correct id of your shop item message.")
             return
 
-        await ctx.send("Successfully updated the item type for " + item_results[2] + " to " + item_type + "!")
+        await self.outbound.send(ctx, "Successfully updated the item type for " + item_results[2] + " to " + item_type + "!")
 
     @commands.command()
     async def set_item_image(self, ctx, item_id, item_image):
@@ -373,35 +506,244 @@ class ShopQueries(commands.Cog):
         user = ctx.author
 
         try:
-            in_control_panel(user.id, ctx.message.channel.id, self.cursor)
+            shop_id = await self.get_panel_shop(ctx)
         except CommandNotControlPanelError:
             return  # do nothing in current channel
 
-        if len(item_image) >= 128:
-            await ctx.send("Error: The item image must be less than 128 characters long!")
+        try:
+            item_image = validate_item_fields({'image': item_image})['image']
+        except InvalidItemFieldError as e:
+            await self.outbound.send(ctx, str(e))
             return
 
-        if item_image.lower() == 'none':
-            item_image = item_image.lower()
+        try:
+            item_results = await self.db.run(get_shop_item, item_id, shop_id)
+            embed = create_item_embed(user, item_results[2], item_results[3], item_results[4],
+                                      item_results[5], item_results[6], item_image)
 
-        shop_id = get_user_shop(user.id, self.cursor)
-        shop_channel = self.bot.get_channel(shop_id)
+            await self.db.run(set_shop_item_image, item_id, shop_id, item_image)
+            await self.edit_item_message(ctx, shop_id, item_id, embed)
+        except ItemNotFoundError:
+            await self.outbound.send(ctx,
+                "Error: The item id was not found! Be sure to copy the correct id of your shop item message.")
+            return
+
+        await self.outbound.send(ctx, "Successfully updated the item image for " + item_results[2] + " to " + item_image + "!")
+
+    @commands.command()
+    async def set_item(self, ctx, item_id, *fields):
+        """
+        Sets several fields of an item at once
+        :param item_id: id for the item to update
+        :param fields: field=value pairs to update (name, desc, price, qty, type, image)
+        """
+        user = ctx.author
 
-        item_msg = await shop_channel.fetch_message(item_id)
+        try:
+            shop_id = await self.get_panel_shop(ctx)
+        except CommandNotControlPanelError:
+            return  # do nothing in current channel
+
+        updates = {}
+        for field in fields:
+            key, sep, value = field.partition('=')
+            key = key.strip().lower()
+
+            if sep == '' or key not in ITEM_FIELDS:
+                await self.outbound.send(ctx, "Error: Fields must be given as field=value using name, desc, price, qty, type or image!"
+                               " (Use quotes to include spaces)")
+                return
+
+            updates[key] = value
+
+        if len(updates) == 0:
+            await self.outbound.send(ctx, "Error: Must provide at least one field to update! (eg. price=1.00 qty=5)")
+            return
 
         try:
-            item_results = get_shop_item(item_id, shop_id, self.cursor)
-            embed = create_item_embed(user, item_results[2], item_results[3], item_results[4],
-                                      item_results[5], item_results[6], item_image)
+            updates = validate_item_fields(updates)
+        except InvalidItemFieldError as e:
+            await self.outbound.send(ctx, str(e))
+            return
 
-            set_shop_item_image(item_id, shop_id, item_image, self.cursor, self.cnx)
-            await item_msg.edit(embed=embed)
+        try:
+            item_results = await self.db.run(get_shop_item, item_id, shop_id)
         except ItemNotFoundError:
-            await ctx.send(
+            await self.outbound.send(ctx,
                 "Error: The item id was not found! Be sure to copy the correct id of your shop item message.")
             return
 
-        await ctx.send("Successfully updated the item image for " + item_results[2] + " to " + item_image + "!")
+        item = {field: updates.get(field, item_results[ITEM_FIELDS[field]]) for field in ITEM_FIELDS}
+        embed = create_item_embed(user, item['name'], item['desc'], item['price'], item['qty'], item['type'],
+                                  item['image'])
+
+        await self.db.run(set_shop_item_fields, item_id, shop_id, updates)     # one update for every field
+        await self.edit_item_message(ctx, shop_id, item_id, embed)
+
+        await self.outbound.send(ctx, "Successfully updated " + ", ".join(updates) + " for " + item_results[2] + "!")
+
+    @commands.command()
+    async def import_items(self, ctx):
+        """
+        Add many items to the shop from an attached .csv or .json file
+        Each item needs name, price, qty, type and desc, and optionally image (see add_item for the rules)
+        """
+        user = ctx.author
+
+        try:
+            shop_id = await self.get_panel_shop(ctx)
+        except CommandNotControlPanelError:
+            return  # do nothing in current channel
+
+        if len(ctx.message.attachments) == 0:
+            await self.outbound.send(ctx, "Error: Must attach a .csv or .json file of items to import!")
+            return
+
+        attachment = ctx.message.attachments[0]
+
+        try:
+            with span('discord read_attachment'):
+                data = await attachment.read()
+            rows = parse_item_file(attachment.filename, data)
+        except InvalidItemFieldError as e:
+            await self.outbound.send(ctx, str(e))
+            return
+
+        if len(rows) == 0 or len(rows) > MAX_IMPORT_ITEMS:
+            await self.outbound.send(ctx, "Error: The file must contain between 1 and " + str(MAX_IMPORT_ITEMS) + " items!")
+            return
+
+        items = []
+        for line, row in enumerate(rows, start=1):     # validate every item before sending anything
+            row = {str(key).strip().lower(): value for key, value in row.items()}
+            row.setdefault('image', 'none')
+
+            missing = [field for field in ('name', 'price', 'qty', 'type', 'desc') if row.get(field) is None]
+            if len(missing) > 0:
+                await self.outbound.send(ctx, "Error: Item " + str(line) + " is missing " + ", ".join(missing) + "!")
+                return
+
+            try:
+                items.append(validate_item_fields({field: row[field] for field in ITEM_FIELDS}))
+            except InvalidItemFieldError as e:
+                await self.outbound.send(ctx, "Item " + str(line) + ": " + str(e))
+                return
+
+        shop_channel = self.bot.get_channel(shop_id)
+        embeds = [create_item_embed(user, item['name'], item['desc'], item['price'], item['qty'], item['type'],
+                                    item['image']) for item in items]
+
+        messages = await send_embeds(self.outbound, shop_channel, embeds)
+
+        added = [(msg.id, item['name'], item['desc'], item['price'], item['qty'], item['type'], item['image'])
+                 for msg, item in zip(messages, items) if msg is not None]
+        hashes = [(msg.id, hash_render(embed.to_dict())) for msg, embed in zip(messages, embeds) if msg is not None]
+        try:
+            async with self.db.transaction() as tx:     # the items and the hashes of their embeds in one commit
+                await tx.run(add_shop_items, shop_id, added)
+                await tx.run(set_render_hashes, hashes)
+        except Exception:
+            for msg in messages:    # don't leave embeds in the shop for items that were never stored
+                if msg is not None:
+                    try:
+                        await self.outbound.delete(shop_id, msg.id)
+                    except discord.HTTPException:
+                        pass
+            await self.outbound.send(ctx, "Error: The items could not be added to your shop! Please try again.")
+            raise
+
+        if len(added) < len(items):
+            await self.outbound.send(ctx, "Added " + str(len(added)) + " of " + str(len(items)) + " items to your shop, "
+                           "the rest could not be posted. Please try adding them again.")
+        else:
+            await self.outbound.send(ctx, "You have successfully added " + str(len(added)) + " new items to your shop!")
+
+
+async def send_embeds(outbound, channel, embeds):
+    """
+    Sends embeds to a channel concurrently through the outbound queue, which paces them to the channel's rate limit
+    :param outbound: the OutboundQueue
+    :param channel: channel to send the embeds to
+    :param embeds: list of embeds to send
+    :return: list of sent messages in the same order as embeds, None for any embed that failed to send
+    """
+    async def send(embed):
+        try:
+            return await outbound.send(channel, embed=embed)
+        except discord.HTTPException:
+            return None
+
+    return await asyncio.gather(*(send(embed) for embed in embeds))
+
+
+def parse_item_file(filename, data):
+    """
+    Parses an item import file
+    :param filename: name of the attached file, used to pick the format
+    :param data: raw bytes of the file
+    :return: Raise InvalidItemFieldError if the file can't be read, list of item dicts otherwise
+    """
+    try:
+        text = data.decode('utf-8-sig')
+
+        if filename.lower().endswith('.json'):
+            rows = json.loads(text)
+            if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+                raise InvalidItemFieldError("Error: The .json file must be a list of items!")
+            return rows
+
+        if filename.lower().endswith('.csv'):
+            return list(csv.DictReader(io.StringIO(text)))
+    except (UnicodeDecodeError, ValueError, csv.Error):
+        raise InvalidItemFieldError("Error: The item file could not be read! Make sure it is valid .csv or .json")
+
+    raise InvalidItemFieldError("Error: Must attach a .csv or .json file of items to import!")
+
+
+def validate_item_fields(fields):
+    """
+    Validates and normalizes item fields using the same rules as add_item
+    :param fields: dict of field name (name, desc, price, qty, type, image) -> raw value
+    :return: Raise InvalidItemFieldError with the error message if a field is invalid, dict of normalized values
+    """
+    item = {}
+
+    for field, value in fields.items():
+        if field == 'name':
+            if not isinstance(value, str):
+                raise InvalidItemFieldError("Error: The item name must have a valid name! (Use quotes to include spaces)")
+        elif field == 'price':
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                raise InvalidItemFieldError("Error: The item price must have a valid price! (eg. 00.00)")
+            if not math.isfinite(value):    # nan and inf parse as floats but can't be stored
+                raise InvalidItemFieldError("Error: The item price must have a valid price! (eg. 00.00)")
+        elif field == 'qty':
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise InvalidItemFieldError("Error: The item quantity must have a valid amount! (eg. 1)")
+        elif field == 'type':
+            if not isinstance(value, str) or not (value.upper() == 'DIGITAL' or value.upper() == 'SERVICE'):
+                raise InvalidItemFieldError("Error: The item type must have a valid type! (eg. digital / service)")
+            value = value.upper()
+        elif field == 'desc':
+            if not isinstance(value, str):
+                raise InvalidItemFieldError("Error: The item description must have a valid description text!")
+            if len(value) >= 512:
+                raise InvalidItemFieldError("Error: The item description must be less than 512 characters long!")
+        elif field == 'image':
+            if not isinstance(value, str):
+                raise InvalidItemFieldError("Error: The item image must be a direct url or none!")
+            if len(value) >= 128:
+                raise InvalidItemFieldError("Error: The item image must be less than 128 characters long!")
+            if value.strip() == '' or value.lower() == 'none':    # eg. an empty cell of an imported .csv
+                value = 'none'
+
+        item[field] = value
+
+    return item
 
 
 def create_item_embed(user, item_name, item_desc, item_price, item_qty, item_type, item_image):
@@ -435,8 +777,16 @@ def create_item_embed(user, item_name, item_desc, item_price, item_qty, item_typ
     return embed
 
 
-def create_shop_sign(shop_owner, shop_results, cursor):
-    #shop_results = get_shop_item(shop_id, cursor)
+def hash_render(render):
+    """
+    Hashes a render to compare it with the last one
+    :param render: sign text, or the dict of an embed
+    :return: hex digest of the render
+    """
+    return hashlib.md5(json.dumps(render, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def create_shop_sign(shop_owner, shop_results):
 
     formatted_desc = "Shop description not yet set." if shop_results[3] == "" else shop_results[3]
     formatted_status = "open" if int(shop_results[4]) == 1 else "closed"
@@ -524,3 +874,7 @@ class ResponseError(Error):
 
 class ExistingUserError(Error):
     """Trying to create a user that already exists"""
+
+
+class InvalidItemFieldError(Error):
+    """An item field failed validation, the message is the error shown to the seller"""
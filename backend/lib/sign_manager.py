@@ -0,0 +1,122 @@
+import asyncio
+import functools
+import time
+
+import discord
+
+from backend.lib.helper_commands import ShopNotFoundError, get_shop, set_shop_sign, set_render_hashes
+from backend.lib.metrics import metrics
+from backend.lib.outbound import BACKGROUND, USER
+from backend.lib.tracing import span
+from backend.lib.shop_queries import create_shop_sign, hash_render
+
+
+class SignManager:
+    """
+    Keeps each shop's sign as the latest message of its channel.  Repost requests are coalesced so a burst of
+    messages in a shop costs at most one repost per shop per window, and nothing is sent if the sign is already
+    the latest message with up to date text.
+    """
+    def __init__(self, bot, db, outbound, window):
+        self.bot = bot
+        self.db = db
+        self.outbound = outbound
+        self.window = window    # seconds to wait for more messages before reposting
+        self.pending = {}       # shop id -> scheduled repost task
+        self.locks = {}         # shop id -> lock serializing reposts of that shop
+        self.posted = {}        # shop id -> (sign id, sign text) of the last sign we posted or edited
+
+    def request_repost(self, shop_id):
+        """
+        Schedule a sign repost for a shop, unless one is already scheduled
+        :param shop_id: channel id of the shop
+        :return: void
+        """
+        if shop_id in self.pending:
+            return  # coalesce with the repost already waiting
+
+        self.pending[shop_id] = self.bot.loop.create_task(self._repost_later(shop_id))
+
+    async def repost_now(self, shop_id):
+        """
+        Bring a shop's sign up to date immediately, eg. after its status changed
+        :param shop_id: channel id of the shop
+        :return: void
+        """
+        task = self.pending.pop(shop_id, None)
+        if task is not None:
+            task.cancel()
+
+        await self.repost(shop_id, USER)
+
+    async def _repost_later(self, shop_id):
+        """
+        Wait out the coalescing window, then repost the sign
+        :param shop_id: channel id of the shop
+        :return: void
+        """
+        await asyncio.sleep(self.window)
+        self.pending.pop(shop_id, None)
+
+        try:
+            await self.repost(shop_id)
+        except ShopNotFoundError:
+            pass    # shop was deleted while waiting
+
+    async def repost(self, shop_id, priority=BACKGROUND):
+        """
+        Make the shop's sign the latest message of its channel with current text
+        :param shop_id: channel id of the shop
+        :param priority: outbound priority, USER when a seller is waiting on the change
+        :return: Raise ShopNotFoundError if the shop doesn't exist, void otherwise
+        """
+        start = time.perf_counter()
+        try:
+            with span('sign repost'):
+                await self._repost(shop_id, priority)
+        finally:
+            metrics.observe('sign_repost_seconds', time.perf_counter() - start)
+
+    async def _repost(self, shop_id, priority):
+        lock = self.locks.setdefault(shop_id, asyncio.Lock())
+
+        async with lock:
+            shop_results = await self.db.run(get_shop, shop_id)
+            shop_channel = self.bot.get_channel(shop_id)
+            if shop_channel is None:
+                return
+
+            sign_id = int(shop_results[5])
+            sign_text = render_shop_sign(str(self.bot.get_user(int(shop_results[1]))), tuple(shop_results))
+
+            if shop_channel.last_message_id == sign_id:     # sign is still the latest message
+                if self.posted.get(shop_id) == (sign_id, sign_text):
+                    return  # nothing changed
+
+                try:
+                    await self.outbound.edit(shop_id, sign_id, content=sign_text, priority=priority)
+                    await self.db.run(set_render_hashes, [(sign_id, hash_render(sign_text))])
+                    self.posted[shop_id] = (sign_id, sign_text)
+                    return
+                except discord.NotFound:
+                    pass    # sign was deleted, post a new one
+
+            new_sign = await self.outbound.send(shop_channel, sign_text, priority=priority)
+            await self.db.run(set_shop_sign, shop_id, new_sign.id, hash_render(sign_text))
+            self.posted[shop_id] = (new_sign.id, sign_text)
+
+            try:
+                await self.outbound.delete(shop_id, sign_id, priority=priority)
+            except discord.NotFound:
+                pass    # old sign already gone
+
+
+@functools.lru_cache(maxsize=1024)
+def render_shop_sign(owner_name, shop_results):
+    """
+    Cached rendering of a shop sign, keyed on the owner name and the shop row
+    :param owner_name: display name of the shop owner
+    :param shop_results: the shop row as a tuple
+    :return: text of the shop sign
+    """
+    return create_shop_sign(owner_name, shop_results)
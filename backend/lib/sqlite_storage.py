@@ -0,0 +1,121 @@
+import datetime
+import queue
+import re
+import sqlite3
+import uuid
+
+MEMORY = ':memory:'
+
+# datetime columns come back as datetime objects, like they do from mysql.connector
+sqlite3.register_converter('datetime', lambda value: datetime.datetime.fromisoformat(value.decode()))
+
+
+class SQLitePool:
+    """
+    Connection pool with the same interface as mysql.connector's MySQLConnectionPool, backed by SQLite, so the bot
+    can run without a MySQL server either on a database file or entirely in memory.  The helper functions' MySQL
+    flavoured SQL is translated by SQLiteCursor.
+    """
+    def __init__(self, path, pool_size=5):
+        if path == MEMORY:
+            # every connection has to share one database, which only a named shared cache memory database allows,
+            # and shared cache locking fails instead of waiting so only one connection is used
+            path = 'file:discord_shop_' + uuid.uuid4().hex + '?mode=memory&cache=shared'
+            pool_size = 1
+
+        self.path = path
+        self.pool_size = pool_size
+        self.connections = queue.Queue()
+
+        for _ in range(pool_size):
+            cnx = sqlite3.connect(path, uri=path.startswith('file:'), check_same_thread=False, timeout=30,
+                                  detect_types=sqlite3.PARSE_DECLTYPES)
+            cnx.execute('pragma journal_mode=wal')  # readers don't block the writer
+            self.connections.put(SQLiteConnection(self, cnx))
+
+    def get_connection(self):
+        """
+        Check a connection out of the pool
+        :return: SQLiteConnection
+        """
+        return self.connections.get()
+
+
+class SQLiteConnection:
+    """A pooled SQLite connection, close() returns it to the pool like a pooled mysql.connector connection"""
+    def __init__(self, pool, cnx):
+        self.pool = pool
+        self.cnx = cnx
+
+    def cursor(self):
+        return SQLiteCursor(self.cnx.cursor())
+
+    def commit(self):
+        self.cnx.commit()
+
+    def rollback(self):
+        self.cnx.rollback()
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        """SQLite connections can't be dropped by a server, nothing to check"""
+
+    def close(self):
+        self.cnx.rollback()     # like pool_reset_session, nothing uncommitted carries over to the next user
+        self.pool.connections.put(self)
+
+
+class SQLiteCursor:
+    """
+    Cursor that accepts the MySQL flavoured SQL of the helper functions: %s placeholders, insert ignore and explain
+    """
+    dialect = 'sqlite'
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, statement, params=()):
+        return self.cursor.execute(translate(statement), params)
+
+    def executemany(self, statement, seq_params):
+        return self.cursor.executemany(translate(statement), seq_params)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size=None):
+        return self.cursor.fetchmany(size if size is not None else self.cursor.arraysize)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def close(self):
+        self.cursor.close()
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+
+def translate(statement):
+    """
+    Translates a MySQL statement used by the helper functions to SQLite
+    :param statement: MySQL statement
+    :return: SQLite statement
+    """
+    statement = statement.replace('%s', '?')
+    lowered = statement.lower()
+
+    if lowered.startswith('insert ignore '):
+        statement = 'insert or ignore ' + statement[len('insert ignore '):]
+    elif lowered.startswith('explain '):
+        statement = 'explain query plan ' + statement[len('explain '):]
+
+    if ' on duplicate key update ' in lowered:
+        statement = re.sub(r'(?i) on duplicate key update ', ' on conflict do update set ', statement)
+        statement = re.sub(r'(?i)\bvalues\((\w+)\)', r'excluded.\1', statement)
+
+    return statement
@@ -0,0 +1,128 @@
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import time
+
+current_trace = contextvars.ContextVar('current_trace', default=None)   # trace of the command being run
+
+slow_log = logging.getLogger('discord_shop.slow')   # one JSON line per slow command
+
+
+class Span:
+    """A timed step of a command, eg. one SQL helper call or one Discord request"""
+    def __init__(self, name, start, duration, error=None):
+        self.name = name
+        self.start = start          # seconds after the trace started
+        self.duration = duration    # seconds
+        self.error = error          # name of the exception raised, if any
+
+    def to_dict(self):
+        entry = {'name': self.name, 'start_ms': round(self.start * 1000, 3),
+                 'duration_ms': round(self.duration * 1000, 3)}
+        if self.error is not None:
+            entry['error'] = self.error
+        return entry
+
+
+class Trace:
+    """
+    Timeline of one command from the moment its message arrived.  Tasks the command starts (eg. with
+    asyncio.gather) inherit the trace through the context, so their spans are recorded too.
+    """
+    def __init__(self, name=None):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def add(self, name, start, error=None):
+        """
+        Record a span that started at start and ends now
+        :param name: name of the span
+        :param start: perf_counter time the span started
+        :param error: name of the exception raised, if any
+        :return: void
+        """
+        self.spans.append(Span(name, start - self.started, time.perf_counter() - start, error))
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def begin(name=None):
+    """
+    Start tracing the current task
+    :param name: name of the command, if already known
+    :return: the new Trace
+    """
+    trace = Trace(name)
+    current_trace.set(trace)
+    return trace
+
+
+def current():
+    """
+    Gets the trace of the current task
+    :return: Trace, or None if the task isn't traced
+    """
+    return current_trace.get()
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+    Time a step of the current command, does nothing outside of a traced command
+        with span('discord set_permissions'):
+            await shop_channel.set_permissions(...)
+    :param name: name of the span
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        trace.add(name, start, error)
+
+
+async def traced(name, awaitable):
+    """
+    Await something inside a span, for steps run with asyncio.gather
+    :param name: name of the span
+    :param awaitable: coroutine to await
+    :return: its result
+    """
+    with span(name):
+        return await awaitable
+
+
+def log_if_slow(trace, threshold, ctx):
+    """
+    Write a command to the slow log with its full span breakdown if it took longer than the threshold
+    :param trace: the command's Trace
+    :param threshold: seconds a command may take before it's logged
+    :param ctx: context of the command
+    :return: True if the command was logged
+    """
+    elapsed = trace.elapsed()
+    if elapsed < threshold:
+        return False
+
+    slow_log.warning(json.dumps({
+        'time': datetime.datetime.now().isoformat(),
+        'command': trace.name,
+        'author': ctx.author.id,
+        'channel': ctx.channel.id,
+        'message': ctx.message.content,
+        'total_ms': round(elapsed * 1000, 3),
+        'spans': [step.to_dict() for step in sorted(trace.spans, key=lambda step: step.start)],
+    }))
+    return True
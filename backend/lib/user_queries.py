@@ -1,19 +1,30 @@
+import asyncio
+
 import discord
 from discord.ext import commands
 from discord.utils import get
 from backend.lib.helper_commands import check_admin_status, AdminPermissionError, check_user_exists, \
     create_user_control_panel, create_user_shop, get_user_control_panel, ControlPanelNotFoundError, ShopNotFoundError, \
-    get_user_shop, delete_user_shop, delete_user_control_panel, get_name_from_id
-from backend.lib.shop_queries import create_shop_sign
+    get_user_shop, delete_user_shop, delete_user_control_panel, get_name_from_id, ExistingControlPanelError, \
+    ExistingShopError, on_commit, LOAD_BATCH, set_render_hashes
+from backend.lib.caches import admin_users
+from backend.lib.shop_queries import create_shop_sign, hash_render
+from backend.lib.tracing import span, traced
+
+
+AFFILIATE_CONCURRENCY = 3     # users onboarded or offboarded at once by set_affiliates
 
 
 class UserQueries(commands.Cog):
-    def __init__(self, bot, cursor, cnx, shop_category_id, control_category_id):
+    def __init__(self, bot, db, outbound, scheduler, shop_category_id, control_category_id):
         self.bot = bot
-        self.cursor = cursor
-        self.cnx = cnx
+        self.db = db
+        self.outbound = outbound
+        self.scheduler = scheduler
         self.shop_category_id = shop_category_id
         self.control_category_id = control_category_id
+        self.role_ids = {}      # (guild id, role name) -> role id
+        self.categories = {}    # category id -> category channel
 
     @commands.command()
     async def set_affiliate(self, ctx, user_id, status):
@@ -25,86 +36,218 @@ class UserQueries(commands.Cog):
         """
 
         try:
-            check_admin_status(ctx.author.id, False, self.cursor)
+            await self.db.run(check_admin_status, ctx.author.id, True)
         except AdminPermissionError:
-            await ctx.send("Error: You must be an admin to perform this command!")
+            await self.outbound.send(ctx, "Error: You must be an admin to perform this command!")
+            return
 
         status = status.lower()
 
         if not (status == 'true' or status == 'false'):  # check for valid response
-            await ctx.send("Error: Must provide a valid status for setting affiliate status! (eg. true / false)")
+            await self.outbound.send(ctx, "Error: Must provide a valid status for setting affiliate status! (eg. true / false)")
             return
 
+        user = ctx.guild.get_member(int(user_id)) if user_id.isdigit() else None
+
+        if user is None or await self.db.run(check_user_exists, user_id) == -1:
+            await self.outbound.send(ctx, "Error: Must provide a valid user id. This user doesn't exist!")
+            return
+
+        if status == 'true':
+            try:
+                await self.onboard(ctx.guild, user)
+            except (ExistingControlPanelError, ExistingShopError):
+                await self.outbound.send(ctx, "Error: " + user.name + " is already an affiliate!")
+                return
+        else:
+            await self.offboard(ctx.guild, user)
+
+        await self.outbound.send(ctx, "Successfully updated " + user.name + "'s affiliate status to " + status + "!")
+
+    @commands.command()
+    async def set_affiliates(self, ctx, status, *user_ids):
+        """
+        Update the affiliation status of several users at once
+        :param status: status of their affiliation (true / false)
+        :param user_ids: ids of the users to set affiliation status
+        :return: void
+        """
         try:
-            check_user_exists(user_id, self.cursor)
-        except UserNotFoundError:
-            await ctx.send("Error: Must provide a valid user id. This user doesn't exist!")
+            await self.db.run(check_admin_status, ctx.author.id, True)
+        except AdminPermissionError:
+            await self.outbound.send(ctx, "Error: You must be an admin to perform this command!")
             return
 
-        guild = ctx.guild
-        user = guild.get_member(int(user_id))
+        status = status.lower()
+
+        if not (status == 'true' or status == 'false'):  # check for valid response
+            await self.outbound.send(ctx, "Error: Must provide a valid status for setting affiliate status! (eg. true / false)")
+            return
 
-        affiliate_role = get(guild.roles, name="Affiliate")
+        if len(user_ids) == 0:
+            await self.outbound.send(ctx, "Error: Must provide at least one user id!")
+            return
 
-        if status == 'true':
-            control_category = self.bot.get_channel(self.control_category_id)
-            shop_category = self.bot.get_channel(self.shop_category_id)
+        semaphore = asyncio.Semaphore(AFFILIATE_CONCURRENCY)
 
-            admin_role = get(guild.roles, name="Creator")
+        async def update(user_id):
+            async with semaphore:
+                user = ctx.guild.get_member(int(user_id)) if user_id.isdigit() else None
 
-            control_overwrites = {
-                guild.default_role: discord.PermissionOverwrite(read_messages=False),
-                user: discord.PermissionOverwrite(read_messages=True),
-                admin_role: discord.PermissionOverwrite(read_messages=True)
-            }
+                if user is None or await self.db.run(check_user_exists, user_id) == -1:
+                    return user_id + " (user doesn't exist)"
 
-            shop_overwrites = {
-                guild.default_role: discord.PermissionOverwrite(read_messages=False, send_messages=False),
-                user: discord.PermissionOverwrite(read_messages=True, send_messages=False),
-                admin_role: discord.PermissionOverwrite(read_messages=True, send_messages=True)
-            }
+                try:
+                    if status == 'true':
+                        await self.onboard(ctx.guild, user)
+                    else:
+                        await self.offboard(ctx.guild, user)
+                except (ExistingControlPanelError, ExistingShopError):
+                    return user.name + " (already an affiliate)"
+                except discord.HTTPException:
+                    return user.name + " (Discord error)"
 
-            control_channel = await control_category.create_text_channel(user.name + 's control panel',
-                                                                         overwrites=control_overwrites)
+                return None
 
-            await control_channel.send("```Welcome to your shop control panel!\n\n"
-                                       "Here you can run commands to modify your shop.\n\n"
-                                       "Type *help to get started!```")
+        failures = [failure for failure in await asyncio.gather(*(update(user_id) for user_id in user_ids))
+                    if failure is not None]
 
-            await control_channel.send("```Please note additional help on commands can be found on our documentation page:\n\n"
-                                       "https://docs.google.com/document/d/1CW68wzUiIkLB4gMXKQdhTLo8BhZQDTICi4i5kqe1iKA/edit?usp=sharing```")
+        message = "Successfully updated " + str(len(user_ids) - len(failures)) + " of " + str(len(user_ids)) + \
+                  " users' affiliate status to " + status + "!"
+        if len(failures) > 0:
+            message += "\nNot updated: " + ", ".join(failures)
 
-            shop_name = user.name + 's shop'
-            shop_desc = ""
-            shop_channel = await shop_category.create_text_channel(shop_name, overwrites=shop_overwrites)
+        await self.outbound.send(ctx, message)
 
-            shop_results = [shop_channel.id, user.id, shop_desc, 0, -1]
-            shop_msg = await shop_channel.send(create_shop_sign(user, shop_results, self.cursor))
+    async def onboard(self, guild, user):
+        """
+        Make a user an affiliate: create their control panel and shop and give them the affiliate role
+        :param guild: the guild
+        :param user: member to onboard
+        :return: Raise ExistingControlPanelError / ExistingShopError if they already have one, void if successful
+        """
+        # check before creating anything on Discord, the unit of work below still catches a concurrent onboard
+        try:
+            await self.db.run(get_user_control_panel, user.id)
+            raise ExistingControlPanelError
+        except ControlPanelNotFoundError:
+            pass
 
-            create_user_control_panel(user_id, control_channel.id, self.cursor, self.cnx)
-            create_user_shop(user_id, shop_channel.id, shop_name, shop_desc, 0, shop_msg.id, self.cursor, self.cnx)
+        try:
+            await self.db.run(get_user_shop, user.id)
+            raise ExistingShopError
+        except ShopNotFoundError:
+            pass
+
+        admin_role = self.get_role(guild, "Creator")
+
+        control_overwrites = {
+            guild.default_role: discord.PermissionOverwrite(read_messages=False),
+            user: discord.PermissionOverwrite(read_messages=True),
+            admin_role: discord.PermissionOverwrite(read_messages=True)
+        }
+
+        shop_overwrites = {
+            guild.default_role: discord.PermissionOverwrite(read_messages=False, send_messages=False),
+            user: discord.PermissionOverwrite(read_messages=True, send_messages=False),
+            admin_role: discord.PermissionOverwrite(read_messages=True, send_messages=True)
+        }
+
+        shop_name = user.name + 's shop'
+        shop_desc = ""
+
+        with span('discord create_channels'):
+            control_channel, shop_channel = await asyncio.gather(
+                self.get_category(self.control_category_id).create_text_channel(user.name + 's control panel',
+                                                                                overwrites=control_overwrites),
+                self.get_category(self.shop_category_id).create_text_channel(shop_name, overwrites=shop_overwrites))
+
+        shop_results = (shop_channel.id, user.id, shop_name, shop_desc, 0, -1)
+        sign_text = create_shop_sign(user, shop_results)
+
+        shop_msg, _, _ = await asyncio.gather(
+            self.outbound.send(shop_channel, sign_text),
+            self.outbound.send(control_channel, "```Welcome to your shop control panel!\n\n"
+                                                "Here you can run commands to modify your shop.\n\n"
+                                                "Type *help to get started!```"),
+            self.outbound.send(control_channel, "```Please note additional help on commands can be found on our documentation page:\n\n"
+                                                "https://docs.google.com/document/d/1CW68wzUiIkLB4gMXKQdhTLo8BhZQDTICi4i5kqe1iKA/edit?usp=sharing```"))
+
+        async def save():
+            async with self.db.transaction() as tx:     # both rows or neither
+                await tx.run(create_user_control_panel, user.id, control_channel.id)
+                await tx.run(create_user_shop, user.id, shop_channel.id, shop_name, shop_desc, 0, shop_msg.id)
+                await tx.run(set_render_hashes, [(shop_msg.id, hash_render(sign_text))])
 
-            await user.add_roles(affiliate_role)
-            await ctx.send("Successfully updated " + user.name + "'s affiliate status to true!")
-        else:
-            # Try to delete control channel
+        try:
+            await asyncio.gather(save(),
+                                 traced('discord add_roles', user.add_roles(self.get_role(guild, "Affiliate"))))
+        except (ExistingControlPanelError, ExistingShopError):
+            with span('discord delete_channels'):
+                await asyncio.gather(control_channel.delete(), shop_channel.delete())     # don't leave duplicates behind
+            raise
+
+    async def offboard(self, guild, user):
+        """
+        Remove a user's affiliate status: delete their control panel, shop and items and take the affiliate role
+        :param guild: the guild
+        :param user: member to offboard
+        :return: void
+        """
+        deleted_channel_ids = []
+        shop_id = None
+
+        async with self.db.transaction() as tx:     # remove the control panel, shop and items in one commit
+            # Try to delete control panel
             try:
-                control_channel_id = get_user_control_panel(user_id, self.cursor)
-                await self.bot.get_channel(control_channel_id).delete()
-                delete_user_control_panel(user_id, self.cursor, self.cnx)
+                deleted_channel_ids.append(await tx.run(get_user_control_panel, user.id))
+                await tx.run(delete_user_control_panel, user.id)
             except ControlPanelNotFoundError:
                 pass
 
-            # Try to delete shop channel
+            # Try to delete shop
             try:
-                shop_channel_id = get_user_shop(user_id, self.cursor)
-                await self.bot.get_channel(shop_channel_id).delete()
-                delete_user_shop(user_id, self.cursor, self.cnx)
+                shop_id = await tx.run(get_user_shop, user.id)
+                await tx.run(delete_user_shop, user.id)
+                deleted_channel_ids.append(shop_id)
             except ShopNotFoundError:
                 pass
 
-            await user.remove_roles(affiliate_role)
-            await ctx.send("Successfully updated " + user.name + "'s affiliate status to false!")
+        if shop_id is not None:
+            self.scheduler.forget(shop_id)  # stop its opening hours
+
+        channels = [self.bot.get_channel(channel_id) for channel_id in deleted_channel_ids]     # delete once rows are gone
+        with span('discord remove_roles_and_delete_channels'):
+            await asyncio.gather(user.remove_roles(self.get_role(guild, "Affiliate")),
+                                 *(channel.delete() for channel in channels if channel is not None))
+
+    def get_role(self, guild, name):
+        """
+        Gets a role by name, caching its id so later lookups don't scan the guild's roles
+        :param guild: the guild
+        :param name: name of the role
+        :return: the role, or None if the guild has no role with that name
+        """
+        role_id = self.role_ids.get((guild.id, name))
+        role = guild.get_role(role_id) if role_id is not None else None
+
+        if role is None:    # not cached yet, or the role was deleted
+            role = get(guild.roles, name=name)
+            if role is not None:
+                self.role_ids[(guild.id, name)] = role.id
+
+        return role
+
+    def get_category(self, category_id):
+        """
+        Gets a category channel, cached after the first lookup
+        :param category_id: id of the category
+        :return: the category channel
+        """
+        category = self.categories.get(category_id)
+        if category is None:
+            category = self.categories[category_id] = self.bot.get_channel(category_id)
+        return category
 
     @commands.command()
     async def set_admin_status(self, ctx, user_id, status):
@@ -115,15 +258,15 @@ class UserQueries(commands.Cog):
         :return: the updated user table or an error message
         """
         try:
-            message = sql_set_admin_status(ctx.author.id, user_id, status, self.cursor, self.cnx)
+            message = await self.db.run(sql_set_admin_status, ctx.author.id, user_id, status)
         except AdminPermissionError:
-            await ctx.send("Permission Error encountered.  You do not have permission to edit the database")
+            await self.outbound.send(ctx, "Permission Error encountered.  You do not have permission to edit the database")
         except UserNotFoundError:
-            await ctx.send("Error: you are attempting to modify a user that does not exist.")
+            await self.outbound.send(ctx, "Error: you are attempting to modify a user that does not exist.")
         except ResponseError:
-            await ctx.send("Error: please supply either TRUE or FALSE for new admin status")
+            await self.outbound.send(ctx, "Error: please supply either TRUE or FALSE for new admin status")
         else:
-            await ctx.send(message)
+            await self.outbound.send(ctx, message)
 
 
 # SQL FUNCTIONS #
@@ -142,6 +285,45 @@ def sql_delete_user(user_id, cursor, cnx):
 
     cursor.execute('delete from user where user_id = %s', (user_id,))  # execute deletion query
     cnx.commit()  # commit changes to database
+    on_commit(cnx, lambda: admin_users.discard(user_id))
+
+
+def sql_delete_users(user_ids, cursor, cnx):
+    """
+    Delete several users with one query, ignoring users that don't exist
+    :param user_ids: ids of the users to delete
+    :param cursor: cursor object for executing query
+    :param cnx: connection object for committing changes
+    :return: number of users deleted
+    """
+    if len(user_ids) == 0:
+        return 0
+
+    cursor.execute('delete from user where user_id in (' + ', '.join(['%s'] * len(user_ids)) + ')', tuple(user_ids))
+    deleted = cursor.rowcount
+    cnx.commit()  # commit the whole batch at once
+
+    def update_caches():
+        for user_id in user_ids:
+            admin_users.discard(user_id)
+
+    on_commit(cnx, update_caches)
+    return deleted
+
+
+def get_user_joindates(cursor):
+    """
+    Streams the id, join date and admin flag of every user
+    :param cursor: cursor object for executing search query
+    :return: dict of user id -> (join date, True if admin)
+    """
+    users = {}
+    cursor.execute('select user_id, joindate, admin from user')
+    for rows in iter(lambda: cursor.fetchmany(LOAD_BATCH), []):
+        for user_id, joindate, admin in rows:
+            users[int(user_id)] = (joindate, int(admin) == 1)
+
+    return users
 
 
 def sql_add_user(user_id, display_name, email, is_admin, rank, joindate, cursor, cnx):
@@ -151,10 +333,31 @@ def sql_add_user(user_id, display_name, email, is_admin, rank, joindate, cursor,
     if not (is_admin.lower() == 'true' or is_admin.lower() == 'false'):  # check for valid response
         raise ResponseError()
 
-    cursor.execute('insert into user '
+    cursor.execute('insert into user (user_id, display_name, email, admin, `rank`, joindate) '
                    'values (%s, %s, %s, %s, %s, %s)',
                    (user_id, display_name, email, 1 if is_admin == "true" else 0, rank, joindate))
     cnx.commit()  # commit changes to database
+    if is_admin == "true":
+        on_commit(cnx, lambda: admin_users.put(user_id))
+
+
+def sql_add_users(users, cursor, cnx):
+    """
+    Add or refresh several users with one multi-row upsert.  Users that already exist keep their admin status and
+    rank, only their display name and join date are updated.
+    :param users: list of (user id, display name, join date)
+    :param cursor: cursor object for executing query
+    :param cnx: connection object for committing changes
+    :return: void
+    """
+    if len(users) == 0:
+        return
+
+    cursor.execute('insert into user (user_id, display_name, joindate) '
+                   'values ' + ', '.join(['(%s, %s, %s)'] * len(users)) + ' '
+                   'on duplicate key update display_name = values(display_name), joindate = values(joindate)',
+                   tuple(value for user in users for value in user))
+    cnx.commit()  # commit the whole batch at once
 
 
 def sql_set_admin_status(auth_user, user_id, new_status, cursor, cnx):
@@ -179,6 +382,7 @@ def sql_set_admin_status(auth_user, user_id, new_status, cursor, cnx):
                    'set admin = %s '
                    'where user_id = %s', (1 if new_status == "true" else 0, user_id))
     cnx.commit()  # commit changes to user table
+    on_commit(cnx, lambda: admin_users.put(user_id) if new_status == "true" else admin_users.discard(user_id))
     cursor.execute('select * from user where user_id = %s', (user_id,))  # get new user table
     return cursor.fetchall()
 
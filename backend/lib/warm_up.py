@@ -0,0 +1,49 @@
+import asyncio
+import time
+import traceback
+
+from backend.lib.helper_commands import load_shops, load_items, load_admins
+from backend.lib.metrics import metrics
+
+RETRY_DELAY = 5         # seconds before retrying a failed warm-up, doubled after every failure
+MAX_RETRY_DELAY = 300
+
+
+async def warm_up(db):
+    """
+    Bulk-load the shop, control panel, admin and item caches with a few streaming queries, smallest tables first.
+    Commands are accepted while this runs, helpers fall back to single row queries until their cache has loaded.
+    :param db: the Database
+    :return: dict of cache -> rows loaded
+    """
+    start = time.perf_counter()
+    counts = {}
+
+    counts['shops'], counts['control panels'] = await db.run(load_shops)
+    counts['admins'] = await db.run(load_admins)
+    counts['items'] = await db.run(load_items)
+
+    elapsed = time.perf_counter() - start
+    metrics.observe('warm_up_seconds', elapsed)
+    print('Warm-up loaded ' + ', '.join('{0} {1}'.format(count, name) for name, count in counts.items()) +
+          ' in {0:.2f}s'.format(elapsed))
+    return counts
+
+
+async def keep_warming(db):
+    """
+    Warm up the caches, retrying with backoff until it succeeds.  Until then the helpers keep falling back to the
+    database.
+    :param db: the Database
+    :return: dict of cache -> rows loaded
+    """
+    delay = RETRY_DELAY
+    while True:
+        try:
+            return await warm_up(db)
+        except Exception:
+            traceback.print_exc()
+            print('Warm-up failed, retrying in {0}s'.format(delay))
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MAX_RETRY_DELAY)
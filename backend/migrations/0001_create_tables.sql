@@ -0,0 +1,39 @@
+-- Tables used by the helper functions.  Column order matches the positional rows the bot reads with select *.
+
+create table if not exists user (
+    user_id bigint not null,
+    display_name varchar(64) not null,
+    email varchar(128) not null default '',
+    admin tinyint not null default 0,
+    `rank` int not null default 0,
+    joindate datetime null,
+    primary key (user_id)
+);
+
+create table if not exists shop (
+    shop_id bigint not null,
+    owner bigint not null,
+    name varchar(128) not null,
+    `desc` varchar(512) not null default '',
+    status tinyint not null default 0,
+    sign_id bigint not null,
+    primary key (shop_id)
+);
+
+create table if not exists shop_control (
+    shop_category_id bigint not null,
+    owner bigint not null,
+    primary key (shop_category_id)
+);
+
+create table if not exists item (
+    item_id bigint not null,
+    shop_id bigint not null,
+    name varchar(256) not null,
+    `desc` varchar(512) not null,
+    price decimal(10, 2) not null,
+    qty int not null,
+    type varchar(16) not null,
+    image varchar(128) not null,
+    primary key (item_id)
+);
@@ -0,0 +1,15 @@
+-- Indexes for the lookups in helper_commands.py.  The owner columns are unique, which create_user_control_panel and
+-- create_user_shop rely on for their insert ignore.
+
+-- get_user_shop, create_user_shop
+create unique index shop_owner on shop (owner);
+
+-- get_user_control_panel, in_control_panel, delete_user_control_panel, create_user_control_panel
+create unique index shop_control_owner on shop_control (owner);
+
+-- get_shop_item and the set_shop_item_* family use the primary key, delete_all_shop_items and delete_user_shop
+-- filter on shop_id alone
+create index item_shop on item (shop_id, item_id);
+
+-- get_id_from_name
+create index user_display_name on user (display_name);
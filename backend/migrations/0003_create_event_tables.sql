@@ -0,0 +1,31 @@
+-- Tables of the event reminders sent by reminders.py.  reminder_sent records who has been reminded of which event,
+-- so a restart never reminds anyone twice.
+
+create table if not exists game (
+    game_id int not null,
+    name varchar(128) not null,
+    primary key (game_id)
+);
+
+create table if not exists event (
+    event_id int not null,
+    game_id int not null,
+    title varchar(256) not null,
+    date datetime not null,
+    primary key (event_id)
+);
+
+create table if not exists registration (
+    event_id int not null,
+    user_id bigint not null,
+    primary key (event_id, user_id)
+);
+
+create table if not exists reminder_sent (
+    event_id int not null,
+    user_id bigint not null,
+    primary key (event_id, user_id)
+);
+
+-- get_upcoming_events
+create index event_date on event (date);
@@ -0,0 +1,10 @@
+-- Opening hours of shops, read by shop_hours.py.  Each row opens a shop on a day of the week (0 is Monday) and
+-- closes it again, times are minutes after midnight and a close before the open runs past midnight.
+
+create table if not exists shop_schedule (
+    shop_id bigint not null,
+    day tinyint not null,
+    open_minute smallint not null,
+    close_minute smallint not null,
+    primary key (shop_id, day)
+);
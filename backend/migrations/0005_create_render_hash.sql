@@ -0,0 +1,8 @@
+-- Hash of the last render of every item embed and shop sign the bot has posted or edited, keyed by message id.
+-- renderer.py compares new renders against it and only edits messages whose render changed.
+
+create table if not exists render_hash (
+    message_id bigint not null,
+    hash char(32) not null,
+    primary key (message_id)
+);
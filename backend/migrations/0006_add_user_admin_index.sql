@@ -0,0 +1,4 @@
+-- Index for the admin lookup in helper_commands.py, which check_query_plans otherwise reports as a full scan.
+
+-- load_admins
+create index user_admin on user (admin);
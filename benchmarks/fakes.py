@@ -0,0 +1,180 @@
+import itertools
+
+# Stand-ins for the discord.py objects the cogs touch.  Every call that would be a Discord API request is counted
+# on the ApiCounter instead of being sent.
+
+snowflakes = itertools.count(700000000000000000)    # ids for fake messages, channels, members and roles
+
+
+class ApiCounter:
+    """Counts simulated Discord API requests by name"""
+    def __init__(self):
+        self.calls = {}
+
+    def hit(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def total(self):
+        return sum(self.calls.values())
+
+    def reset(self):
+        self.calls = {}
+
+
+class FakeHTTP:
+    """The bot's HTTP client, used by the outbound queue for edits and deletes by id"""
+    def __init__(self, api):
+        self.api = api
+
+    async def edit_message(self, channel_id, message_id, **fields):
+        self.api.hit('edit_message')
+
+    async def delete_message(self, channel_id, message_id, *, reason=None):
+        self.api.hit('delete_message')
+
+
+class FakeBot:
+    def __init__(self, loop, api):
+        self.loop = loop
+        self.api = api
+        self.http = FakeHTTP(api)
+        self.channels = {}  # channel id -> FakeChannel
+        self.users = {}     # user id -> FakeMember
+        self.user = FakeMember(self, 'Shop Bot', True)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(int(channel_id))
+
+    def get_user(self, user_id):
+        return self.users.get(int(user_id))
+
+
+class FakeRole:
+    def __init__(self, name):
+        self.id = next(snowflakes)
+        self.name = name
+
+
+class FakeGuild:
+    def __init__(self, bot):
+        self.bot = bot
+        self.id = next(snowflakes)
+        self.default_role = FakeRole('@everyone')
+        self.roles = [self.default_role, FakeRole('Creator'), FakeRole('Affiliate')]
+        self.members = {}   # member id -> FakeMember
+
+    def get_role(self, role_id):
+        for role in self.roles:
+            if role.id == role_id:
+                return role
+        return None
+
+    def get_member(self, member_id):
+        return self.members.get(int(member_id))
+
+    def add_member(self, name, bot=False):
+        member = FakeMember(self.bot, name, bot)
+        member.guild = self
+        self.members[member.id] = member
+        self.bot.users[member.id] = member
+        return member
+
+    def add_channel(self, name, category_id=None):
+        channel = FakeChannel(self.bot, name, category_id)
+        self.bot.channels[channel.id] = channel
+        return channel
+
+
+class FakeMember:
+    def __init__(self, bot, name, bot_account=False):
+        self.bot_client = bot
+        self.id = next(snowflakes)
+        self.name = name
+        self.discriminator = '0001'
+        self.bot = bot_account
+        self.avatar = None
+        self.avatar_url = ''
+        self.joined_at = None
+        self.guild = None
+
+    def __str__(self):
+        return self.name + '#' + self.discriminator
+
+    async def send(self, content=None, **kwargs):
+        self.bot_client.api.hit('send_message')
+        return FakeMessage(next(snowflakes), self, None, content)
+
+    async def add_roles(self, *roles):
+        self.bot_client.api.hit('add_roles')
+
+    async def remove_roles(self, *roles):
+        self.bot_client.api.hit('remove_roles')
+
+
+class FakeChannel:
+    def __init__(self, bot, name, category_id=None):
+        self.bot = bot
+        self.id = next(snowflakes)
+        self.name = name
+        self.category_id = category_id
+        self.last_message_id = None
+
+    async def send(self, content=None, **kwargs):
+        self.bot.api.hit('send_message')
+        message = FakeMessage(next(snowflakes), self.bot.user, self, content)
+        self.last_message_id = message.id
+        return message
+
+    async def set_permissions(self, target, **permissions):
+        self.bot.api.hit('set_permissions')
+
+    async def delete(self):
+        self.bot.api.hit('delete_channel')
+        self.bot.channels.pop(self.id, None)
+
+    async def create_text_channel(self, name, overwrites=None):
+        """Channels are only created in categories"""
+        self.bot.api.hit('create_channel')
+        channel = FakeChannel(self.bot, name, self.id)
+        self.bot.channels[channel.id] = channel
+        return channel
+
+
+class FakeMessage:
+    def __init__(self, message_id, author, channel, content, attachments=()):
+        self.id = message_id
+        self.author = author
+        self.channel = channel
+        self.guild = None if channel is None else getattr(author, 'guild', None)
+        self.content = content or ''
+        self.attachments = list(attachments)
+
+    async def add_reaction(self, emoji):
+        self.channel.bot.api.hit('add_reaction')
+
+    async def remove_reaction(self, emoji, member):
+        self.channel.bot.api.hit('remove_reaction')
+
+
+class FakeAttachment:
+    def __init__(self, bot, filename, data):
+        self.bot = bot
+        self.filename = filename
+        self.data = data
+
+    async def read(self):
+        self.bot.api.hit('read_attachment')
+        return self.data
+
+
+class FakeContext:
+    """Context of a command typed by author in channel"""
+    def __init__(self, author, channel, attachments=()):
+        self.bot = channel.bot
+        self.author = author
+        self.channel = channel
+        self.guild = author.guild
+        self.message = FakeMessage(next(snowflakes), author, channel, '', attachments)
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
@@ -0,0 +1,501 @@
+"""
+Benchmarks every ShopQueries and UserQueries command and the EventActions listeners against a local database,
+with fake Discord objects standing in for the guild.  For each operation it records the wall time and the number of
+queries, commits and Discord API requests it costs.  Sign reposts triggered by an operation are counted as part of
+it, and the outbound queue is not paced so the numbers show the bot's own cost rather than Discord's rate limits.
+
+    python -m benchmarks.run [--backend memory|sqlite|mysql] [--config FILE] [--iterations N] [--only NAME ...]
+                             [--save FILE] [--compare FILE]
+
+--backend mysql uses the [Database] section of --config, which must point at a scratch database.  --save writes
+the results as JSON, --compare prints the difference from results saved earlier, eg. before a change.
+"""
+import argparse
+import asyncio
+import configparser
+import copy
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+from backend.lib.caches import control_panels
+from backend.lib.database import Database, open_pool
+from backend.lib.event_actions import EventActions
+from backend.lib.helper_commands import add_shop_item, set_shop_status
+from backend.lib.migrations import migrate
+from backend.lib.outbound import OutboundQueue
+from backend.lib.join_writer import JoinWriter
+from backend.lib.renderer import Renderer
+from backend.lib.shop_hours import ShopScheduler
+from backend.lib.shop_queries import ShopQueries
+from backend.lib.sign_manager import SignManager
+from backend.lib.sqlite_storage import MEMORY, SQLitePool
+from backend.lib.user_queries import UserQueries, sql_add_user
+from backend.lib.warm_up import warm_up
+from benchmarks.fakes import ApiCounter, FakeAttachment, FakeBot, FakeContext, FakeGuild, FakeMessage, snowflakes
+
+METRICS = ('wall_ms', 'queries', 'commits', 'api_calls')
+UNPACED = 10 ** 6   # rate limit high enough that the outbound queue never waits
+
+
+class QueryStats:
+    """Query and commit counts, updated from the database threads"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.commits = 0
+
+    def count(self, queries=0, commits=0):
+        with self.lock:
+            self.queries += queries
+            self.commits += commits
+
+    def reset(self):
+        with self.lock:
+            self.queries = 0
+            self.commits = 0
+
+
+class CountingPool:
+    """Wraps a connection pool so every statement and commit made through it is counted"""
+    def __init__(self, pool, stats):
+        self.pool = pool
+        self.stats = stats
+        self.pool_size = pool.pool_size
+
+    def get_connection(self):
+        return CountingConnection(self.pool.get_connection(), self.stats)
+
+
+class CountingConnection:
+    def __init__(self, cnx, stats):
+        self.cnx = cnx
+        self.stats = stats
+
+    def cursor(self):
+        return CountingCursor(self.cnx.cursor(), self.stats)
+
+    def commit(self):
+        self.stats.count(commits=1)
+        self.cnx.commit()
+
+    def __getattr__(self, name):
+        return getattr(self.cnx, name)
+
+
+class CountingCursor:
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+    def execute(self, statement, params=()):
+        self.stats.count(queries=1)
+        return self.cursor.execute(statement, params)
+
+    def executemany(self, statement, seq_params):
+        self.stats.count(queries=1)     # one batched statement
+        return self.cursor.executemany(statement, seq_params)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class World:
+    """A guild with an admin and a seller who owns a shop, wired to the cogs like bot_controller does"""
+    def __init__(self, db, stats, loop):
+        self.db = db
+        self.stats = stats
+        self.api = ApiCounter()
+        self.bot = FakeBot(loop, self.api)
+        self.guild = FakeGuild(self.bot)
+        self.general = self.guild.add_channel('general')
+        shop_category = self.guild.add_channel('Shops')
+        control_category = self.guild.add_channel('Control Panels')
+
+        self.outbound = OutboundQueue(self.bot, channel_rate=UNPACED, global_rate=UNPACED)
+        outbound = self.outbound
+        self.signs = SignManager(self.bot, db, outbound, 0)
+        scheduler = ShopScheduler(self.bot, db, outbound, self.signs)
+        self.shop_queries = ShopQueries(self.bot, db, outbound, self.signs, scheduler, shop_category.id,
+                                        control_category.id)
+        self.user_queries = UserQueries(self.bot, db, outbound, scheduler, shop_category.id, control_category.id)
+        self.joins = JoinWriter(self.bot, db)
+        self.renderer = Renderer(self.bot, db, outbound, self.signs)
+        self.events = EventActions(self.bot, db, outbound, self.signs, self.joins, self.renderer, shop_category.id)
+
+        self.admin = None
+        self.seller = None
+
+    async def setup(self):
+        await warm_up(self.db)     # same as on_ready
+
+        self.admin = await self.add_user('admin', admin=True)
+        self.seller = await self.add_affiliate('seller')
+
+    async def add_user(self, name, admin=False):
+        member = self.guild.add_member(name + str(next(snowflakes)))
+        member.joined_at = datetime.datetime.now().replace(microsecond=0)
+        await self.db.run(sql_add_user, member.id, str(member), '', 'true' if admin else 'false', 0,
+                          member.joined_at)
+        return member
+
+    async def add_affiliate(self, name):
+        member = await self.add_user(name)
+        await self.user_queries.onboard(self.guild, member)
+        return member
+
+    async def add_item(self, member):
+        item_id = next(snowflakes)
+        await self.db.run(add_shop_item, item_id, self.shop_id(member), 'Item', 'A benchmark item', 1.0, 5,
+                          'DIGITAL', 'none')
+        return item_id
+
+    def shop_id(self, member):
+        return control_panels.get_shop(member.id)
+
+    def panel_ctx(self, member, attachments=()):
+        return FakeContext(member, self.bot.get_channel(control_panels.get_panel(member.id)), attachments)
+
+    def admin_ctx(self):
+        return FakeContext(self.admin, self.general)
+
+    def command(self, cog, name, ctx, *args):
+        """Invoke a command's callback directly, skipping argument parsing"""
+        return getattr(cog, name).callback(cog, ctx, *args)
+
+    async def settle(self):
+        """Wait for sign reposts, buffered joins and background messages scheduled by the last operation"""
+        await asyncio.sleep(0)  # let tasks created by the operation start
+        if len(self.joins.buffer) > 0:
+            await self.joins.flush()
+        await asyncio.gather(*self.joins.pending)
+        while len(self.signs.pending) > 0:
+            await asyncio.gather(*self.signs.pending.values(), return_exceptions=True)
+        while self.outbound.depth() > 0:
+            await asyncio.sleep(0)
+
+    def reset(self):
+        self.stats.reset()
+        self.api.reset()
+
+
+# BENCHMARKS #
+
+# Each benchmark sets up what its operation needs and returns the operation as an unawaited coroutine.  Only the
+# operation is measured.
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+@benchmark('shop')
+async def bench_shop(world):
+    await world.db.run(set_shop_status, world.shop_id(world.seller), 0)
+    return world.command(world.shop_queries, 'shop', world.panel_ctx(world.seller), 'open')
+
+
+@benchmark('hours')
+async def bench_hours(world):
+    return world.command(world.shop_queries, 'hours', world.panel_ctx(world.seller), 'mon-fri', '09:00', '17:00')
+
+
+@benchmark('inventory')
+async def bench_inventory(world):
+    return world.command(world.shop_queries, 'inventory', world.panel_ctx(world.seller))
+
+
+@benchmark('search')
+async def bench_search(world):
+    await world.db.run(set_shop_status, world.shop_id(world.seller), 1)
+    await world.add_item(world.seller)
+    return world.command(world.shop_queries, 'search', world.admin_ctx(), 'benchmark', 'item', 'max=5', 'instock')
+
+
+@benchmark('add_item')
+async def bench_add_item(world):
+    return world.command(world.shop_queries, 'add_item', world.panel_ctx(world.seller),
+                         'Item', '1.00', '5', 'digital', 'none', 'A benchmark item')
+
+
+@benchmark('delete_item')
+async def bench_delete_item(world):
+    item_id = await world.add_item(world.seller)
+    return world.command(world.shop_queries, 'delete_item', world.panel_ctx(world.seller), str(item_id))
+
+
+@benchmark('set_item_name')
+async def bench_set_item_name(world):
+    item_id = await world.add_item(world.seller)
+    return world.command(world.shop_queries, 'set_item_name', world.panel_ctx(world.seller), str(item_id),
+                         'Renamed item')
+
+
+@benchmark('set_item_desc')
+async def bench_set_item_desc(world):
+    item_id = await world.add_item(world.seller)
+    return world.command(world.shop_queries, 'set_item_desc', world.panel_ctx(world.seller), str(item_id),
+                         'A new description')
+
+
+@benchmark('set_item_price')
+async def bench_set_item_price(world):
+    item_id = await world.add_item(world.seller)
+    return world.command(world.shop_queries, 'set_item_price', world.panel_ctx(world.seller), str(item_id), '2.50')
+
+
+@benchmark('set_item_quantity')
+async def bench_set_item_quantity(world):
+    item_id = await world.add_item(world.seller)
+    return world.command(world.shop_queries, 'set_item_quantity', world.panel_ctx(world.seller), str(item_id), '10')
+
+
+@benchmark('set_item_type')
+async def bench_set_item_type(world):
+    item_id = await world.add_item(world.seller)
+    return world.command(world.shop_queries, 'set_item_type', world.panel_ctx(world.seller), str(item_id),
+                         'service')
+
+
+@benchmark('set_item_image')
+async def bench_set_item_image(world):
+    item_id = await world.add_item(world.seller)
+    return world.command(world.shop_queries, 'set_item_image', world.panel_ctx(world.seller), str(item_id),
+                         'https://i.imgur.com/1sgUyPn.png')
+
+
+@benchmark('set_item')
+async def bench_set_item(world):
+    item_id = await world.add_item(world.seller)
+    return world.command(world.shop_queries, 'set_item', world.panel_ctx(world.seller), str(item_id),
+                         'price=2.50', 'qty=10', 'desc=Restocked and ready to go')
+
+
+@benchmark('import_items')
+async def bench_import_items(world):
+    data = 'name,price,qty,type,image,desc\n' + \
+           ''.join('Item {0},1.00,5,digital,none,A benchmark item\n'.format(i) for i in range(20))
+    attachment = FakeAttachment(world.bot, 'items.csv', data.encode('utf-8'))
+    return world.command(world.shop_queries, 'import_items', world.panel_ctx(world.seller, [attachment]))
+
+
+@benchmark('set_affiliate true')
+async def bench_set_affiliate_true(world):
+    member = await world.add_user('new affiliate')
+    return world.command(world.user_queries, 'set_affiliate', world.admin_ctx(), str(member.id), 'true')
+
+
+@benchmark('set_affiliate false')
+async def bench_set_affiliate_false(world):
+    member = await world.add_affiliate('old affiliate')
+    return world.command(world.user_queries, 'set_affiliate', world.admin_ctx(), str(member.id), 'false')
+
+
+@benchmark('set_affiliates true x5')
+async def bench_set_affiliates(world):
+    members = [await world.add_user('new affiliate') for _ in range(5)]
+    return world.command(world.user_queries, 'set_affiliates', world.admin_ctx(), 'true',
+                         *(str(member.id) for member in members))
+
+
+@benchmark('set_admin_status')
+async def bench_set_admin_status(world):
+    member = await world.add_user('member')
+    return world.command(world.user_queries, 'set_admin_status', world.admin_ctx(), str(member.id), 'true')
+
+
+@benchmark('on_member_join')
+async def bench_on_member_join(world):
+    member = world.guild.add_member('joiner' + str(next(snowflakes)))
+    member.joined_at = datetime.datetime.now().replace(microsecond=0)
+    return world.events.on_member_join(member)
+
+
+@benchmark('on_member_join x100')
+async def bench_on_member_join_burst(world):
+    members = [world.guild.add_member('joiner' + str(next(snowflakes))) for _ in range(100)]
+    for member in members:
+        member.joined_at = datetime.datetime.now().replace(microsecond=0)
+
+    async def burst():
+        for member in members:
+            await world.events.on_member_join(member)
+
+    return burst()
+
+
+@benchmark('on_member_remove')
+async def bench_on_member_remove(world):
+    member = await world.add_user('leaver')
+    return world.events.on_member_remove(member)
+
+
+@benchmark('on_user_update')
+async def bench_on_user_update(world):
+    before = copy.copy(world.seller)
+    world.seller.avatar = str(next(snowflakes))    # new avatar, so every item embed changes
+    world.seller.avatar_url = 'https://cdn.discordapp.com/avatars/' + world.seller.avatar + '.png'
+    return world.events.on_user_update(before, world.seller)
+
+
+@benchmark('on_message')
+async def bench_on_message(world):
+    channel = world.bot.get_channel(world.shop_id(world.seller))
+    message = FakeMessage(next(snowflakes), world.admin, channel, 'Is this still available?')
+    channel.last_message_id = message.id   # the sign is no longer the latest message
+    return world.events.on_message(message)
+
+
+@benchmark('on_message general')
+async def bench_on_message_general(world):
+    return world.events.on_message(FakeMessage(next(snowflakes), world.admin, world.general, 'Hello'))
+
+
+# RUNNER #
+
+
+async def run_benchmarks(world, iterations, only):
+    """
+    Run the benchmarks
+    :param world: World that has been set up
+    :param iterations: times to run each operation
+    :param only: names of the benchmarks to run, all if empty
+    :return: dict of benchmark name -> dict of metric -> value
+    """
+    results = {}
+
+    for name, setup in BENCHMARKS:
+        if len(only) > 0 and name not in only:
+            continue
+
+        samples = {metric: [] for metric in METRICS}
+        for _ in range(iterations):
+            operation = await setup(world)
+            await world.settle()
+            world.reset()
+
+            start = time.perf_counter()
+            await operation
+            await world.settle()
+            samples['wall_ms'].append((time.perf_counter() - start) * 1000)
+            samples['queries'].append(world.stats.queries)
+            samples['commits'].append(world.stats.commits)
+            samples['api_calls'].append(world.api.total())
+
+        results[name] = {'wall_ms': round(statistics.median(samples['wall_ms']), 3),
+                         'wall_ms_mean': round(statistics.mean(samples['wall_ms']), 3),
+                         'queries': statistics.mean(samples['queries']),
+                         'commits': statistics.mean(samples['commits']),
+                         'api_calls': statistics.mean(samples['api_calls'])}
+
+    return results
+
+
+def open_database(backend, config_path):
+    """
+    Opens the database to benchmark against and brings its schema up to date
+    :param backend: memory, sqlite or mysql
+    :param config_path: configuration file with the [Database] section to use for mysql
+    :return: (Database, QueryStats, cleanup function)
+    """
+    cleanup = lambda: None
+
+    if backend == 'memory':
+        pool = SQLitePool(MEMORY)
+    elif backend == 'sqlite':
+        directory = tempfile.TemporaryDirectory()
+        pool = SQLitePool(os.path.join(directory.name, 'benchmark.db'))
+        cleanup = directory.cleanup
+    else:
+        config = configparser.ConfigParser()
+        config.read(config_path)
+        pool = open_pool(config['Database'])
+
+    stats = QueryStats()
+    db = Database(CountingPool(pool, stats))
+    db.call(migrate)
+    return db, stats, cleanup
+
+
+def get_commit():
+    """
+    Gets the commit the benchmarks ran on
+    :return: short commit hash, or None outside of a git checkout
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous=None):
+    """
+    Print the results as a table, with the change from previous results if given
+    :param results: dict of benchmark name -> metrics
+    :param previous: dict of benchmark name -> metrics from an earlier run, or None
+    :return: void
+    """
+    print('{0:<26}{1:>18}  {2:>14}  {3:>14}  {4:>16}'.format('operation', 'wall ms', 'queries', 'commits', 'api calls'))
+
+    for name, metrics in results.items():
+        cells = []
+        for metric in METRICS:
+            cell = '{0:g}'.format(round(metrics[metric], 3))
+            old = None if previous is None or name not in previous else previous[name].get(metric)
+            if old is not None and old != metrics[metric]:
+                if metric == 'wall_ms' and old > 0:
+                    cell += ' ({0:+.0f}%)'.format((metrics[metric] - old) / old * 100)
+                else:
+                    cell += ' ({0:+g})'.format(round(metrics[metric] - old, 3))
+            cells.append(cell)
+
+        print('{0:<26}{1:>18}  {2:>14}  {3:>14}  {4:>16}'.format(name, *cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cost of every bot command and listener')
+    parser.add_argument('--backend', choices=('memory', 'sqlite', 'mysql'), default='memory')
+    parser.add_argument('--config', default='configuration.conf', help='configuration with a scratch [Database]')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--only', nargs='*', default=[], help='names of the benchmarks to run')
+    parser.add_argument('--save', help='file to save the results to')
+    parser.add_argument('--compare', help='results saved by an earlier run to compare with')
+    args = parser.parse_args()
+
+    db, stats, cleanup = open_database(args.backend, args.config)
+    loop = asyncio.get_event_loop()
+
+    try:
+        world = World(db, stats, loop)
+        loop.run_until_complete(world.setup())
+        results = loop.run_until_complete(run_benchmarks(world, args.iterations, args.only))
+    finally:
+        db.close()
+        cleanup()
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as saved:
+            previous = json.load(saved)['results']
+
+    print_results(results, previous)
+
+    if args.save is not None:
+        with open(args.save, 'w') as saved:
+            json.dump({'commit': get_commit(), 'backend': args.backend, 'iterations': args.iterations,
+                       'created': datetime.datetime.now().isoformat(), 'results': results}, saved, indent=2)
+
+
+if __name__ == '__main__':
+    main()
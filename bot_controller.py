@@ -1,14 +1,30 @@
 import configparser
 import discord
 import asyncio
+import logging
+import sys
+import time
+import traceback
 from discord.ext import commands, tasks
 from datetime import datetime, timedelta
-import mysql.connector
 
 from backend.lib.shop_queries import ShopQueries
 from backend.lib.user_queries import UserQueries
 from backend.lib.helper_commands import HelperCommands
 from backend.lib.event_actions import EventActions
+from backend.lib.database import Database, open_pool
+from backend.lib.migrations import migrate
+from backend.lib.sign_manager import SignManager
+from backend.lib.warm_up import keep_warming
+from backend.lib.reconciler import Reconciler
+from backend.lib.reminders import ReminderDispatcher
+from backend.lib.shop_hours import ShopScheduler
+from backend.lib.join_writer import JoinWriter
+from backend.lib.member_sync import MemberSync
+from backend.lib.renderer import Renderer
+from backend.lib.outbound import OutboundQueue
+from backend.lib.metrics import metrics, serve, RateLimitHandler
+from backend.lib import tracing
 
 
 def main():
@@ -21,19 +37,49 @@ def main():
     shop_category_id = int(config['Discord']['shop_category_id'])  # id of the shop category
     control_category_id = int(config['Discord']['control_category_id'])  # id of the control panel category
     command_prefix = config['Discord']['prefix']
+    sign_repost_window = config['Discord'].getfloat('sign_repost_window', 5.0)  # seconds to coalesce sign reposts
+    metrics_host = config.get('Metrics', 'host', fallback='127.0.0.1')     # local Prometheus endpoint
+    metrics_port = config.getint('Metrics', 'port', fallback=0)    # 0 disables the endpoint
+    slow_command_seconds = config.getfloat('Tracing', 'slow_command_ms', fallback=1000) / 1000   # slow log threshold
+    slow_log_path = config.get('Tracing', 'slow_log', fallback='slow_commands.log')
+    reconcile_interval = config.getfloat('Reconciler', 'interval', fallback=3600)     # seconds between repair cycles
+    reconcile_max_api_calls = config.getint('Reconciler', 'max_api_calls', fallback=50)   # Discord requests per cycle
+    reminder_channel_id = config.getint('Reminders', 'channel_id', fallback=event_channel_id)   # for users without DMs
+    reminder_lead = timedelta(hours=config.getfloat('Reminders', 'lead_hours', fallback=24))   # reminder before event
+    join_batch_size = config.getint('Joins', 'batch_size', fallback=100)   # joining members written per upsert
+    join_flush_seconds = config.getfloat('Joins', 'flush_ms', fallback=500) / 1000     # longest a join is buffered
 
-    username = config['Database']['username']       # get details for signing in to database
-    password = config['Database']['password']
-    host = config['Database']['host']
-    database = config['Database']['database']
+    pool = open_pool(config['Database'])     # connect to the mysql, sqlite or memory database
+    db = Database(pool)     # run queries off of the event loop, one pooled connection per query
 
-    cnx = mysql.connector.connect(user=username,
-                                  password=password,
-                                  host=host,
-                                  database=database)        # connect to the database
-    cursor = cnx.cursor()       # create cursor object for executing queries
+    if config['Database'].getboolean('migrate', True):
+        for version, name in db.call(migrate):      # bring the schema up to date before accepting commands
+            print('Applied migration {0:04d} {1}'.format(version, name))
 
     client = commands.Bot(command_prefix=command_prefix, case_insensitive=True)       # create the bot client
+    outbound = OutboundQueue(client)     # paces message sends, edits and deletes per channel
+    signs = SignManager(client, db, outbound, sign_repost_window)      # keeps shop signs at the bottom of shop channels
+    warming = []    # warm-up task started by on_ready
+    scheduler = ShopScheduler(client, db, outbound, signs)
+    scheduler.start()       # opens and closes shops on their opening hours
+    reconciler = Reconciler(client, db, outbound, signs, scheduler, reconcile_interval, reconcile_max_api_calls)
+    reconciler.start()      # reposts signs and items deleted by hand, removes orphaned rows
+    joins = JoinWriter(client, db, join_batch_size, join_flush_seconds)     # batches the users of joining members
+    members = MemberSync(client, db)
+    members.start()     # adds and removes users for members who joined or left while offline
+    renderer = Renderer(client, db, outbound, signs)     # edits item embeds and signs whose render changed
+    reminders = ReminderDispatcher(client, db, outbound, reminder_channel_id, reminder_lead)
+    reminders.start()       # reminds users of the events they registered for
+
+    metrics.gauge('outbound_queue_depth', outbound.depth)
+    logging.getLogger('discord.http').addHandler(RateLimitHandler())     # count 429s
+    if metrics_port != 0:
+        client.loop.create_task(serve(metrics_host, metrics_port))
+
+    slow_log_handler = logging.FileHandler(slow_log_path)     # slow commands with their span breakdown
+    slow_log_handler.setFormatter(logging.Formatter('%(message)s'))
+    tracing.slow_log.addHandler(slow_log_handler)
+    tracing.slow_log.propagate = False
 
     # BOT EVENTS #
 
@@ -43,41 +89,49 @@ def main():
         on_ready() is called when the bot is signed in to Discord and ready to send/receive event notifications
         :return: none; print ready status to console
         """
+        if len(warming) == 0 or warming[0].done():     # reload the caches in the background after (re)connecting
+            warming[:] = [client.loop.create_task(keep_warming(db))]
         await client.change_presence(activity=discord.Game(name='Managing Shops'))
         print('We have logged in as {0.user}'.format(client))
 
-    """
-    async def sendreminders():
-        remchan = client.get_channel(reminder_channel_id)
-        command = 'select registration.user_id, game.name, event.title, DATE_FORMAT(event.date,"%M %d %Y")' \
-                  ' from event inner join game on event.game_id = game.game_id'\
-                  ' inner join registration on registration.event_id = event.event_id '\
-                  ' where event.date > CURDATE() and event.date <= DATE_ADD(CURDATE(),INTERVAL 1 DAY)'
-        cursor.execute(command)
-        for line in cursor.fetchall():
-            message = "Reminding <@%d> you are registered to play %s in '%s' on %s " % (line[0], line[1], line[2], line[3])
-            await remchan.send(message)
-
-    async def remindertask():
-        hour = 23
-        minute = 58
-        await client.wait_until_ready()
-        while not client.is_closed():
-            now = datetime.now()
-            future = datetime(now.year, now.month, now.day, hour, minute)
-            if now.hour >= hour and now.minute > minute:
-                future += timedelta(days=1)
-            await asyncio.sleep((future - now).seconds)
-            await sendreminders()
-
-    client.loop.create_task(remindertask())
-    """
+    @client.event
+    async def on_message(message):
+        """
+        on_message() is called for every message, start tracing before the bot looks for a command in it
+        :return: none
+        """
+        tracing.begin()
+        await client.process_commands(message)
+
+    @client.before_invoke
+    async def start_command_timer(ctx):
+        ctx.started = time.perf_counter()
+        trace = tracing.current() or tracing.begin()
+        trace.name = ctx.command.qualified_name
+        trace.add('dispatch', trace.started)    # parsing and checks since the message arrived
+
+    @client.after_invoke
+    async def stop_command_timer(ctx):
+        metrics.observe('command_seconds', time.perf_counter() - ctx.started, command=ctx.command.qualified_name)
+        tracing.log_if_slow(tracing.current(), slow_command_seconds, ctx)
+
+    @client.event
+    async def on_command_error(ctx, error):
+        """
+        on_command_error() is called when a command raises, count the error then report it like discord.py does
+        :return: none; print the traceback to stderr
+        """
+        error = getattr(error, 'original', error)   # unwrap CommandInvokeError
+        metrics.increment('errors_total', source=ctx.command.qualified_name if ctx.command else 'dispatch',
+                          error=type(error).__name__)
+        print('Ignoring exception in command {0}:'.format(ctx.command), file=sys.stderr)
+        traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
 
     # RUN THE BOT #
-    client.add_cog(HelperCommands(client, cursor, cnx))
-    client.add_cog(UserQueries(client, cursor, cnx, shop_category_id, control_category_id))
-    client.add_cog(ShopQueries(client, cursor, cnx, shop_category_id, control_category_id))
-    client.add_cog(EventActions(client, cursor, cnx))
+    client.add_cog(HelperCommands(client, db, outbound, members, renderer))
+    client.add_cog(UserQueries(client, db, outbound, scheduler, shop_category_id, control_category_id))
+    client.add_cog(ShopQueries(client, db, outbound, signs, scheduler, shop_category_id, control_category_id))
+    client.add_cog(EventActions(client, db, outbound, signs, joins, renderer, shop_category_id))
     client.run(token)
 
 